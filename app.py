@@ -3,26 +3,151 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+import asyncio
+import atexit
 import json
 import re
-import requests
 import logging
+import logging.handlers
+import queue
+import sys
+import uuid
+from datetime import datetime, timezone
 from functools import wraps
 import base64
+import bisect
+import contextvars
+import hashlib
+import random
+import sqlite3
+import threading
 import time
-from typing import Dict, List
+import unicodedata
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
 
-from quart import Quart, request, jsonify, Response
+import aiohttp
+import numpy as np
+
+from local_index import SIMILARITY_FIELD, VECTOR_FIELD, LocalIndex
+
+try:
+    import tiktoken
+except ImportError:  # tokenizador opcional: sin él se estima ~4 chars/token
+    tiktoken = None
+from quart import Quart, request, jsonify, Response, g
 from botbuilder.core import (
+    BotAdapter,
     BotFrameworkAdapter,
     BotFrameworkAdapterSettings,
     TurnContext,
 )
 from botbuilder.schema import Activity, ActivityTypes
-from openai import AzureOpenAI
+import openai
+from openai import AsyncAzureOpenAI
+
+# 🔹 Logging: JSON estructurado, en cola (un hilo escribe) y con formateo diferido
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BODY_SAMPLE_RATE = float(os.getenv("LOG_BODY_SAMPLE_RATE", "0.01"))
+LOG_BODY_MAX_CHARS = int(os.getenv("LOG_BODY_MAX_CHARS", "2000"))
+
+request_id_var: "contextvars.ContextVar[str]" = contextvars.ContextVar("request_id", default="-")
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro; los campos de extra={...} se añaden tal cual."""
+
+    _STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "request_id", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self._STANDARD:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Encola el LogRecord sin formatearlo: msg % args, el JSON y la escritura se hacen en el hilo
+    del QueueListener, fuera del event loop. Con la cola llena el registro se descarta (y se cuenta)
+    en vez de bloquear la petición.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _TruncatedJson:
+    """Serializa y trunca un payload solo si el registro llega a formatearse (en el hilo de logging)."""
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        text = json.dumps(self.payload, ensure_ascii=False, default=str)
+        if len(text) > LOG_BODY_MAX_CHARS:
+            return f"{text[:LOG_BODY_MAX_CHARS]}… ({len(text)} chars)"
+        return text
+
+
+def log_payload(message: str, payload):
+    """Cuerpo de una petición: siempre con DEBUG activo; a INFO solo una muestra (LOG_BODY_SAMPLE_RATE)."""
+    if logging.getLogger().isEnabledFor(logging.DEBUG) or random.random() < LOG_BODY_SAMPLE_RATE:
+        logging.info("%s: %s", message, _TruncatedJson(payload))
+
+
+def setup_logging(stream=None) -> Tuple[logging.handlers.QueueListener, NonBlockingQueueHandler]:
+    """Sustituye los handlers del root logger por la cola; el listener escribe en stream (stderr)."""
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"))
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener, queue_handler
+
+
+log_listener: Optional[logging.handlers.QueueListener] = None
+log_handler: Optional[NonBlockingQueueHandler] = None
 
-# 🔹 Habilitar logging
-logging.basicConfig(level=logging.INFO)
+
+def configure_logging():
+    """Activa el logging en cola una sola vez; se llama al arrancar, no al importar app.py."""
+    global log_listener, log_handler
+    if log_listener is None:
+        log_listener, log_handler = setup_logging()
 
 
 # 🔹 Quart App
@@ -32,6 +157,10 @@ app = Quart(__name__)
 AZURE_SEARCH_SERVICE = os.getenv("AZURE_SEARCH_SERVICE")
 AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
 INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX")
+# Permite apuntar a otro endpoint (p.ej. el stand-in local de mock_azure.py para pruebas de carga)
+AZURE_SEARCH_ENDPOINT = (
+    os.getenv("AZURE_SEARCH_ENDPOINT") or f"https://{AZURE_SEARCH_SERVICE}.search.windows.net"
+).rstrip("/")
 
 # 🔹 Azure OpenAI config
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -39,12 +168,133 @@ AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 AZURE_OPENAI_DEPLOYMENT_INTENT = os.getenv("AZURE_OPENAI_DEPLOYMENT_INTENT", "gpt-4o-mini")
 
-# 🔹 Azure OpenAI SDK client
-openai_client = AzureOpenAI(
-    api_key=AZURE_OPENAI_API_KEY,
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    api_version="2024-02-01"
-)
+# 🔹 Detección de intención: llm | local | hybrid
+INTENT_MODE = os.getenv("INTENT_MODE", "hybrid").lower()
+INTENT_KEYWORD_MIN_CONFIDENCE = float(os.getenv("INTENT_KEYWORD_MIN_CONFIDENCE", "0.6"))
+INTENT_CENTROIDS_PATH = os.getenv("INTENT_CENTROIDS_PATH", "")
+INTENT_CENTROID_MIN_MARGIN = float(os.getenv("INTENT_CENTROID_MIN_MARGIN", "0.03"))
+
+# 🔹 Clientes async (se crean al arrancar el servidor y se cierran al pararlo)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+SEARCH_HYBRID_TIMEOUT = float(os.getenv("SEARCH_HYBRID_TIMEOUT", "10"))
+SEARCH_CLASSIC_TIMEOUT = float(os.getenv("SEARCH_CLASSIC_TIMEOUT", "10"))
+
+# 🔹 Filtro de relevancia previo a la generación y enrutado de consultas sencillas
+RELEVANCE_GATE_ENABLED = os.getenv("RELEVANCE_GATE_ENABLED", "true").lower() == "true"
+RELEVANCE_GATE_MIN_SIMILARITY = float(os.getenv("RELEVANCE_GATE_MIN_SIMILARITY", "0.2"))
+RELEVANCE_GATE_MIN_SCORE = float(os.getenv("RELEVANCE_GATE_MIN_SCORE", "0"))
+# 🔹 content_vector en la búsqueda: ~0.5 MB de JSON por búsqueda (15 × 1536 floats); opt-in
+SEARCH_RETURN_VECTORS = os.getenv("SEARCH_RETURN_VECTORS", "false").lower() == "true"
+ROUTE_SIMPLE_QUERIES = os.getenv("ROUTE_SIMPLE_QUERIES", "false").lower() == "true"
+SIMPLE_QUERY_MAX_TOKENS = int(os.getenv("SIMPLE_QUERY_MAX_TOKENS", "16"))
+SIMPLE_QUERY_INTENTS = set(os.getenv("SIMPLE_QUERY_INTENTS", "consulta_directa").split(","))
+
+# 🔹 Sesiones por conversación: reutilizar lo recuperado en el turno anterior para las repreguntas
+SESSION_ENABLED = os.getenv("SESSION_ENABLED", "true").lower() == "true"
+SESSION_TTL = float(os.getenv("SESSION_TTL", "900"))
+SESSION_MAX_CONVERSATIONS = int(os.getenv("SESSION_MAX_CONVERSATIONS", "1000"))
+SESSION_MAX_MEMORY_MB = float(os.getenv("SESSION_MAX_MEMORY_MB", "64"))
+SESSION_REUSE_MIN_SIMILARITY = float(os.getenv("SESSION_REUSE_MIN_SIMILARITY", "0.45"))
+SESSION_REUSE_RATIO = float(os.getenv("SESSION_REUSE_RATIO", "0.9"))
+SESSION_MAX_REUSES = int(os.getenv("SESSION_MAX_REUSES", "3"))
+# Sin content_vector (SEARCH_RETURN_VECTORS=false y sin índice local) se calcula el embedding de los chunks
+SESSION_EMBED_CHUNKS = os.getenv("SESSION_EMBED_CHUNKS", "true").lower() == "true"
+
+# 🔹 Índice local (local_index.py): "fallback" si Azure Search falla, "primary" para no usar Azure Search
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "")
+LOCAL_INDEX_MODE = os.getenv("LOCAL_INDEX_MODE", "fallback").lower()
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+
+openai_client: AsyncAzureOpenAI = None
+http_session: aiohttp.ClientSession = None
+
+# 🔹 Embeddings
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSIONS = 1536
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "604800"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+EMBEDDING_CACHE_DISK_SIZE = int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", "100000"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+
+# 🔹 Caché compartida entre workers de hypercorn: "memory" (solo en proceso) o "sqlite" (fichero local en WAL)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite" if EMBEDDING_CACHE_PATH else "memory").lower()
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", EMBEDDING_CACHE_PATH or "confubot_cache.sqlite")
+CACHE_SHARED_MAX_ENTRIES = int(os.getenv("CACHE_SHARED_MAX_ENTRIES", str(EMBEDDING_CACHE_DISK_SIZE)))
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "2"))
+CACHE_PRELOAD = os.getenv("CACHE_PRELOAD", "true").lower() == "true"
+
+# 🔹 /api/ask/batch
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+# 🔹 Caché semántica de respuestas
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# 🔹 Construcción del contexto (presupuesto en tokens por intención)
+CONTEXT_TOKEN_BUDGETS = {
+    "resumen": int(os.getenv("CONTEXT_TOKENS_RESUMEN", "6000")),
+    "extraccion": int(os.getenv("CONTEXT_TOKENS_EXTRACCION", "10000")),
+    "consulta_directa": int(os.getenv("CONTEXT_TOKENS_CONSULTA_DIRECTA", "8000")),
+    "procedimiento": int(os.getenv("CONTEXT_TOKENS_PROCEDIMIENTO", "10000")),
+}
+CONTEXT_CHUNK_MAX_TOKENS = int(os.getenv("CONTEXT_CHUNK_MAX_TOKENS", "1000"))
+CONTEXT_MAX_CHUNKS_PER_URL = int(os.getenv("CONTEXT_MAX_CHUNKS_PER_URL", "2"))
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "1.0"))  # 1.0 = sin MMR (solo ranking)
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+
+# 🔹 Respuestas progresivas en Teams (streaming + update_activity)
+TEAMS_STREAMING = os.getenv("TEAMS_STREAMING", "false").lower() == "true"
+TEAMS_STREAM_UPDATE_INTERVAL = float(os.getenv("TEAMS_STREAM_UPDATE_INTERVAL", "1.5"))
+
+# 🔹 Caché de resultados de Azure Search
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "60"))
+
+# 🔹 Control de admisión, rate limiting por usuario y reintentos hacia Azure
+MAX_INFLIGHT_REQUESTS = int(os.getenv("MAX_INFLIGHT_REQUESTS", "64"))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", "128"))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "30"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", "32"))
+USER_RATE_LIMIT_PER_MINUTE = float(os.getenv("USER_RATE_LIMIT_PER_MINUTE", "20"))
+USER_RATE_LIMIT_BURST = float(os.getenv("USER_RATE_LIMIT_BURST", "5"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+UPSTREAM_RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "10"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+# 🔹 Circuit breakers por upstream y peticiones "hedged"
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "true").lower() == "true"
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "50"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "20"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_SLOW_CALL_SECONDS = {
+    "embedding": float(os.getenv("BREAKER_SLOW_EMBEDDING", "2")),
+    "intent": float(os.getenv("BREAKER_SLOW_INTENT", "3")),
+    "chat": float(os.getenv("BREAKER_SLOW_CHAT", "30")),
+    "search_hybrid": float(os.getenv("BREAKER_SLOW_SEARCH", "3")),
+    "search_classic": float(os.getenv("BREAKER_SLOW_SEARCH", "3")),
+    "search_index": float(os.getenv("BREAKER_SLOW_SEARCH_INDEX", "30")),  # subidas de ingest_confluence.py
+}
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_UPSTREAMS = set(os.getenv("HEDGE_UPSTREAMS", "embedding,search_hybrid,search_classic").split(","))
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+# 🔹 Respuestas de Teams en segundo plano: /api/messages responde 201 al encolar
+TEAMS_ASYNC_REPLIES = os.getenv("TEAMS_ASYNC_REPLIES", "false").lower() == "true"
+TEAMS_WORKERS = int(os.getenv("TEAMS_WORKERS", "8"))
+TEAMS_QUEUE_SIZE = int(os.getenv("TEAMS_QUEUE_SIZE", "200"))
+TEAMS_DEDUP_TTL = float(os.getenv("TEAMS_DEDUP_TTL", "600"))
 
 USERNAME = os.getenv("BASIC_AUTH_USER", "admin")
 PASSWORD = os.getenv("BASIC_AUTH_PASS", "password")
@@ -63,11 +313,17 @@ settings = BotFrameworkAdapterSettings(
     oauth_endpoint=f"https://login.microsoftonline.com/{BOT_TENANT_ID}/oauth2/v2.0/token"  # 👈 explícitamente tu tenant
 )
 
-adapter = BotFrameworkAdapter(settings)
+adapter: Optional[BotFrameworkAdapter] = None
+
+
+def get_adapter() -> BotFrameworkAdapter:
+    """Adaptador de Bot Framework, creado con la primera actividad (los scripts que importan app no lo necesitan)."""
+    global adapter
+    if adapter is None:
+        adapter = BotFrameworkAdapter(settings)
+        logging.info("🤖 Bot inicializado con AppId=%s, Tenant=%s", BOT_APP_ID, BOT_TENANT_ID)
+    return adapter
 
-logging.info(
-    f"🤖 Bot inicializado con AppId={BOT_APP_ID}, Tenant={BOT_TENANT_ID}"
-)
 
 # 🔹 Prompts
 PROMPT_BASE = (
@@ -97,6 +353,94 @@ INTENT_PROMPTS = {
     ),
 }
 
+def get_openai_client() -> AsyncAzureOpenAI:
+    """
+    Cliente async de Azure OpenAI, creado en la primera llamada: arrancar un worker no paga su
+    construcción (~0.15 s y unos MB por proceso) hasta que hace falta.
+    """
+    global openai_client
+    if openai_client is None:
+        openai_client = AsyncAzureOpenAI(
+            api_key=AZURE_OPENAI_API_KEY,
+            azure_endpoint=AZURE_OPENAI_ENDPOINT,
+            api_version="2024-02-01",
+            max_retries=0,  # los reintentos los gestiona call_upstream (respetando Retry-After)
+            timeout=OPENAI_TIMEOUT
+        )
+    return openai_client
+
+
+cache_sync_task: Optional[asyncio.Task] = None
+
+
+async def cache_sync_loop():
+    """Trae a memoria las respuestas (e invalidaciones) que guardan los otros workers."""
+    while True:
+        await asyncio.sleep(CACHE_SYNC_INTERVAL)
+        try:
+            await answer_cache.sync()
+        except Exception as e:
+            logging.warning("⚠️ Error sincronizando la caché de respuestas: %r", e)
+
+
+async def warm_up():
+    """
+    Precarga al arrancar (CACHE_PRELOAD): embeddings y respuestas desde la caché compartida y los
+    ficheros del índice local (mmap: las páginas las comparte el sistema entre workers).
+    """
+    start = time.perf_counter()
+    embeddings = await embedding_cache.preload() if CACHE_PRELOAD else 0
+    answers = await answer_cache.preload(load=CACHE_PRELOAD)
+    if CACHE_PRELOAD and local_index_usable():
+        try:
+            await asyncio.to_thread(local_index.load)
+        except LOCAL_INDEX_ERRORS as e:
+            disable_local_index(e)
+    logging.info("🔥 Precarga: %d embeddings, %d respuestas (%.2fs)", embeddings, answers, time.perf_counter() - start)
+
+
+@app.before_serving
+async def startup():
+    """Configura el logging, abre el backend de caché, crea el pool HTTP compartido y precarga las cachés."""
+    global http_session, cache_sync_task
+    configure_logging()
+    open_cache_backend()
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+    )
+    # 🔹 El tokenizador puede descargar su vocabulario: mejor al arrancar que en la primera petición
+    await asyncio.to_thread(get_tokenizer)
+    await warm_up()
+    if answer_cache.shared:
+        cache_sync_task = asyncio.create_task(cache_sync_loop())
+    if TEAMS_ASYNC_REPLIES:
+        teams_queue.start()
+    if SESSION_ENABLED and not SEARCH_RETURN_VECTORS and not LOCAL_INDEX_PATH:
+        if SESSION_EMBED_CHUNKS:
+            logging.info("🧵 Sesiones sin content_vector: se calcula el embedding de los chunks recuperados")
+        else:
+            logging.warning("⚠️ SESSION_ENABLED sin SEARCH_RETURN_VECTORS, índice local ni SESSION_EMBED_CHUNKS: "
+                            "las sesiones no reutilizarán nada")
+    logging.info("🔌 Clientes async inicializados (pool HTTP=%s)", HTTP_POOL_SIZE)
+
+
+@app.after_serving
+async def shutdown():
+    """Cierra las conexiones abiertas de los clientes async."""
+    global openai_client
+    await teams_queue.stop()
+    if cache_sync_task is not None:
+        cache_sync_task.cancel()
+    if http_session is not None:
+        await http_session.close()
+    if openai_client is not None:
+        await openai_client.close()
+        openai_client = None
+    cache_backend.close()
+    logging.info("🔌 Clientes async cerrados")
+
+
 def require_basic_auth(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
@@ -111,6 +455,7 @@ def require_basic_auth(func):
             return Response("Unauthorized", status=401)
         if user != USERNAME or pwd != PASSWORD:
             return Response("Unauthorized", status=401)
+        g.auth_user = user
         return await func(*args, **kwargs)
     return wrapper
 
@@ -123,7 +468,7 @@ def strip_mentions(text: str) -> str:
 async def on_message_activity(turn_context: TurnContext):
     raw_text = turn_context.activity.text or ""
     user_query = strip_mentions(raw_text)
-    logging.info(f"🔍 Query limpia: '{user_query}'")
+    logging.info("🔍 Query limpia: '%s'", user_query)
 
     if not user_query:
         await turn_context.send_activity(
@@ -131,105 +476,1694 @@ async def on_message_activity(turn_context: TurnContext):
         )
         return
 
-    await turn_context.send_activity(Activity(type=ActivityTypes.typing))
+    # 🔹 El canal reenvía la actividad si tardamos en responder: no repetir búsqueda ni LLM
+    activity = turn_context.activity
+    activity_key = f"{activity.conversation.id}:{activity.id}" if activity.id else None
+    if activity_key and seen_activities.seen(activity_key):
+        logging.info("♻️ Actividad %s ya recibida, se ignora", activity.id)
+        metrics.inc("confubot_teams_duplicates_total")
+        return
 
-    intent = detect_intent(user_query)
-    logging.info(f"🔍 Intención detectada: {intent}")
+    # 🔹 Rate limit por usuario de Teams (o por conversación si no viene el remitente)
+    user_id = activity.from_property.id if activity.from_property else activity.conversation.id
+    if not rate_limiter.allow(f"teams:{user_id}"):
+        logging.warning("⛔ Rate limit superado para %s", user_id)
+        await turn_context.send_activity(Activity(type=ActivityTypes.message, text=RATE_LIMITED_MESSAGE))
+        return
 
-    search_results = search_azure(user_query)
-    response_text = generate_response_by_intent(user_query, search_results, intent)
+    # Solo se marca como vista al aceptarla: si se rechaza o falla, el reenvío del canal se atiende
+    seen_activities.add(activity_key)
+    if TEAMS_ASYNC_REPLIES:
+        await teams_queue.submit(turn_context, user_query, activity_key)
+        return
 
-    logging.info(f"🤖 Respuesta generada ({len(response_text)} chars)")
-    await turn_context.send_activity(Activity(type=ActivityTypes.message, text=response_text))
-    logging.info("✅ Respuesta enviada a Teams")
+    await reply_to_query(turn_context, user_query, activity_key)
 
-def generate_embedding(text: str) -> List[float]:
-    """Genera embedding usando Azure OpenAI text-embedding-3-large"""
 
-    cleaned_text = text.strip()
-    if len(cleaned_text) > 8000:
-        cleaned_text = cleaned_text[:8000]
+async def reply_to_query(turn_context: TurnContext, user_query: str, activity_key: Optional[str] = None):
+    """
+    Ejecuta el pipeline y envía la respuesta al turno (el original o uno proactivo).
+    Si la consulta se rechaza o falla, activity_key deja de contar como vista.
+    """
+    session_id = f"teams:{turn_context.activity.conversation.id}"
+    try:
+        async with admission:
+            await turn_context.send_activity(Activity(type=ActivityTypes.typing))
+
+            if TEAMS_STREAMING:
+                response_text = await send_progressive_reply(turn_context, answer_query_stream(user_query, session_id))
+                logging.info("🤖 Respuesta generada (%d chars)", len(response_text))
+                logging.info("✅ Respuesta enviada a Teams")
+                return
+
+            response_text = await answer_query(user_query, session_id=session_id)
+
+        logging.info("🤖 Respuesta generada (%d chars)", len(response_text))
+        await turn_context.send_activity(Activity(type=ActivityTypes.message, text=response_text))
+        logging.info("✅ Respuesta enviada a Teams")
+    except (Overloaded, UpstreamThrottled) as e:
+        seen_activities.discard(activity_key)
+        logging.warning("⛔ Consulta rechazada por saturación: %r", e)
+        await turn_context.send_activity(Activity(type=ActivityTypes.message, text=BUSY_MESSAGE))
+    except BaseException:
+        seen_activities.discard(activity_key)
+        raise
+
+
+async def send_progressive_reply(turn_context: TurnContext, deltas) -> str:
+    """
+    Envía el primer fragmento como mensaje nuevo y lo va actualizando (update_activity)
+    como mucho cada TEAMS_STREAM_UPDATE_INTERVAL segundos, para no chocar con el rate limit de Teams.
+    """
+    text = ""
+    sent_id = None
+    shown = ""
+    last_update = 0.0
+    async for delta in deltas:
+        text += delta
+        now = time.monotonic()
+        if sent_id is None:
+            if text.strip():
+                sent = await turn_context.send_activity(Activity(type=ActivityTypes.message, text=text))
+                sent_id, shown, last_update = sent.id if sent else None, text, now
+        elif now - last_update >= TEAMS_STREAM_UPDATE_INTERVAL:
+            await turn_context.update_activity(Activity(id=sent_id, type=ActivityTypes.message, text=text))
+            shown, last_update = text, now
+
+    if sent_id is None:
+        if text != shown:
+            await turn_context.send_activity(Activity(type=ActivityTypes.message, text=text))
+    elif text != shown:
+        await turn_context.update_activity(Activity(id=sent_id, type=ActivityTypes.message, text=text))
+    return text
+
+# 🔹 Métricas (formato Prometheus) y tiempos por etapa
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (0, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Contadores e histogramas en memoria del proceso, expuestos en /metrics en formato Prometheus.
+    Las etiquetas son tuplas de pares (nombre, valor). Registrar un valor cuesta un par de
+    operaciones de diccionario, así que se puede usar en el hot path sin coste apreciable.
+    """
 
-    if not cleaned_text:
-        return [0.0] * 1536
+    def __init__(self):
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self._help: Dict[str, str] = {}
+        self._collectors: List[Callable[[], Dict[Tuple[str, Tuple], float]]] = []
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, labels: Tuple = (), value: float = 1.0):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, labels: Tuple = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def register_collector(self, collector: Callable[[], Dict[Tuple[str, Tuple], float]]):
+        """Gauges calculados al hacer scrape (tamaño de cachés, colas...)."""
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _labels(labels: Tuple, extra: Tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def _header(self, lines: List[str], seen: set, name: str, kind: str):
+        if name not in seen:
+            seen.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    def render(self) -> str:
+        lines: List[str] = []
+        seen: set = set()
+        for (name, labels), value in sorted(self._counters.items()):
+            self._header(lines, seen, name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+            self._header(lines, seen, name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        for collector in self._collectors:
+            for (name, labels), value in sorted(collector().items()):
+                self._header(lines, seen, name, "gauge")
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("confubot_stage_seconds", "Duración de cada etapa del pipeline")
+metrics.describe("confubot_request_seconds", "Duración total de las peticiones por endpoint")
+metrics.describe("confubot_upstream_errors_total", "Errores de llamadas a Azure por upstream")
+metrics.describe("confubot_fallbacks_total", "Fallbacks aplicados (búsqueda keyword, intent local...)")
+metrics.describe("confubot_low_relevance_total", "Respuestas sustituidas por el mensaje de baja relevancia")
+metrics.describe("confubot_openai_tokens_total", "Tokens consumidos en Azure OpenAI por deployment y tipo")
+metrics.describe("confubot_intent_decisions_total", "Intenciones resueltas por método (keywords, centroid, llm...)")
+metrics.describe("confubot_context_tokens_total", "Tokens de contexto enviados al modelo y ahorrados por build_context")
+metrics.describe("confubot_context_tokens_saved", "Tokens ahorrados por build_context en cada generación")
+
+# Tiempos de la petición en curso (solo si se han pedido en /api/ask)
+request_timings: "contextvars.ContextVar[Optional[Dict[str, float]]]" = contextvars.ContextVar(
+    "request_timings", default=None
+)
+# Tokens de la petición en curso: "usage" de /api/ask y registro final de la petición
+request_usage: "contextvars.ContextVar[Optional[Dict[str, int]]]" = contextvars.ContextVar(
+    "request_usage", default=None
+)
+
+
+def add_usage(**tokens: int):
+    usage = request_usage.get()
+    if usage is not None:
+        for name, value in tokens.items():
+            usage[name] = usage.get(name, 0) + value
+
+
+@contextmanager
+def stage(name: str):
+    """Mide una etapa del pipeline: histograma global y tiempos de la petición (log y, si se piden, respuesta)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("confubot_stage_seconds", elapsed, (("stage", name),))
+        timings = request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def record_usage(deployment: str, usage):
+    """Acumula los tokens de prompt/completion que devuelve Azure OpenAI."""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    metrics.inc("confubot_openai_tokens_total", (("deployment", deployment), ("kind", "prompt")), prompt_tokens)
+    metrics.inc("confubot_openai_tokens_total", (("deployment", deployment), ("kind", "completion")), completion_tokens)
+    add_usage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+def record_context_usage(stats: Dict):
+    """Tokens de contexto enviados y ahorrados (estadísticas de build_context): métricas y usage de la petición."""
+    metrics.inc("confubot_context_tokens_total", (("kind", "sent"),), stats["tokens"])
+    metrics.inc("confubot_context_tokens_total", (("kind", "saved"),), stats["tokens_saved"])
+    metrics.observe("confubot_context_tokens_saved", stats["tokens_saved"], buckets=TOKEN_BUCKETS)
+    add_usage(context_tokens=stats["tokens"], context_tokens_saved=stats["tokens_saved"])
+
+
+# 🔹 Control de admisión y reintentos
+BUSY_MESSAGE = (
+    "Ahora mismo hay muchas consultas en curso y no puedo atender la tuya. "
+    "Inténtalo de nuevo en unos segundos."
+)
+RATE_LIMITED_MESSAGE = (
+    "Has enviado muchas preguntas seguidas. Espera un momento antes de enviar la siguiente."
+)
+
+
+class Overloaded(Exception):
+    """La cola de peticiones está llena (o se ha esperado demasiado en ella)."""
+
+
+class UpstreamThrottled(Exception):
+    """Azure sigue devolviendo 429 tras agotar los reintentos."""
 
+    def __init__(self, upstream: str, retry_after: Optional[float] = None):
+        super().__init__(f"{upstream} throttled")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitOpen(UpstreamThrottled):
+    """El circuit breaker del upstream está abierto: ni se intenta la llamada."""
+
+    def __str__(self):
+        return f"{self.upstream} circuit open"
+
+
+class AdmissionController:
+    """
+    Limita las peticiones que ejecutan el pipeline a la vez (max_inflight) con una cola acotada
+    detrás (max_queued). Si la cola está llena se rechaza al momento en vez de acumular latencia.
+    """
+
+    def __init__(self, max_inflight: int, max_queued: int, queue_timeout: float):
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_inflight)
+        self.inflight = 0
+        self.queued = 0
+
+    def full(self) -> bool:
+        return self._semaphore.locked() and self.queued >= self.max_queued
+
+    async def __aenter__(self):
+        if self.full():
+            metrics.inc("confubot_rejected_total", (("reason", "queue_full"),))
+            raise Overloaded()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("confubot_rejected_total", (("reason", "queue_timeout"),))
+            raise Overloaded()
+        finally:
+            self.queued -= 1
+        self.inflight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.inflight -= 1
+        self._semaphore.release()
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket por clave (usuario de Teams / usuario de Basic Auth). Una petición con coste > 1
+    (un lote de preguntas) pasa si queda al menos un token y deja el bucket en negativo: el
+    usuario no vuelve a pasar hasta haberla pagado al ritmo normal.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: float, max_keys: int = 10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def allow(self, key: str, cost: float = 1.0) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1.0
+        self._buckets[key] = (tokens - cost if allowed else tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        if not allowed:
+            metrics.inc("confubot_rejected_total", (("reason", "rate_limited"),))
+        return allowed
+
+
+admission = AdmissionController(MAX_INFLIGHT_REQUESTS, MAX_QUEUED_REQUESTS, QUEUE_TIMEOUT)
+rate_limiter = TokenBucketLimiter(USER_RATE_LIMIT_PER_MINUTE, USER_RATE_LIMIT_BURST)
+
+# Cada upstream comparte el semáforo de su servicio de Azure
+UPSTREAM_POOLS = {
+    "embedding": "openai", "intent": "openai", "chat": "openai",
+    "search_hybrid": "search", "search_classic": "search", "search_index": "search",
+}
+upstream_semaphores = {
+    "openai": asyncio.Semaphore(OPENAI_MAX_CONCURRENCY),
+    "search": asyncio.Semaphore(SEARCH_MAX_CONCURRENCY),
+}
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Segundos indicados por Azure en Retry-After / retry-after-ms, si los hay."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
     try:
-        result = openai_client.embeddings.create(
-            model="text-embedding-3-large",
-            input=cleaned_text,
-            dimensions=1536
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def _is_throttled(error: Exception) -> bool:
+    return isinstance(error, openai.RateLimitError) or getattr(error, "status", None) == 429
+
+
+def _is_retryable(error: Exception) -> bool:
+    if _is_throttled(error):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    if isinstance(error, SearchHTTPError):
+        return error.status >= 500
+    return isinstance(error, (openai.APIConnectionError, aiohttp.ClientConnectionError))
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de un upstream sobre las últimas BREAKER_WINDOW llamadas.
+    Se abre si la proporción de errores (5xx, 429, timeouts, conexión) o de llamadas lentas
+    supera el umbral; abierto rechaza al instante durante BREAKER_OPEN_SECONDS y después deja
+    pasar una única llamada de prueba (half-open) que lo cierra o lo vuelve a abrir.
+    Guarda también las latencias recientes para calcular el retardo de los hedges.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, name: str, slow_call: float):
+        self.name = name
+        self.slow_call = slow_call
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)  # (fallo, lenta)
+        self._latencies = deque(maxlen=200)
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        metrics.inc("confubot_circuit_transitions_total", (("upstream", self.name), ("state", state)))
+        log = logging.warning if state == self.OPEN else logging.info
+        log("🔌 Circuit breaker de %s: %s", self.name, state)
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + BREAKER_OPEN_SECONDS - time.monotonic())
+
+    def available(self) -> bool:
+        """Si una llamada tendría opción de pasar (sin consumir la llamada de prueba)."""
+        return self.state != self.OPEN or self.retry_after() == 0
+
+    def allow(self) -> bool:
+        if not BREAKER_ENABLED:
+            return True
+        if self.state == self.OPEN and self.retry_after() == 0:
+            self._transition(self.HALF_OPEN)
+        # una prueba que nunca llegó a registrarse (cancelada en la cola) no bloquea para siempre
+        probe_stale = time.monotonic() - self._probe_started > BREAKER_OPEN_SECONDS
+        if self.state == self.CLOSED or (self.state == self.HALF_OPEN and (not self._probing or probe_stale)):
+            self._probing = self.state == self.HALF_OPEN
+            self._probe_started = time.monotonic()
+            return True
+        metrics.inc("confubot_circuit_rejected_total", (("upstream", self.name),))
+        return False
+
+    def record(self, failed: bool, latency: float):
+        slow = latency > self.slow_call
+        if not failed:
+            self._latencies.append(latency)
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            if failed or slow:
+                self._open()
+            else:
+                self._outcomes.clear()
+                self._transition(self.CLOSED)
+            return
+        self._outcomes.append((failed, slow))
+        if len(self._outcomes) >= BREAKER_MIN_CALLS:
+            failures = sum(f for f, _ in self._outcomes) / len(self._outcomes)
+            slow_calls = sum(s for _, s in self._outcomes) / len(self._outcomes)
+            if failures >= BREAKER_ERROR_RATE or slow_calls >= BREAKER_SLOW_RATE:
+                self._open()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._transition(self.OPEN)
+
+    async def call(self, fn):
+        start = time.perf_counter()
+        try:
+            result = await fn()
+        except Exception as e:
+            self.record(_is_retryable(e) or isinstance(e, asyncio.TimeoutError), time.perf_counter() - start)
+            raise
+        except BaseException:
+            self._probing = False  # cancelada (p.ej. el hedge perdedor): no cuenta
+            raise
+        self.record(False, time.perf_counter() - start)
+        return result
+
+    def hedge_delay(self) -> Optional[float]:
+        """Retardo del hedge: cuantil HEDGE_QUANTILE de las latencias recientes (None sin datos)."""
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, float(np.quantile(np.fromiter(self._latencies, float), HEDGE_QUANTILE)))
+
+
+breakers = {name: CircuitBreaker(name, slow) for name, slow in BREAKER_SLOW_CALL_SECONDS.items()}
+
+
+async def hedged(upstream: str, leg, breaker: CircuitBreaker):
+    """
+    Lanza leg(); si no ha terminado tras el retardo del hedge, lanza una segunda copia y se
+    queda con la primera que responda bien (la otra se cancela). Solo para lecturas idempotentes.
+    """
+    delay = breaker.hedge_delay()
+    if delay is None:
+        return await leg()
+    tasks = {asyncio.ensure_future(leg()): "primary"}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or breaker.state != CircuitBreaker.CLOSED:
+            return await next(iter(tasks))
+        metrics.inc("confubot_hedges_total", (("upstream", upstream),))
+        tasks[asyncio.ensure_future(leg())] = "hedge"
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    metrics.inc("confubot_hedge_wins_total", (("upstream", upstream), ("winner", tasks[task])))
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call_upstream(upstream: str, call):
+    """
+    Ejecuta call() contra Azure limitando la concurrencia por servicio y reintentando 429/5xx
+    con backoff exponencial con jitter. Si Azure indica Retry-After se respeta; si pide esperar
+    más de UPSTREAM_RETRY_MAX_DELAY o se agotan los reintentos de un 429, lanza UpstreamThrottled.
+    Con el circuit breaker abierto lanza CircuitOpen sin llamar; con HEDGE_ENABLED las lecturas
+    de HEDGE_UPSTREAMS se duplican si tardan más que su p95 reciente.
+    """
+    semaphore = upstream_semaphores[UPSTREAM_POOLS[upstream]]
+    breaker = breakers[upstream]
+
+    async def leg():
+        async with semaphore:
+            return await breaker.call(call)
+
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        if not breaker.allow():
+            raise CircuitOpen(upstream, breaker.retry_after())
+        try:
+            if HEDGE_ENABLED and upstream in HEDGE_UPSTREAMS:
+                return await hedged(upstream, leg, breaker)
+            return await leg()
+        except Exception as e:
+            if not _is_retryable(e):
+                raise
+            retry_after = _retry_after(e)
+            if _is_throttled(e):
+                metrics.inc("confubot_upstream_throttled_total", (("upstream", upstream),))
+            last_attempt = attempt == UPSTREAM_MAX_RETRIES
+            too_long = retry_after is not None and retry_after > UPSTREAM_RETRY_MAX_DELAY
+            if last_attempt or too_long:
+                if _is_throttled(e):
+                    raise UpstreamThrottled(upstream, retry_after) from e
+                raise
+            delay = retry_after if retry_after is not None else random.uniform(
+                0, min(UPSTREAM_RETRY_MAX_DELAY, UPSTREAM_RETRY_BASE_DELAY * 2 ** attempt)
+            )
+            metrics.inc("confubot_upstream_retries_total", (("upstream", upstream),))
+            logging.warning("🔁 Reintento %s/%s de %s en %.2fs: %s", attempt + 1, UPSTREAM_MAX_RETRIES, upstream, delay, e)
+            await asyncio.sleep(delay)
+
+
+def _admission_metrics() -> Dict[Tuple[str, Tuple], float]:
+    gauges = {
+        ("confubot_requests_inflight", ()): admission.inflight,
+        ("confubot_requests_queued", ()): admission.queued,
+    }
+    for pool, semaphore in upstream_semaphores.items():
+        limit = OPENAI_MAX_CONCURRENCY if pool == "openai" else SEARCH_MAX_CONCURRENCY
+        gauges[("confubot_upstream_inflight", (("pool", pool),))] = limit - semaphore._value
+    states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+    for name, breaker in breakers.items():
+        gauges[("confubot_circuit_state", (("upstream", name),))] = states[breaker.state]
+    return gauges
+
+
+metrics.describe("confubot_rejected_total", "Peticiones rechazadas (cola llena, timeout en cola, rate limit)")
+metrics.describe("confubot_upstream_retries_total", "Reintentos de llamadas a Azure")
+metrics.describe("confubot_upstream_throttled_total", "Respuestas 429 de Azure")
+metrics.describe("confubot_circuit_transitions_total", "Cambios de estado de los circuit breakers")
+metrics.describe("confubot_circuit_rejected_total", "Llamadas no realizadas por circuit breaker abierto")
+metrics.describe("confubot_hedges_total", "Peticiones hedged lanzadas")
+metrics.describe("confubot_hedge_wins_total", "Qué copia de la petición hedged respondió primero")
+metrics.register_collector(_admission_metrics)
+metrics.register_collector(lambda: {("confubot_log_records_dropped", ()): log_handler.dropped if log_handler else 0})
+
+
+# 🔹 Cola de respuestas de Teams (TEAMS_ASYNC_REPLIES)
+class RecentIds:
+    """Conjunto de ids vistos en los últimos ttl segundos (acotado, evicción LRU)."""
+
+    def __init__(self, ttl: float, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+
+    def seen(self, key: str) -> bool:
+        """True si el id se ha registrado y no ha caducado."""
+        expires = self._seen.get(key)
+        return expires is not None and expires > time.monotonic()
+
+    def add(self, key: Optional[str]) -> bool:
+        """Registra el id; devuelve False si ya se había visto y no ha caducado."""
+        if key is None:
+            return True
+        if self.seen(key):
+            return False
+        self._seen[key] = time.monotonic() + self.ttl
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return True
+
+    def discard(self, key: Optional[str]):
+        """Olvida el id (la actividad no llegó a atenderse): un reenvío se procesará."""
+        if key is not None:
+            self._seen.pop(key, None)
+
+
+class TeamsReplyQueue:
+    """
+    Cola acotada de consultas de Teams atendida por un pool de workers.
+    /api/messages solo autentica la actividad, guarda la referencia de la conversación y
+    encola; los workers responden con mensajería proactiva (continue_conversation).
+    """
+
+    def __init__(self, workers: int, max_size: int):
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._tasks: List[asyncio.Task] = []
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logging.info("📬 Cola de Teams iniciada (%s workers, máx. %s en espera)", self.workers, self._queue.maxsize)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._tasks and self.depth():
+            logging.warning("⚠️ %s consultas de Teams sin responder al parar", self.depth())
+        self._tasks = []
+
+    async def submit(self, turn_context: TurnContext, user_query: str, activity_key: Optional[str] = None):
+        reference = TurnContext.get_conversation_reference(turn_context.activity)
+        identity = turn_context.turn_state.get(BotAdapter.BOT_IDENTITY_KEY)
+        try:
+            self._queue.put_nowait(
+                (reference, identity, user_query, activity_key, request_id_var.get(), time.perf_counter())
+            )
+        except asyncio.QueueFull:
+            seen_activities.discard(activity_key)
+            metrics.inc("confubot_rejected_total", (("reason", "teams_queue_full"),))
+            logging.warning("⛔ Cola de Teams llena, consulta rechazada")
+            await turn_context.send_activity(Activity(type=ActivityTypes.message, text=BUSY_MESSAGE))
+            return
+        logging.info("📬 Consulta encolada (%d en espera)", self.depth())
+
+    async def _worker(self, number: int):
+        while True:
+            reference, identity, user_query, activity_key, request_id, enqueued_at = await self._queue.get()
+            started = time.perf_counter()
+            metrics.observe("confubot_stage_seconds", started - enqueued_at, (("stage", "teams_queue"),))
+            request_id_var.set(request_id)
+            timings = {"teams_queue": started - enqueued_at}
+            request_timings.set(timings)
+            usage = {}
+            request_usage.set(usage)
+
+            async def logic(turn_context: TurnContext):
+                try:
+                    await reply_to_query(turn_context, user_query, activity_key)
+                except Exception as e:
+                    logging.error("❌ Error procesando mensaje del usuario: %s", e, exc_info=True)
+                    await turn_context.send_activity(
+                        Activity(type=ActivityTypes.message, text="Se ha producido un error procesando tu mensaje.")
+                    )
+
+            try:
+                await get_adapter().continue_conversation(
+                    reference, logic, bot_id=BOT_APP_ID or None, claims_identity=identity
+                )
+            except Exception as e:
+                seen_activities.discard(activity_key)
+                logging.error("❌ Worker %s no pudo responder en Teams: %s", number, e, exc_info=True)
+            finally:
+                self._queue.task_done()
+                logging.info(
+                    "✅ Respuesta de Teams en segundo plano",
+                    extra={"duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                           "timings_ms": {name: round(seconds * 1000, 1) for name, seconds in timings.items()},
+                           "usage": usage},
+                )
+
+
+seen_activities = RecentIds(TEAMS_DEDUP_TTL)
+teams_queue = TeamsReplyQueue(TEAMS_WORKERS, TEAMS_QUEUE_SIZE)
+
+metrics.describe("confubot_teams_duplicates_total", "Actividades de Teams reenviadas e ignoradas")
+metrics.describe("confubot_batch_questions_total", "Preguntas recibidas en /api/ask/batch")
+metrics.register_collector(lambda: {("confubot_teams_queue_depth", ()): teams_queue.depth()})
+
+
+def normalize_query(text: str) -> str:
+    """Normaliza una query para usarla como clave de caché (mayúsculas, signos, espacios)."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = re.sub(r"[¿?¡!.,;:\"']+", " ", text)
+    return " ".join(text.split())
+
+
+class CacheBackend:
+    """
+    Almacén clave → bytes por namespace, con TTL, en el que se apoyan las cachés de embeddings,
+    búsquedas y respuestas. Cada caché mantiene su nivel en memoria y, si el backend es compartido
+    (shared), lo usa como segundo nivel común a todos los workers. Cada escritura recibe un seq
+    creciente para poder leer solo lo escrito desde la última sincronización.
+    """
+
+    shared = False
+
+    async def get(self, namespace: str, key: str) -> Optional[Tuple[bytes, float]]:
+        """(valor, caducidad) o None si no está o ha caducado."""
+        raise NotImplementedError
+
+    async def set(self, namespace: str, key: str, value: bytes, ttl: float):
+        raise NotImplementedError
+
+    async def delete(self, namespace: str, keys: List[str]):
+        raise NotImplementedError
+
+    async def recent(self, namespace: str, limit: int) -> List[Tuple[int, str, bytes, float]]:
+        """Entradas vigentes (seq, clave, valor, caducidad), de la más reciente a la más antigua."""
+        raise NotImplementedError
+
+    async def changes(self, namespace: str, after: int, limit: int = 1000) -> List[Tuple[int, str, bytes, float]]:
+        """Entradas vigentes escritas después de seq=after, en orden de escritura."""
+        raise NotImplementedError
+
+    async def clear(self, namespace: str):
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Implementación en proceso: cada worker tiene la suya, así que las cachés no la consultan."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._seq = 0
+        self._data: Dict[str, "OrderedDict[str, Tuple[int, bytes, float]]"] = {}
+
+    def _live(self, namespace: str) -> List[Tuple[int, str, bytes, float]]:
+        now = time.time()
+        return [
+            (seq, key, value, expires)
+            for key, (seq, value, expires) in self._data.get(namespace, {}).items()
+            if expires > now
+        ]
+
+    async def get(self, namespace: str, key: str) -> Optional[Tuple[bytes, float]]:
+        entry = self._data.get(namespace, {}).get(key)
+        if entry is None or entry[2] <= time.time():
+            return None
+        return entry[1], entry[2]
+
+    async def set(self, namespace: str, key: str, value: bytes, ttl: float):
+        entries = self._data.setdefault(namespace, OrderedDict())
+        self._seq += 1
+        entries.pop(key, None)
+        entries[key] = (self._seq, value, time.time() + ttl)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    async def delete(self, namespace: str, keys: List[str]):
+        entries = self._data.get(namespace, {})
+        for key in keys:
+            entries.pop(key, None)
+
+    async def recent(self, namespace: str, limit: int) -> List[Tuple[int, str, bytes, float]]:
+        return self._live(namespace)[::-1][:limit]
+
+    async def changes(self, namespace: str, after: int, limit: int = 1000) -> List[Tuple[int, str, bytes, float]]:
+        return [entry for entry in self._live(namespace) if entry[0] > after][:limit]
+
+    async def clear(self, namespace: str):
+        self._data.pop(namespace, None)
+
+    def stats(self) -> Dict:
+        return {"entries": sum(len(entries) for entries in self._data.values())}
+
+
+class SqliteCacheBackend(CacheBackend):
+    """
+    Fichero SQLite en modo WAL compartido por los workers de una misma máquina (disco local del
+    App Service): las lecturas no bloquean a quien escribe y sobrevive a los reinicios.
+    Cada proceso abre su conexión; las consultas van a un hilo para no bloquear el event loop.
+    Un error de SQLite se trata como un fallo de caché, nunca como un error de la petición.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.errors = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, key TEXT NOT NULL, "
+            "expires REAL NOT NULL, value BLOB NOT NULL, UNIQUE (namespace, key))"
         )
-        return result.data[0].embedding
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_namespace_seq ON cache(namespace, seq)")
+
+    def _query(self, sql: str, params: Tuple) -> List[Tuple]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _set(self, namespace: str, key: str, value: bytes, expires: float):
+        with self._lock:
+            # 🔹 REPLACE borra la fila anterior e inserta otra: la entrada recibe un seq nuevo
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, expires, value) VALUES (?, ?, ?, ?)",
+                (namespace, key, expires, value),
+            )
+            self._writes += 1
+            # 🔹 Poda periódica: caducados y exceso sobre el tamaño máximo por namespace
+            if self._writes % 500 == 0:
+                self._db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+                self._db.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND seq <= ("
+                    "SELECT seq FROM cache WHERE namespace = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                    (namespace, namespace, self.max_entries),
+                )
+
+    async def _run(self, default, func, *args):
+        try:
+            return await asyncio.to_thread(func, *args)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logging.warning("⚠️ Error en la caché compartida %s: %r", self.path, e)
+            return default
+
+    async def get(self, namespace: str, key: str) -> Optional[Tuple[bytes, float]]:
+        rows = await self._run([], self._query,
+                               "SELECT value, expires FROM cache WHERE namespace = ? AND key = ? AND expires > ?",
+                               (namespace, key, time.time()))
+        return (rows[0][0], rows[0][1]) if rows else None
+
+    async def set(self, namespace: str, key: str, value: bytes, ttl: float):
+        await self._run(None, self._set, namespace, key, value, time.time() + ttl)
+
+    async def delete(self, namespace: str, keys: List[str]):
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            await self._run(None, self._query,
+                            f"DELETE FROM cache WHERE namespace = ? AND key IN ({','.join('?' * len(batch))})",
+                            (namespace, *batch))
+
+    async def recent(self, namespace: str, limit: int) -> List[Tuple[int, str, bytes, float]]:
+        return await self._run([], self._query,
+                               "SELECT seq, key, value, expires FROM cache WHERE namespace = ? AND expires > ? "
+                               "ORDER BY seq DESC LIMIT ?",
+                               (namespace, time.time(), limit))
+
+    async def changes(self, namespace: str, after: int, limit: int = 1000) -> List[Tuple[int, str, bytes, float]]:
+        return await self._run([], self._query,
+                               "SELECT seq, key, value, expires FROM cache WHERE namespace = ? AND seq > ? "
+                               "AND expires > ? ORDER BY seq LIMIT ?",
+                               (namespace, after, time.time(), limit))
+
+    async def clear(self, namespace: str):
+        await self._run(None, self._query, "DELETE FROM cache WHERE namespace = ?", (namespace,))
+
+    def stats(self) -> Dict:
+        return {"errors": self.errors}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def make_cache_backend() -> CacheBackend:
+    if CACHE_BACKEND == "sqlite":
+        try:
+            backend = SqliteCacheBackend(CACHE_SQLITE_PATH, CACHE_SHARED_MAX_ENTRIES)
+            logging.info("🗄️ Caché compartida entre workers en SQLite: %s", CACHE_SQLITE_PATH)
+            return backend
+        except sqlite3.Error as e:
+            logging.error("❌ No se pudo abrir la caché compartida %s: %s; solo caché en memoria", CACHE_SQLITE_PATH, e)
+    elif CACHE_BACKEND != "memory":
+        logging.warning("⚠️ CACHE_BACKEND desconocido '%s', solo caché en memoria", CACHE_BACKEND)
+    return MemoryCacheBackend(CACHE_SHARED_MAX_ENTRIES)
+
+
+# 🔹 El backend de CACHE_BACKEND se abre en startup() (open_cache_backend), no al importar app.py:
+# hasta entonces las cachés solo usan su nivel en memoria
+cache_backend: CacheBackend = MemoryCacheBackend(CACHE_SHARED_MAX_ENTRIES)
+cache_backend_opened = False
+
+
+class EmbeddingCache:
+    """
+    Caché de embeddings por texto normalizado.
+    - Nivel 1: LRU en memoria acotado por tamaño.
+    - Nivel 2 (opcional): el backend compartido (CACHE_BACKEND=sqlite), común a todos los
+      workers y persistente entre reinicios del App Service.
+    Los vectores se guardan como float32 (6 KB por embedding de 1536 dims).
+    """
+
+    namespace = "embedding"
+
+    def __init__(self, max_size: int, ttl: float, backend: CacheBackend):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._memory: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+        self.hits_memory = 0
+        self.hits_shared = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(text: str) -> str:
+        raw = f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}:{normalize_query(text)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, created: float, vector: np.ndarray):
+        self._memory[key] = (created, vector)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    async def get(self, text: str) -> Optional[np.ndarray]:
+        key = self._key(text)
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None and now - entry[0] <= self.ttl:
+            self._memory.move_to_end(key)
+            self.hits_memory += 1
+            return entry[1]
+        if entry is not None:
+            del self._memory[key]
+
+        if self.backend.shared:
+            shared = await self.backend.get(self.namespace, key)
+            if shared is not None:
+                vector = np.frombuffer(shared[0], dtype=np.float32)
+                self._remember(key, shared[1] - self.ttl, vector)
+                self.hits_shared += 1
+                return vector
+
+        self.misses += 1
+        return None
+
+    async def put(self, text: str, vector: np.ndarray):
+        key = self._key(text)
+        self._remember(key, time.time(), vector)
+        if self.backend.shared:
+            await self.backend.set(self.namespace, key, vector.tobytes(), self.ttl)
+
+    async def preload(self) -> int:
+        """Carga en memoria los embeddings más recientes del backend compartido."""
+        if not self.backend.shared:
+            return 0
+        entries = await self.backend.recent(self.namespace, self.max_size)
+        for _, key, value, expires in reversed(entries):
+            self._remember(key, expires - self.ttl, np.frombuffer(value, dtype=np.float32))
+        return len(entries)
+
+    def stats(self) -> Dict:
+        lookups = self.hits_memory + self.hits_shared + self.misses
+        return {
+            "size": len(self._memory),
+            "hits_memory": self.hits_memory,
+            "hits_shared": self.hits_shared,
+            "misses": self.misses,
+            "hit_rate": (self.hits_memory + self.hits_shared) / lookups if lookups else 0.0,
+        }
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL, cache_backend)
+
+
+def zero_embedding() -> np.ndarray:
+    return np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+
+
+def clean_embedding_input(text: str) -> str:
+    return text.strip()[:8000]
+
+
+async def generate_embedding(text: str) -> np.ndarray:
+    """Genera embedding usando Azure OpenAI text-embedding-3-large (con caché)"""
+
+    cleaned_text = clean_embedding_input(text)
+    if not cleaned_text:
+        return zero_embedding()
+
+    cached = await embedding_cache.get(cleaned_text)
+    if cached is not None:
+        return cached
+
+    try:
+        with stage("embedding"):
+            result = await call_upstream("embedding", lambda: get_openai_client().embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=cleaned_text,
+                dimensions=EMBEDDING_DIMENSIONS
+            ))
     except Exception as e:
-        logging.error(f"Error generando embedding: {e}")
-        return [0.0] * 1536
+        logging.error("Error generando embedding: %s", e)
+        metrics.inc("confubot_upstream_errors_total", (("upstream", "embedding"),))
+        return zero_embedding()
+
+    record_usage(EMBEDDING_MODEL, result.usage)
+    vector = np.asarray(result.data[0].embedding, dtype=np.float32)
+    await embedding_cache.put(cleaned_text, vector)
+    return vector
+
+
+async def generate_embeddings(texts: List[str]) -> List[np.ndarray]:
+    """
+    Versión por lotes de generate_embedding: consulta la caché y pide los que faltan en
+    llamadas de hasta EMBEDDING_BATCH_SIZE entradas. Un lote fallido devuelve vectores cero
+    para sus textos (que harán fallback a búsqueda keyword).
+    """
+    cleaned = [clean_embedding_input(text) for text in texts]
+    vectors: List[Optional[np.ndarray]] = [None] * len(cleaned)
+    missing: Dict[str, List[int]] = {}
+    for i, text in enumerate(cleaned):
+        if not text:
+            vectors[i] = zero_embedding()
+            continue
+        cached = await embedding_cache.get(text)
+        if cached is not None:
+            vectors[i] = cached
+        else:
+            missing.setdefault(text, []).append(i)
+
+    pending = list(missing)
+    for start in range(0, len(pending), EMBEDDING_BATCH_SIZE):
+        batch = pending[start:start + EMBEDDING_BATCH_SIZE]
+        try:
+            with stage("embedding_batch"):
+                result = await call_upstream("embedding", lambda: get_openai_client().embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=batch,
+                    dimensions=EMBEDDING_DIMENSIONS
+                ))
+        except Exception as e:
+            logging.error("Error generando embeddings en lote (%s textos): %s", len(batch), e)
+            metrics.inc("confubot_upstream_errors_total", (("upstream", "embedding"),))
+            for text in batch:
+                for i in missing[text]:
+                    vectors[i] = zero_embedding()
+            continue
+        record_usage(EMBEDDING_MODEL, result.usage)
+        for item in result.data:
+            text = batch[item.index]
+            vector = np.asarray(item.embedding, dtype=np.float32)
+            await embedding_cache.put(text, vector)
+            for i in missing[text]:
+                vectors[i] = vector
+    return vectors
+
+class SemanticAnswerCache:
+    """
+    Caché semántica de respuestas finales.
+    Guarda (embedding de la query, intención, respuesta) en una matriz NumPy normalizada;
+    una query nueva reutiliza la respuesta si la similitud coseno supera el umbral
+    y la intención coincide. Evicción por TTL y LRU.
+    Con un backend compartido cada respuesta nueva (y cada invalidación) se publica en él y
+    sync() incorpora a la matriz local lo que han publicado los otros workers.
+    """
+
+    namespace = "answer"
+    invalidations_namespace = "answer_invalidations"
+
+    def __init__(self, capacity: int, ttl: float, threshold: float, backend: CacheBackend,
+                 dimensions: int = EMBEDDING_DIMENSIONS):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.threshold = threshold
+        self.backend = backend
+        # 🔹 Las filas se reservan según se llenan (duplicando hasta capacity), no al importar
+        self._matrix = np.zeros((0, dimensions), dtype=np.float32)
+        self._expires = np.zeros(0, dtype=np.float64)
+        self._last_used = np.zeros(0, dtype=np.float64)
+        self._intents: List[Optional[str]] = []
+        self._answers: List[Optional[str]] = []
+        self._keys: List[Optional[str]] = []
+        self._slots_by_key: Dict[str, int] = {}
+        self._published_invalidations: set = set()
+        self._seq = 0
+        self._invalidation_seq = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.synced = 0
+
+    @property
+    def shared(self) -> bool:
+        return self.backend.shared and self.capacity > 0
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> Optional[np.ndarray]:
+        norm = float(np.linalg.norm(embedding))
+        if norm == 0.0:
+            return None
+        return (embedding / norm).astype(np.float32, copy=False)
+
+    def _similarities(self, vector: np.ndarray) -> np.ndarray:
+        sims = self._matrix @ vector
+        sims[self._expires <= time.time()] = -1.0
+        return sims
+
+    def _candidates(self, vector: np.ndarray) -> Dict[str, int]:
+        sims = self._similarities(vector)
+        candidates: Dict[str, int] = {}
+        for slot in np.argsort(-sims):
+            if sims[slot] < self.threshold:
+                break
+            candidates.setdefault(self._intents[slot], int(slot))
+        return candidates
+
+    def lookup(self, embedding: np.ndarray) -> Dict[str, int]:
+        """Candidatos por encima del umbral: {intención: slot} con el más similar por intención."""
+        vector = self._normalize(embedding)
+        if vector is None or self.capacity == 0:
+            return {}
+        return self._candidates(vector)
+
+    def resolve(self, candidates: Dict[str, int], intent: Optional[str]) -> Optional[str]:
+        """Devuelve la respuesta cacheada para la intención (y contabiliza hit/miss)."""
+        slot = candidates.get(intent)
+        if slot is None or self._expires[slot] <= time.time():
+            self.misses += 1
+            return None
+        self._last_used[slot] = time.time()
+        self.hits += 1
+        return self._answers[slot]
+
+    def _grow(self) -> int:
+        """Duplica las filas reservadas (como mucho capacity) y devuelve el primer slot nuevo."""
+        used = len(self._expires)
+        extra = min(self.capacity, max(2 * used, 64)) - used
+        self._matrix = np.concatenate([self._matrix, np.zeros((extra, self._matrix.shape[1]), dtype=np.float32)])
+        self._expires = np.concatenate([self._expires, np.zeros(extra)])
+        self._last_used = np.concatenate([self._last_used, np.zeros(extra)])
+        for column in (self._intents, self._answers, self._keys):
+            column.extend([None] * extra)
+        return used
+
+    def _insert(self, vector: np.ndarray, intent: str, answer: str, expires: float, key: str):
+        now = time.time()
+        slot = self._candidates(vector).get(intent)
+        if slot is None:
+            free = np.flatnonzero(self._expires <= now)
+            if free.size:
+                slot = int(free[0])
+            elif len(self._expires) < self.capacity:
+                slot = self._grow()
+            else:
+                slot = int(np.argmin(self._last_used))
+                self.evictions += 1
+        self._slots_by_key.pop(self._keys[slot], None)
+        self._matrix[slot] = vector
+        self._expires[slot] = expires
+        self._last_used[slot] = now
+        self._intents[slot] = intent
+        self._answers[slot] = answer
+        self._keys[slot] = key
+        self._slots_by_key[key] = slot
+
+    async def store(self, embedding: np.ndarray, intent: str, answer: str):
+        vector = self._normalize(embedding)
+        if vector is None or self.capacity == 0:
+            return
+        key = uuid.uuid4().hex
+        self._insert(vector, intent, answer, time.time() + self.ttl, key)
+        if self.shared:
+            entry = {"intent": intent, "answer": answer, "vector": base64.b64encode(vector.tobytes()).decode("ascii")}
+            await self.backend.set(self.namespace, key, json.dumps(entry, ensure_ascii=False).encode("utf-8"), self.ttl)
+
+    def _invalidate_local(self, vector: Optional[np.ndarray]) -> List[str]:
+        live = self._expires > time.time()
+        mask = live if vector is None else live & (self._matrix @ vector >= self.threshold)
+        self._expires[mask] = 0.0
+        keys = []
+        for slot in np.flatnonzero(mask):
+            keys.append(self._keys[slot])
+            self._slots_by_key.pop(self._keys[slot], None)
+            self._answers[slot] = None
+            self._intents[slot] = None
+            self._keys[slot] = None
+        self.invalidations += len(keys)
+        return keys
+
+    async def invalidate(self, embedding: Optional[np.ndarray] = None) -> int:
+        """Invalida todo, o solo las entradas similares al embedding dado. Devuelve cuántas."""
+        vector = None
+        if embedding is not None:
+            vector = self._normalize(embedding)
+            if vector is None:
+                return 0
+        keys = self._invalidate_local(vector)
+        if self.shared:
+            if vector is None:
+                await self.backend.clear(self.namespace)
+            else:
+                await self.backend.delete(self.namespace, keys)
+            # 🔹 Los otros workers la aplican a su matriz en el siguiente sync()
+            event = uuid.uuid4().hex
+            self._published_invalidations.add(event)
+            await self.backend.set(
+                self.invalidations_namespace, event, b"" if vector is None else vector.tobytes(), self.ttl
+            )
+        return len(keys)
+
+    async def sync(self):
+        """Incorpora las respuestas e invalidaciones publicadas por otros workers, en orden de escritura."""
+        if not self.shared:
+            return
+        answers = await self.backend.changes(self.namespace, self._seq)
+        invalidations = await self.backend.changes(self.invalidations_namespace, self._invalidation_seq)
+        events = [(seq, False, key, value, expires) for seq, key, value, expires in answers]
+        events += [(seq, True, key, value, expires) for seq, key, value, expires in invalidations]
+        for seq, is_invalidation, key, value, expires in sorted(events, key=lambda event: event[0]):
+            if is_invalidation:
+                self._invalidation_seq = seq
+                if key not in self._published_invalidations:
+                    self._invalidate_local(np.frombuffer(value, dtype=np.float32) if value else None)
+                continue
+            self._seq = seq
+            if key in self._slots_by_key:
+                continue
+            entry = json.loads(value)
+            vector = np.frombuffer(base64.b64decode(entry["vector"]), dtype=np.float32)
+            self._insert(vector, entry["intent"], entry["answer"], expires, key)
+            self.synced += 1
+
+    async def preload(self, load: bool = True) -> int:
+        """Carga las respuestas vigentes del backend compartido y sitúa los cursores de sync()."""
+        if not self.shared:
+            return 0
+        entries = await self.backend.recent(self.namespace, self.capacity if load else 1)
+        invalidations = await self.backend.recent(self.invalidations_namespace, 1)
+        self._seq = entries[0][0] if entries else 0
+        self._invalidation_seq = invalidations[0][0] if invalidations else 0
+        if not load:
+            return 0
+        for _, key, value, expires in reversed(entries):
+            entry = json.loads(value)
+            vector = np.frombuffer(base64.b64decode(entry["vector"]), dtype=np.float32)
+            self._insert(vector, entry["intent"], entry["answer"], expires, key)
+        return len(entries)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": int((self._expires > time.time()).sum()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "synced": self.synced,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+answer_cache = SemanticAnswerCache(
+    ANSWER_CACHE_SIZE if ANSWER_CACHE_ENABLED else 0, ANSWER_CACHE_TTL, ANSWER_CACHE_THRESHOLD, cache_backend
+)
+
+
+def strip_accents(text: str) -> str:
+    """Minúsculas y sin tildes: 'Cómo CONFIGURO' → 'como configuro'."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _keyword_pattern(*terms: str) -> "re.Pattern":
+    return re.compile(r"\b(?:" + "|".join(terms) + r")\b")
+
+
+# 🔹 Palabras clave por intención (sin tildes, con límites de palabra) y su peso
+INTENT_KEYWORDS = {
+    "procedimiento": [
+        (2.0, _keyword_pattern(
+            r"pasos?", r"paso a paso", r"procedimiento", r"instrucciones", r"tutorial", r"guia",
+            r"como (?:se|puedo|debo|hago|hay que)", r"que (?:hago|tengo que hacer|hay que hacer) para",
+            r"(?:forma|manera) de",
+        )),
+        (1.5, _keyword_pattern(
+            r"configur\w*", r"instal\w*", r"setup", r"desplieg\w*", r"desplegar", r"deploy\w*",
+            r"habilit\w*", r"activar", r"crear", r"generar", r"solicitar", r"conectar(?:me)?",
+            r"acceder", r"migrar", r"reiniciar", r"restablecer", r"resetear", r"dar de alta",
+        )),
+        (1.0, re.compile(r"^\W*como\b")),
+    ],
+    "resumen": [
+        (2.0, _keyword_pattern(
+            r"resume\w*", r"resumen", r"resumir", r"sintetiza\w*", r"overview",
+            r"de que (?:va|trata)", r"en que consiste", r"vision general", r"descripcion general",
+        )),
+        (1.5, _keyword_pattern(r"que (?:es|son)", r"explica\w*", r"introduccion")),
+    ],
+    "extraccion": [
+        (2.0, _keyword_pattern(
+            r"lista\w*", r"enumera\w*", r"extrae\w*", r"tabla", r"inventario",
+            r"todos los", r"todas las", r"puntos clave", r"que datos",
+        )),
+        (1.0, _keyword_pattern(r"cuales son", r"dame (?:los|las)", r"datos")),
+    ],
+    "consulta_directa": [
+        (1.5, _keyword_pattern(
+            r"cual", r"cuando", r"donde", r"quien", r"cuant[oa]s?", r"por que", r"existe",
+            r"se puede", r"es posible",
+        )),
+        (1.0, _keyword_pattern(r"version", r"url", r"ip", r"puerto", r"responsable", r"contacto")),
+    ],
+}
+
+
+def classify_intent_keywords(query: str) -> Tuple[str, float]:
+    """Clasificador por palabras clave. Devuelve (intención, confianza 0-1)."""
+    text = strip_accents(query)
+    scores = {
+        intent: sum(weight for weight, pattern in patterns if pattern.search(text))
+        for intent, patterns in INTENT_KEYWORDS.items()
+    }
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, top), (_, second) = ranked[0], ranked[1]
+    if top == 0:
+        return "consulta_directa", 0.0
+    return best, top / (top + second) * min(top / 2.0, 1.0)
 
-def detect_intent(query):
+
+class IntentCentroids:
+    """
+    Clasificador por centroide más cercano sobre el embedding de la query.
+    Los centroides se generan offline con intent_eval.py (--build-centroids) y se guardan en .npz.
+    """
+
+    def __init__(self, path: str):
+        data = np.load(path)
+        self.labels = [str(label) for label in data["labels"]]
+        matrix = data["centroids"].astype(np.float32)
+        self.matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    def classify(self, embedding: np.ndarray) -> Optional[Tuple[str, float]]:
+        """Devuelve (intención, margen entre el 1º y 2º centroide) o None si el embedding es nulo."""
+        norm = float(np.linalg.norm(embedding))
+        if norm == 0.0:
+            return None
+        sims = self.matrix @ (embedding / norm)
+        order = np.argsort(-sims)
+        margin = float(sims[order[0]] - sims[order[1]]) if len(order) > 1 else 1.0
+        return self.labels[order[0]], margin
+
+
+intent_centroids: Optional[IntentCentroids] = None
+if INTENT_CENTROIDS_PATH:
     try:
-        return detect_intent_openai(query)
+        intent_centroids = IntentCentroids(INTENT_CENTROIDS_PATH)
+        logging.info("🧭 Centroides de intención cargados: %s", intent_centroids.labels)
     except Exception as e:
-        logging.warning(f"⚠️ Fallback a intent local: {e}")
-        return detect_intent_local(query)
+        logging.warning("⚠️ No se pudieron cargar los centroides de intención: %s", e)
+
+async def detect_intent(query, embedding_task: Optional["asyncio.Future"] = None):
+    """
+    Detecta la intención según INTENT_MODE:
+    - 'llm': siempre pregunta al modelo de intención (fallback local si falla).
+    - 'local': palabras clave y, si hay centroides, embedding; nunca llama al LLM.
+    - 'hybrid': como 'local', pero escala al LLM si la confianza es baja.
+    embedding_task es el embedding de la query que el pipeline ya está calculando. Si hace falta
+    se espera antes de stage("intent"): su latencia ya cuenta en stage("embedding").
+    """
+    embedding = None
+    if embedding_task is not None and needs_intent_embedding(query):
+        embedding = await asyncio.shield(embedding_task)
+    with stage("intent"):
+        method, intent = await _detect_intent(query, embedding)
+    metrics.inc("confubot_intent_decisions_total", (("method", method),))
+    return intent
+
+
+def needs_intent_embedding(query) -> bool:
+    """Las palabras clave no bastan y hay centroides con los que clasificar el embedding."""
+    return (
+        INTENT_MODE != "llm" and intent_centroids is not None
+        and classify_intent_keywords(query)[1] < INTENT_KEYWORD_MIN_CONFIDENCE
+    )
+
+
+async def _detect_intent(query, embedding: Optional[np.ndarray]) -> Tuple[str, str]:
+    """Devuelve (método usado, intención)."""
+    if INTENT_MODE != "llm":
+        intent, confidence = classify_intent_keywords(query)
+        if confidence >= INTENT_KEYWORD_MIN_CONFIDENCE:
+            return "keywords", intent
+
+        if intent_centroids is not None and embedding is not None:
+            result = intent_centroids.classify(embedding)
+            if result is not None and (result[1] >= INTENT_CENTROID_MIN_MARGIN or INTENT_MODE == "local"):
+                return "centroid", result[0]
+
+        if INTENT_MODE == "local":
+            return "keywords", intent
+
+    try:
+        return "llm", await detect_intent_openai(query)
+    except Exception as e:
+        logging.warning("⚠️ Fallback a intent local: %s", e)
+        metrics.inc("confubot_upstream_errors_total", (("upstream", "intent"),))
+        metrics.inc("confubot_fallbacks_total", (("kind", "intent_local"),))
+        return "local_fallback", detect_intent_local(query)
 
 def detect_intent_local(query):
     """Detección de intención local - sin llamadas a API"""
-    query_lower = query.lower().strip()
-    
-    # Palabras clave para PROCEDIMIENTO
-    if any(word in query_lower for word in ['cómo', 'como', 'pasos', 'configurar', 'instalar', 'setup', 'crear', 'hacer']):
-        return 'procedimiento'
-    
-    # Palabras clave para RESUMEN
-    if any(word in query_lower for word in ['resume', 'resumen', 'qué es', 'que es', 'explica']):
-        return 'resumen'
-    
-    # Palabras clave para EXTRACCIÓN
-    if any(word in query_lower for word in ['lista', 'extrae', 'puntos', 'datos']):
-        return 'extraccion'
-    
-    # Por defecto: consulta directa
-    return 'consulta_directa'
+    return classify_intent_keywords(query)[0]
 
-def detect_intent_openai(query):
+async def detect_intent_openai(query):
     VALID_INTENTS = {'resumen', 'extraccion', 'procedimiento', 'consulta_directa'}
     messages = [
         {"role": "system", "content": "Clasifica esta consulta como 'resumen', 'extraccion', 'procedimiento' o 'consulta_directa'. Responde SOLO con una de esas palabras exactas, sin explicación."},
         {"role": "user", "content": query}
     ]
-    result = openai_client.chat.completions.create(
+    result = await call_upstream("intent", lambda: get_openai_client().chat.completions.create(
         model=AZURE_OPENAI_DEPLOYMENT_INTENT,
         messages=messages,
         temperature=0,
         max_tokens=10
-    )
+    ))
+    record_usage(AZURE_OPENAI_DEPLOYMENT_INTENT, result.usage)
     intent = result.choices[0].message.content.strip().lower()
     if intent not in VALID_INTENTS:
-        logging.warning(f"⚠️ Intent inesperado del LLM: '{intent}', usando fallback local")
+        logging.warning("⚠️ Intent inesperado del LLM: '%s', usando fallback local", intent)
         return detect_intent_local(query)
     return intent
 
-def search_azure(query) -> List[Dict]:
-    return search_azure_hybrid(query)
+async def search_azure(query, query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
+    if local_index_usable() and LOCAL_INDEX_MODE == "primary":
+        try:
+            return await search_local(query, query_embedding)
+        except LOCAL_INDEX_ERRORS as e:
+            # 🔹 Índice ausente o corrupto: Azure Search en vez de un 500 en cada pregunta
+            disable_local_index(e)
+    return await search_azure_hybrid(query, query_embedding)
+
 
-def search_azure_hybrid(query: str) -> List[Dict]:
+local_index = LocalIndex(LOCAL_INDEX_PATH, nprobe=LOCAL_INDEX_NPROBE) if LOCAL_INDEX_PATH else None
+local_index_error: Optional[Exception] = None
+# Errores de un índice que no existe o está a medias (ficheros que faltan, JSON o .npy corruptos)
+LOCAL_INDEX_ERRORS = (OSError, ValueError, KeyError, IndexError)
+
+
+def local_index_usable() -> bool:
+    return local_index is not None and local_index_error is None
+
+
+def disable_local_index(error: Exception):
+    """El índice local no se puede leer: se deja de usar para el resto del proceso."""
+    global local_index_error
+    if local_index_error is None:
+        local_index_error = error
+        logging.error("❌ Índice local %s inutilizable (%r); se desactiva hasta reiniciar%s", LOCAL_INDEX_PATH, error,
+                      ", las búsquedas van a Azure Search" if LOCAL_INDEX_MODE == "primary" else "")
+
+
+async def search_local(query, query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
+    """Búsqueda híbrida en el índice local (BM25 + vectores con RRF), en un hilo para no bloquear el loop."""
+    vector = query_embedding if query_embedding is not None and query_embedding.any() else None
+    with stage("search_local"):
+        results = await asyncio.to_thread(local_index.search, query, vector)
+    min_score_threshold = float(os.getenv("MIN_SCORE_THRESHOLD_HYBRID", "0.01"))
+    filtered_results = [doc for doc in results if doc["@search.score"] >= min_score_threshold]
+    logging.info("📚 Búsqueda local '%s': %d encontrados, %d relevantes", query, len(results), len(filtered_results))
+    return filtered_results
+
+
+async def search_fallback(query, query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
+    """Azure Search ha fallado: índice local si está configurado y se puede leer, si no sin resultados."""
+    if not local_index_usable():
+        return []
+    logging.warning("⚠️ Azure Search no disponible, usando el índice local")
+    metrics.inc("confubot_fallbacks_total", (("kind", "search_local"),))
+    try:
+        return await search_local(query, query_embedding)
+    except LOCAL_INDEX_ERRORS as e:
+        disable_local_index(e)
+        return []
+
+class SearchHTTPError(Exception):
+    """Respuesta de error (HTTP >= 400) de Azure Search."""
+
+    def __init__(self, status: int, body: str, headers: Optional[Dict] = None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.body = body
+        self.headers = {k.lower(): v for k, v in (headers or {}).items()}
+
+
+class SingleFlightCache:
     """
-    Búsqueda híbrida: keyword + vector search con RRF automático
+    Caché TTL con coalescencia de peticiones en vuelo (single-flight).
+    Si llegan varias peticiones idénticas a la vez, solo la primera llama al upstream;
+    el resto espera el mismo resultado. Los errores se comparten pero no se cachean.
+    Con un backend compartido, antes de llamar al upstream se consulta lo que haya guardado
+    otro worker (la coalescencia sigue siendo por proceso).
     """
-    
-    logging.info(f"🔍 Búsqueda híbrida para: '{query}'")
 
-    # Generar embedding de la query
-    query_embedding = generate_embedding(query)
+    def __init__(self, max_size: int, ttl: float, backend: Optional[CacheBackend] = None,
+                 namespace: str = "", encode: Callable = None, decode: Callable = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self.namespace = namespace
+        self.encode = encode
+        self.decode = decode
+        self._cache: "OrderedDict[Tuple, Tuple[float, object]]" = OrderedDict()
+        self._inflight: Dict[Tuple, asyncio.Task] = {}
+        self.hits = 0
+        self.hits_shared = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @property
+    def shared(self) -> bool:
+        return self.backend is not None and self.backend.shared and self.ttl > 0
+
+    @staticmethod
+    def _shared_key(key: Tuple) -> str:
+        return hashlib.sha1(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _store(self, key: Tuple, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or self.ttl <= 0:
+            return
+        self._cache[key] = task.result()
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: Tuple, loader) -> Tuple[float, object]:
+        """(caducidad, resultado): del backend compartido si otro worker ya lo cargó, o del loader."""
+        if self.shared:
+            entry = await self.backend.get(self.namespace, self._shared_key(key))
+            if entry is not None:
+                self.hits_shared += 1
+                return entry[1], self.decode(entry[0])
+        result = await loader()
+        if self.shared:
+            await self.backend.set(self.namespace, self._shared_key(key), self.encode(result), self.ttl)
+        return time.time() + self.ttl, result
+
+    async def get_or_load(self, key: Tuple, loader):
+        entry = self._cache.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._cache[key]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # 🔹 La carga corre en su propia task: si el primer solicitante se cancela,
+            # los demás siguen esperando el mismo resultado
+            task = asyncio.ensure_future(self._load(key, loader))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._store(key, t))
+        return (await asyncio.shield(task))[1]
+
+    async def clear(self):
+        self._cache.clear()
+        if self.shared:
+            await self.backend.clear(self.namespace)
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._cache),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "hits_shared": self.hits_shared,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+def encode_search_results(results: List[Dict]) -> bytes:
+    """JSON de los resultados; el vector float16 de cada chunk (VECTOR_FIELD) va en base64."""
+    docs = []
+    for doc in results:
+        vector = doc.get(VECTOR_FIELD)
+        if vector is not None:
+            doc = {**doc, VECTOR_FIELD: base64.b64encode(np.asarray(vector, dtype=np.float16).tobytes()).decode("ascii")}
+        docs.append(doc)
+    return json.dumps(docs, ensure_ascii=False).encode("utf-8")
+
+
+def decode_search_results(data: bytes) -> List[Dict]:
+    docs = json.loads(data)
+    for doc in docs:
+        if VECTOR_FIELD in doc:
+            doc[VECTOR_FIELD] = np.frombuffer(base64.b64decode(doc[VECTOR_FIELD]), dtype=np.float16)
+    return docs
+
+
+search_cache = SingleFlightCache(
+    SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, cache_backend, "search", encode_search_results, decode_search_results
+)
+
 
-    url = f"https://{AZURE_SEARCH_SERVICE}.search.windows.net/indexes/{INDEX_NAME}/docs/search?api-version=2024-07-01"
+def open_cache_backend():
+    """Abre el backend de CACHE_BACKEND (una sola vez) y lo conecta a las cachés."""
+    global cache_backend, cache_backend_opened
+    if cache_backend_opened:
+        return
+    cache_backend_opened = True
+    cache_backend = make_cache_backend()
+    for cache in (embedding_cache, answer_cache, search_cache):
+        cache.backend = cache_backend
+
+
+def _cache_metrics() -> Dict[Tuple[str, Tuple], float]:
+    gauges = {}
+    for cache_name, cache_stats in (
+        ("embedding", embedding_cache.stats()),
+        ("answer", answer_cache.stats()),
+        ("search", search_cache.stats()),
+        ("shared", cache_backend.stats()),
+    ):
+        for key, value in cache_stats.items():
+            gauges[(f"confubot_cache_{key}", (("cache", cache_name),))] = value
+    return gauges
+
+
+metrics.register_collector(_cache_metrics)
+
+
+async def post_search(payload: Dict, timeout: Optional[float] = None) -> List[Dict]:
+    """POST a docs/search de Azure Search. Lanza SearchHTTPError si Azure responde con error."""
+    url = f"{AZURE_SEARCH_ENDPOINT}/indexes/{INDEX_NAME}/docs/search?api-version=2024-07-01"
     headers = {"Content-Type": "application/json", "api-key": AZURE_SEARCH_API_KEY}
+    request_timeout = aiohttp.ClientTimeout(total=timeout) if timeout else None
+    async with http_session.post(url, headers=headers, json=payload, timeout=request_timeout) as response:
+        if response.status >= 400:
+            raise SearchHTTPError(response.status, await response.text(), dict(response.headers))
+        return (await response.json()).get("value", [])
+
+
+search_vectors_unavailable = False
+
+
+def search_needs_vectors() -> bool:
+    """
+    content_vector solo se pide con SEARCH_RETURN_VECTORS y si lo usa el filtro de relevancia
+    o las sesiones; nunca si el índice ya lo rechazó (campo no recuperable).
+    """
+    if not SEARCH_RETURN_VECTORS or search_vectors_unavailable:
+        return False
+    return (RELEVANCE_GATE_ENABLED and RELEVANCE_GATE_MIN_SIMILARITY > 0) or SESSION_ENABLED
+
+
+def disable_search_vectors(error: "SearchHTTPError"):
+    """El índice no devuelve content_vector (400): se deja de pedir para el resto del proceso."""
+    global search_vectors_unavailable
+    if not search_vectors_unavailable:
+        search_vectors_unavailable = True
+        logging.error("❌ Azure Search rechaza content_vector en select (%s); se busca sin vectores: el filtro "
+                      "por similitud queda desactivado y las sesiones embeben los chunks (SESSION_EMBED_CHUNKS)",
+                      error.body[:200])
 
-    # Si el embedding falló (vector cero), hacer fallback a búsqueda keyword
-    if all(v == 0.0 for v in query_embedding):
-        logging.warning("⚠️ Embedding es vector cero, usando búsqueda keyword como fallback")
-        return search_azure_classic(query)
 
-    payload = {
+def attach_similarity(results: List[Dict], query_embedding: np.ndarray) -> List[Dict]:
+    """
+    Sustituye content_vector (lista JSON) de cada documento por su similitud coseno con la query
+    y el vector normalizado en float16, que ocupa 4 veces menos en la caché de búsquedas.
+    """
+    query_norm = float(np.linalg.norm(query_embedding))
+    for doc in results:
+        vector = doc.pop("content_vector", None)
+        if vector is None or not query_norm:
+            continue
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        if norm:
+            vector /= norm
+            doc[SIMILARITY_FIELD] = float(vector @ query_embedding) / query_norm
+            doc[VECTOR_FIELD] = vector.astype(np.float16)
+    return results
+
+
+def build_hybrid_payload(query: str, query_embedding: np.ndarray, vectors: Optional[bool] = None) -> Dict:
+    """
+    Payload de la búsqueda híbrida de Azure Search (también lo usa retrieval_eval.py).
+    vectors fuerza si se pide content_vector; por defecto, search_needs_vectors().
+    """
+    if vectors is None:
+        vectors = search_needs_vectors()
+    return {
         # BÚSQUEDA KEYWORD (tu búsqueda actual)
         "search": query,
         "searchMode": "all",
@@ -237,79 +2171,247 @@ def search_azure_hybrid(query: str) -> List[Dict]:
         # BÚSQUEDA VECTORIAL (sintaxis moderna)
         "vectorQueries": [{
             "kind": "vector",
-            "vector": query_embedding,
+            "vector": query_embedding.tolist(),
             "fields": "content_vector",
             "k": 50  # Top 50 vectores más similares
         }],
 
         # CONFIGURACIÓN GENERAL
         "top": 15,
-        "select": "title,content,url,type",
+        "select": "title,content,url,type" + (",content_vector" if vectors else ""),
         "highlight": "content"
 
         # Azure hace RRF (Reciprocal Rank Fusion) automáticamente
     }
 
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
-        response.raise_for_status()
 
-        results = response.json().get("value", [])
+async def search_azure_hybrid(query: str, query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
+    """
+    Búsqueda híbrida: keyword + vector search con RRF automático
+    """
+    
+    logging.info("🔍 Búsqueda híbrida para: '%s'", query)
+
+    # Generar embedding de la query (si el pipeline no lo trae ya calculado)
+    if query_embedding is None:
+        query_embedding = await generate_embedding(query)
 
-        # AJUSTE DE UMBRAL PARA BÚSQUEDA HÍBRIDA
-        # Los scores híbridos suelen ser más bajos debido al RRF
-        min_score_threshold = float(os.getenv("MIN_SCORE_THRESHOLD_HYBRID", "0.01"))
-        filtered_results = [doc for doc in results if doc.get("@search.score", 0) >= min_score_threshold]
+    # Si el embedding falló (vector cero), hacer fallback a búsqueda keyword
+    if not query_embedding.any():
+        logging.warning("⚠️ Embedding es vector cero, usando búsqueda keyword como fallback")
+        metrics.inc("confubot_fallbacks_total", (("kind", "search_classic"),))
+        return await search_azure_classic(query)
 
-        logging.info(f"🔍 Búsqueda híbrida '{query}': {len(results)} encontrados, {len(filtered_results)} relevantes")
+    payload = build_hybrid_payload(query, query_embedding)
+
+    # AJUSTE DE UMBRAL PARA BÚSQUEDA HÍBRIDA
+    # Los scores híbridos suelen ser más bajos debido al RRF
+    min_score_threshold = float(os.getenv("MIN_SCORE_THRESHOLD_HYBRID", "0.01"))
+
+    async def load() -> List[Dict]:
+        nonlocal payload
+        with stage("search_hybrid"):
+            try:
+                results = await call_upstream("search_hybrid", lambda: post_search(payload, timeout=SEARCH_HYBRID_TIMEOUT))
+            except SearchHTTPError as e:
+                if e.status != 400 or not search_needs_vectors():
+                    raise
+                # 🔹 Puede que content_vector no sea recuperable en este índice: se repite sin él y,
+                # si así funciona, se deja de pedir
+                payload = build_hybrid_payload(query, query_embedding, vectors=False)
+                results = await call_upstream("search_hybrid", lambda: post_search(payload, timeout=SEARCH_HYBRID_TIMEOUT))
+                disable_search_vectors(e)
+        results = attach_similarity(results, query_embedding)
+        filtered_results = [doc for doc in results if doc.get("@search.score", 0) >= min_score_threshold]
+        logging.info("🔍 Búsqueda híbrida '%s': %d encontrados, %d relevantes", query, len(results), len(filtered_results))
         return filtered_results
 
-    except requests.RequestException as e:
-        error_body = e.response.text if hasattr(e, "response") and e.response is not None else "sin detalle"
-        logging.error(f"❌ Error en búsqueda híbrida: {e} | Detalle Azure: {error_body}")
-        return []
+    try:
+        return await search_cache.get_or_load(("hybrid", normalize_query(query), min_score_threshold), load)
+
+    except CircuitOpen:
+        metrics.inc("confubot_fallbacks_total", (("kind", "search_classic"),))
+        return await search_azure_classic(query)
+    except UpstreamThrottled:
+        logging.error("❌ Azure Search sigue limitando peticiones (429) tras los reintentos")
+        if local_index_usable():
+            return await search_fallback(query, query_embedding)
+        # 🔹 No devolvemos [] (acabaría en un engañoso "no hay documentación relevante")
+        raise
+    except SearchHTTPError as e:
+        logging.error("❌ Error en búsqueda híbrida: %s | Detalle Azure: %s", e, e.body)
+        metrics.inc("confubot_upstream_errors_total", (("upstream", "search"),))
+        return await search_fallback(query, query_embedding)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error("❌ Error en búsqueda híbrida: %r", e)
+        metrics.inc("confubot_upstream_errors_total", (("upstream", "search"),))
+        return await search_fallback(query, query_embedding)
     except Exception as e:
-        logging.error(f"❌ Error procesando resultados: {e}")
+        logging.error("❌ Error procesando resultados: %s", e)
         return []
 
-def search_azure_classic(query) -> List[Dict]:
-    url = f"https://{AZURE_SEARCH_SERVICE}.search.windows.net/indexes/{INDEX_NAME}/docs/search?api-version=2024-07-01"
-    headers = {"Content-Type": "application/json", "api-key": AZURE_SEARCH_API_KEY}
+async def search_azure_classic(query) -> List[Dict]:
     payload = {"search": query, "top": 15, "select": "title,content,url"}
-    
-    response = requests.post(url, headers=headers, json=payload)
-    
-    if not response.ok:
-        return []
 
     # 🔹 Filtrar por umbral mínimo de score
     min_score_threshold = float(os.getenv("MIN_SCORE_THRESHOLD", 10))
-    results = response.json().get("value", [])
-    return [doc for doc in results if doc.get("@search.score", 0) >= min_score_threshold]
 
-def build_context(search_results, max_total_chars=60000):
-    context_parts = []
-    total_len = 0
+    async def load() -> List[Dict]:
+        with stage("search_classic"):
+            results = await call_upstream("search_classic", lambda: post_search(payload, timeout=SEARCH_CLASSIC_TIMEOUT))
+        return [doc for doc in results if doc.get("@search.score", 0) >= min_score_threshold]
 
-    for doc in search_results:
-        title = doc.get("title", "Documento sin título")
-        content = doc.get("content", "")
+    try:
+        return await search_cache.get_or_load(("classic", normalize_query(query), min_score_threshold), load)
+    except UpstreamThrottled:
+        if local_index_usable():
+            return await search_fallback(query)
+        raise
+    except (SearchHTTPError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error("❌ Error en búsqueda keyword: %r", e)
+        metrics.inc("confubot_upstream_errors_total", (("upstream", "search"),))
+        return await search_fallback(query)
+
+_tokenizer = None
+_tokenizer_loaded = False
+
+def get_tokenizer():
+    """Carga perezosa del tokenizador de tiktoken (None si no está disponible)."""
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        _tokenizer_loaded = True
+        if tiktoken is not None:
+            try:
+                _tokenizer = tiktoken.get_encoding(TOKENIZER_ENCODING)
+            except Exception as e:
+                logging.warning("⚠️ tiktoken no disponible (%s), estimando tokens por caracteres", e)
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return (len(text) + 3) // 4
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return text[:max_tokens * 4]
+    tokens = tokenizer.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return tokenizer.decode(tokens[:max_tokens])
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _mmr_order(chunks: List[Dict], lambda_: float) -> List[Dict]:
+    """Reordena con Maximal Marginal Relevance: relevancia (score) vs. parecido con lo ya elegido."""
+    max_score = max(chunk["score"] for chunk in chunks) or 1.0
+    remaining = list(chunks)
+    selected: List[Dict] = []
+    while remaining:
+        best = max(
+            remaining,
+            key=lambda c: lambda_ * c["score"] / max_score
+            - (1 - lambda_) * max((_jaccard(c["shingles"], s["shingles"]) for s in selected), default=0.0),
+        )
+        selected.append(best)
+        remaining.remove(best)
+    return selected
 
-        # Tus chunks ya son de 3000, pero cortamos por seguridad
-        snippet = content[:3000]
 
-        # 🔹 Un solo salto de línea en lugar de doble
-        entry = f"- **{title}**: {snippet}"
-        entry_len = len(entry)
+def build_context(search_results, intent="consulta_directa") -> Tuple[str, Dict]:
+    """
+    Construye el contexto del prompt con un presupuesto en tokens del modelo según la intención:
+    - descarta chunks casi duplicados (Jaccard de 3-gramas de palabras),
+    - limita los chunks por URL y agrupa los de la misma página bajo un único título,
+    - opcionalmente reordena por diversidad (MMR, CONTEXT_MMR_LAMBDA < 1).
+    Devuelve (contexto, estadísticas) con los tokens usados y los ahorrados frente a
+    enviar todos los chunks recuperados.
+    """
+    budget = CONTEXT_TOKEN_BUDGETS.get(intent, CONTEXT_TOKEN_BUDGETS["consulta_directa"])
 
-        if total_len + entry_len > max_total_chars:
-            break
+    chunks = []
+    baseline_tokens = 0
+    duplicates = 0
+    per_url: Dict[str, int] = {}
+    capped = 0
+    for doc in search_results:
+        title = doc.get("title", "Documento sin título")
+        # Tus chunks ya son de 3000 chars, pero cortamos por seguridad
+        snippet = truncate_tokens(doc.get("content", ""), CONTEXT_CHUNK_MAX_TOKENS)
+        tokens = count_tokens(snippet)
+        baseline_tokens += tokens + count_tokens(title) + 6
+
+        shingles = _shingles(snippet)
+        if any(_jaccard(shingles, kept["shingles"]) >= CONTEXT_DEDUP_THRESHOLD for kept in chunks):
+            duplicates += 1
+            continue
+        url = doc.get("url") or title
+        if per_url.get(url, 0) >= CONTEXT_MAX_CHUNKS_PER_URL:
+            capped += 1
+            continue
+        per_url[url] = per_url.get(url, 0) + 1
+        chunks.append({
+            "title": title, "url": url, "snippet": snippet, "tokens": tokens,
+            "shingles": shingles, "score": doc.get("@search.score", doc.get(SIMILARITY_FIELD, 0.0)),
+        })
 
-        context_parts.append(entry)
-        total_len += entry_len
+    if chunks and CONTEXT_MMR_LAMBDA < 1.0:
+        chunks = _mmr_order(chunks, CONTEXT_MMR_LAMBDA)
+
+    # 🔹 Seleccionar dentro del presupuesto y agrupar por URL (un título por página)
+    groups: "OrderedDict[str, Dict]" = OrderedDict()
+    used = 0
+    for chunk in chunks:
+        group = groups.get(chunk["url"])
+        cost = chunk["tokens"] + (1 if group else count_tokens(chunk["title"]) + 6)
+        snippet = chunk["snippet"]
+        if used + cost > budget:
+            remaining = budget - used - (cost - chunk["tokens"])
+            if remaining < 100:
+                break
+            snippet = truncate_tokens(snippet, remaining)
+            cost = budget - used
+        if group is None:
+            groups[chunk["url"]] = {"title": chunk["title"], "snippets": [snippet]}
+        else:
+            group["snippets"].append(snippet)
+        used += cost
 
     # 🔹 Usamos '\n' en lugar de '\n\n' para ahorrar tokens
-    return "\n".join(context_parts)
+    context = "\n".join(
+        f"- **{group['title']}**: " + "\n".join(group["snippets"]) for group in groups.values()
+    )
+    context_tokens = count_tokens(context)
+    stats = {
+        "budget": budget,
+        "chunks": sum(len(group["snippets"]) for group in groups.values()),
+        "retrieved": len(search_results),
+        "duplicates": duplicates,
+        "capped_by_url": capped,
+        "tokens": context_tokens,
+        "tokens_saved": max(baseline_tokens - context_tokens, 0),
+    }
+    logging.info(
+        "✂️ Contexto: %d/%d tokens, %d/%d chunks (%d duplicados, %d por URL), %d tokens ahorrados",
+        stats["tokens"], budget, stats["chunks"], stats["retrieved"], duplicates, capped, stats["tokens_saved"]
+    )
+    return context, stats
 
 
 RELEVANCE_THRESHOLD = float(os.getenv("RELEVANCE_THRESHOLD", "0.5"))
@@ -320,43 +2422,98 @@ LOW_RELEVANCE_MESSAGE = (
     "Intenta reformular tu pregunta con más detalle."
 )
 
-def generate_openai_response(query, context, intent):
+# 🔹 relevance_score va primero: en streaming el modelo lo emite antes que la respuesta,
+# así el filtro de relevancia se aplica antes de mandar texto al usuario
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "bot_response",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "relevance_score": {"type": "number"},
+                "answer": {"type": "string"}
+            },
+            "required": ["relevance_score", "answer"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def build_messages(query, context, intent) -> List[Dict]:
     instruction = (
         f"{PROMPT_BASE} {INTENT_PROMPTS.get(intent, INTENT_PROMPTS['consulta_directa'])} "
         "Responde únicamente usando el contenido proporcionado. "
         "Si la pregunta es ambigua, demasiado corta o genérica (ej: una sola palabra), "
         "pide al usuario que concrete su consulta en 1-2 frases breves, sin volcar el contenido de los documentos. "
         "Si no encuentras información relevante en los documentos, indica que no hay suficiente información. "
-        'Responde SIEMPRE en JSON con este formato: {"answer": "<tu respuesta en markdown>", "relevance_score": <0.0-1.0>}. '
+        'Responde SIEMPRE en JSON con este formato: {"relevance_score": <0.0-1.0>, "answer": "<tu respuesta en markdown>"}. '
         "relevance_score indica qué tan relevantes son los documentos proporcionados para responder la pregunta "
         "(0.0 = sin relación, 1.0 = perfectamente relevante)."
     )
-    messages = [
+    return [
         {"role": "system", "content": instruction},
         {"role": "user", "content": f"### DOCUMENTOS:\n{context}\n\n### PREGUNTA:\n{query}"}
     ]
-    result = openai_client.chat.completions.create(
-        model=AZURE_OPENAI_DEPLOYMENT,
-        messages=messages,
-        max_tokens=2048,
-        temperature=0.3,
-        response_format={
-            "type": "json_schema",
-            "json_schema": {
-                "name": "bot_response",
-                "strict": True,
-                "schema": {
-                    "type": "object",
-                    "properties": {
-                        "answer": {"type": "string"},
-                        "relevance_score": {"type": "number"}
-                    },
-                    "required": ["answer", "relevance_score"],
-                    "additionalProperties": False
-                }
-            }
-        }
-    )
+
+def relevance_gate(search_results: List[Dict]) -> Optional[str]:
+    """
+    Decide con las señales de la recuperación si merece la pena llamar al LLM.
+    Devuelve el motivo para no generar ("no_results", "low_similarity", "low_score") o None.
+    """
+    if not RELEVANCE_GATE_ENABLED:
+        return None
+    if not search_results:
+        return "no_results"
+    similarities = [doc[SIMILARITY_FIELD] for doc in search_results if SIMILARITY_FIELD in doc]
+    if similarities and RELEVANCE_GATE_MIN_SIMILARITY > 0 and max(similarities) < RELEVANCE_GATE_MIN_SIMILARITY:
+        return "low_similarity"
+    # 🔹 Los chunks reutilizados de la conversación no traen @search.score: ahí solo cuenta la similitud
+    scores = [doc["@search.score"] for doc in search_results if "@search.score" in doc]
+    if scores and RELEVANCE_GATE_MIN_SCORE > 0 and max(scores) < RELEVANCE_GATE_MIN_SCORE:
+        return "low_score"
+    return None
+
+
+def skip_generation(search_results: List[Dict]) -> bool:
+    reason = relevance_gate(search_results)
+    if reason is None:
+        return False
+    logging.info("🚫 Generación evitada por el filtro de relevancia (%s)", reason)
+    metrics.inc("confubot_completions_avoided_total", (("reason", reason),))
+    metrics.inc("confubot_low_relevance_total")
+    return True
+
+
+def choose_deployment(query: str, intent: str) -> str:
+    """Consultas cortas y directas van al deployment barato (el de intención)."""
+    if ROUTE_SIMPLE_QUERIES and intent in SIMPLE_QUERY_INTENTS and count_tokens(query) <= SIMPLE_QUERY_MAX_TOKENS:
+        deployment = AZURE_OPENAI_DEPLOYMENT_INTENT
+    else:
+        deployment = AZURE_OPENAI_DEPLOYMENT
+    metrics.inc("confubot_generation_deployment_total", (("deployment", deployment),))
+    return deployment
+
+
+metrics.describe("confubot_completions_avoided_total", "Generaciones evitadas por el filtro de relevancia previo")
+metrics.describe("confubot_generation_deployment_total", "Generaciones por deployment (enrutado de consultas sencillas)")
+
+
+async def generate_openai_response(query, context, intent, deployment: str = AZURE_OPENAI_DEPLOYMENT):
+    try:
+        with stage("generation"):
+            result = await call_upstream("chat", lambda: get_openai_client().chat.completions.create(
+                model=deployment,
+                messages=build_messages(query, context, intent),
+                max_tokens=2048,
+                temperature=0.3,
+                response_format=RESPONSE_FORMAT
+            ))
+    except Exception:
+        metrics.inc("confubot_upstream_errors_total", (("upstream", "chat"),))
+        raise
+    record_usage(deployment, result.usage)
     raw = result.choices[0].message.content
     try:
         parsed = json.loads(raw)
@@ -364,41 +2521,470 @@ def generate_openai_response(query, context, intent):
     except (json.JSONDecodeError, AttributeError):
         return raw, 1.0
 
-def generate_response_by_intent(query, search_results, intent):
-    context = build_context(search_results)
-    response, relevance_score = generate_openai_response(query, context, intent)
-    logging.info(f"📊 Relevance score: {relevance_score}")
 
-    # 🔹 Respuesta genérica si la relevancia es baja
-    if relevance_score < RELEVANCE_THRESHOLD:
-        return LOW_RELEVANCE_MESSAGE
+class StreamingAnswerParser:
+    """
+    Parser incremental del JSON {"relevance_score": x, "answer": "..."} que llega token a token.
+    feed() devuelve el texto nuevo de 'answer' ya decodificado (escapes JSON incluidos);
+    relevance_score queda disponible en cuanto el modelo lo emite.
+    """
 
-    # 🔹 Recoger URLs únicas con su score
+    _RELEVANCE_RE = re.compile(r'"relevance_score"\s*:\s*(-?[0-9][0-9.eE+-]*)\s*[,}]')
+    _ANSWER_RE = re.compile(r'"answer"\s*:\s*"')
+    _ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+    def __init__(self):
+        self.relevance_score: Optional[float] = None
+        self._buffer = ""
+        self._pos: Optional[int] = None  # posición dentro del string 'answer'
+        self._answer_done = False
+        self._emitted = False
+
+    def feed(self, chunk: str) -> str:
+        self._buffer += chunk
+        if self.relevance_score is None:
+            match = self._RELEVANCE_RE.search(self._buffer)
+            if match:
+                try:
+                    self.relevance_score = float(match.group(1))
+                except ValueError:
+                    self.relevance_score = 1.0
+        if self._pos is None:
+            match = self._ANSWER_RE.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+        return self._decode()
+
+    def _decode(self) -> str:
+        out = []
+        buf, i = self._buffer, self._pos
+        while i < len(buf) and not self._answer_done:
+            c = buf[i]
+            if c == '"':
+                self._answer_done = True
+                i += 1
+                break
+            if c != "\\":
+                out.append(c)
+                i += 1
+                continue
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc != "u":
+                out.append(self._ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            # \uXXXX (y pares sustitutos \uD83D\uDE00 para emojis)
+            if i + 6 > len(buf):
+                break
+            code = int(buf[i + 2:i + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                if i + 12 > len(buf):
+                    break
+                low = int(buf[i + 8:i + 12], 16)
+                out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                i += 12
+            else:
+                out.append(chr(code))
+                i += 6
+        self._pos = i
+        if out:
+            self._emitted = True
+        return "".join(out)
+
+    def finish(self) -> str:
+        """Cierra el stream. Si el modelo no devolvió JSON, se usa el texto en bruto (como en modo normal)."""
+        if self._pos is None and not self._emitted:
+            try:
+                parsed = json.loads(self._buffer)
+                if self.relevance_score is None:
+                    self.relevance_score = parsed.get("relevance_score", 1.0)
+                return parsed.get("answer", self._buffer)
+            except (json.JSONDecodeError, AttributeError):
+                return self._buffer
+        return ""
+
+
+def format_sources(search_results) -> str:
+    """Lista de URLs únicas con su score, para añadir al final de la respuesta."""
     seen_urls = set()
     enlaces = []
     for doc in search_results:
         url = doc.get("url", "")
-        score = doc.get("@search.score", 0.0)
         if url and url not in seen_urls:
             seen_urls.add(url)
             title = doc.get("title", "Documento sin título")
-            enlaces.append(f"- 🔗 [{title}]({url}) (score: {score:.3f})")
+            # 🔹 Los chunks reutilizados de la conversación solo tienen la similitud con la nueva pregunta
+            if "@search.score" in doc or SIMILARITY_FIELD not in doc:
+                enlaces.append(f"- 🔗 [{title}]({url}) (score: {doc.get('@search.score', 0.0):.3f})")
+            else:
+                enlaces.append(f"- 🔗 [{title}]({url}) (similitud: {doc[SIMILARITY_FIELD]:.3f})")
+
+    if not enlaces:
+        return ""
+    return "\n\n---\n" + "\n".join(enlaces)
+
+
+async def generate_response_by_intent(query, search_results, intent):
+    if skip_generation(search_results):
+        return LOW_RELEVANCE_MESSAGE
+    with stage("build_context"):
+        context, context_stats = build_context(search_results, intent)
+    record_context_usage(context_stats)
+    deployment = choose_deployment(query, intent)
+    response, relevance_score = await generate_openai_response(query, context, intent, deployment)
+    logging.info("📊 Relevance score: %s", relevance_score)
+
+    # 🔹 Respuesta genérica si la relevancia es baja
+    if relevance_score < RELEVANCE_THRESHOLD:
+        metrics.inc("confubot_low_relevance_total")
+        return LOW_RELEVANCE_MESSAGE
+
+    # 🔹 Recoger URLs únicas con su score
+    return response + format_sources(search_results)
+
+
+async def stream_response_by_intent(query, search_results, intent):
+    """
+    Versión streaming de generate_response_by_intent: genera los fragmentos de la respuesta
+    final según llegan del modelo. El texto no se emite hasta conocer relevance_score; si es
+    bajo se corta la generación y se devuelve LOW_RELEVANCE_MESSAGE. Los enlaces van al final.
+    """
+    if skip_generation(search_results):
+        yield LOW_RELEVANCE_MESSAGE
+        return
+    with stage("build_context"):
+        context, context_stats = build_context(search_results, intent)
+    record_context_usage(context_stats)
+    deployment = choose_deployment(query, intent)
+    start = time.perf_counter()
+    try:
+        stream = await call_upstream("chat", lambda: get_openai_client().chat.completions.create(
+            model=deployment,
+            messages=build_messages(query, context, intent),
+            max_tokens=2048,
+            temperature=0.3,
+            response_format=RESPONSE_FORMAT,
+            stream=True
+        ))
+    except Exception:
+        metrics.inc("confubot_upstream_errors_total", (("upstream", "chat"),))
+        raise
+    parser = StreamingAnswerParser()
+    pending = []  # texto recibido antes de conocer relevance_score
+    first_token = True
+    try:
+        async for chunk in stream:
+            record_usage(deployment, getattr(chunk, "usage", None))
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if first_token:
+                first_token = False
+                metrics.observe("confubot_stage_seconds", time.perf_counter() - start,
+                                (("stage", "generation_first_token"),))
+            text = parser.feed(chunk.choices[0].delta.content)
+            if parser.relevance_score is None:
+                pending.append(text)
+                continue
+            if parser.relevance_score < RELEVANCE_THRESHOLD:
+                break
+            if pending:
+                text = "".join(pending) + text
+                pending = []
+            if text:
+                yield text
+    finally:
+        await stream.close()
+        metrics.observe("confubot_stage_seconds", time.perf_counter() - start, (("stage", "generation"),))
+
+    pending.append(parser.finish())
+    relevance_score = parser.relevance_score if parser.relevance_score is not None else 1.0
+    logging.info("📊 Relevance score: %s", relevance_score)
+
+    if relevance_score < RELEVANCE_THRESHOLD:
+        metrics.inc("confubot_low_relevance_total")
+        yield LOW_RELEVANCE_MESSAGE
+        return
+
+    text = "".join(pending)
+    if text:
+        yield text
+    sources = format_sources(search_results)
+    if sources:
+        yield sources
+
+
+class ConversationSessions:
+    """
+    Último contexto recuperado por conversación (query, embedding y chunks con sus vectores),
+    acotado por TTL, número de conversaciones y memoria (LRU). Si la nueva pregunta encaja con
+    esos chunks casi tan bien como la pregunta con la que se recuperaron, se reordenan en local
+    y no se vuelve a buscar en Azure.
+    """
+
+    def __init__(self, max_sessions: int, ttl: float, max_bytes: int):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def _size(docs: List[Dict], vectors: np.ndarray) -> int:
+        """Memoria aproximada de una sesión: textos, vectores float16 de los docs y la matriz float32."""
+        size = vectors.nbytes
+        for doc in docs:
+            size += doc[VECTOR_FIELD].nbytes + sum(len(v) for v in doc.values() if isinstance(v, str))
+        return size
+
+    def _drop(self, session_id: str):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self.bytes -= session["bytes"]
+
+    def store(self, session_id: str, search_results: List[Dict]):
+        # 🔹 Los metadatos de búsqueda (@search.score, highlights) son de la query anterior: no se guardan
+        docs = [
+            {key: value for key, value in doc.items() if not key.startswith("@search.")}
+            for doc in search_results if VECTOR_FIELD in doc
+        ]
+        self._drop(session_id)
+        if not docs:
+            return
+        vectors = np.stack([doc[VECTOR_FIELD] for doc in docs]).astype(np.float32)
+        size = self._size(docs, vectors)
+        self._sessions[session_id] = {
+            "docs": docs,
+            "vectors": vectors,
+            "best": max(doc.get(SIMILARITY_FIELD, 0.0) for doc in docs),
+            "reuses": 0,
+            "expires": time.monotonic() + self.ttl,
+            "bytes": size,
+        }
+        self.bytes += size
+        while self._sessions and (len(self._sessions) > self.max_sessions or self.bytes > self.max_bytes):
+            self._drop(next(iter(self._sessions)))
+
+    def reuse(self, session_id: str, query_embedding: np.ndarray) -> Optional[List[Dict]]:
+        """Chunks del turno anterior reordenados para la nueva query, o None si hay que buscar."""
+        session = self._sessions.get(session_id)
+        if session is None or session["expires"] < time.monotonic():
+            self._drop(session_id)
+            return None
+        norm = float(np.linalg.norm(query_embedding))
+        if not norm or session["reuses"] >= SESSION_MAX_REUSES:
+            return None
+        similarities = session["vectors"] @ (query_embedding / norm)
+        best = float(similarities.max())
+        if best < SESSION_REUSE_MIN_SIMILARITY or best < SESSION_REUSE_RATIO * session["best"]:
+            logging.info("🧵 La pregunta se aleja del contexto de la conversación (%.2f), nueva búsqueda", best)
+            return None
+
+        session["reuses"] += 1
+        session["expires"] = time.monotonic() + self.ttl
+        self._sessions.move_to_end(session_id)
+        order = np.argsort(-similarities)
+        return [{**session["docs"][i], SIMILARITY_FIELD: float(similarities[i])} for i in order]
+
+
+sessions = ConversationSessions(SESSION_MAX_CONVERSATIONS, SESSION_TTL, int(SESSION_MAX_MEMORY_MB * 1024 * 1024))
+
+metrics.describe("confubot_searches_avoided_total", "Búsquedas evitadas reutilizando el contexto de la conversación")
+metrics.register_collector(lambda: {
+    ("confubot_sessions", ()): len(sessions),
+    ("confubot_sessions_bytes", ()): sessions.bytes,
+})
+
+
+def reuse_session(session_id: Optional[str], query_embedding: np.ndarray) -> Optional[List[Dict]]:
+    """Chunks del turno anterior de la conversación si la nueva pregunta encaja con ellos."""
+    if not (SESSION_ENABLED and session_id):
+        return None
+    with stage("session_rerank"):
+        reused = sessions.reuse(session_id, query_embedding)
+    if reused is not None:
+        logging.info("🧵 Reutilizando %d chunks del turno anterior de la conversación", len(reused))
+        metrics.inc("confubot_searches_avoided_total", (("reason", "session"),))
+    return reused
+
+
+session_tasks = set()
+
+
+async def store_session(session_id: str, search_results: List[Dict], query_embedding: np.ndarray):
+    """
+    Guarda los resultados como contexto de la conversación. Los que llegan sin vector (Azure Search
+    sin content_vector) se embeben una vez, con el mismo texto que ingest_confluence.py, en copias:
+    los de la caché de búsquedas no se modifican.
+    """
+    missing = [doc for doc in search_results if VECTOR_FIELD not in doc]
+    if missing and SESSION_EMBED_CHUNKS:
+        with stage("session_embedding"):
+            vectors = await generate_embeddings([f"{doc.get('title') or ''}\n\n{doc.get('content') or ''}" for doc in missing])
+        embedded = {id(doc): {**doc, "content_vector": vector} for doc, vector in zip(missing, vectors)}
+        attach_similarity(list(embedded.values()), query_embedding)
+        search_results = [embedded.get(id(doc), doc) for doc in search_results]
+    sessions.store(session_id, search_results)
 
-    if enlaces:
-        response += "\n\n---\n" + "\n".join(enlaces)
 
+async def retrieve(query, query_embedding: np.ndarray, session_id: Optional[str] = None) -> List[Dict]:
+    """
+    Búsqueda; con session_id los resultados quedan como contexto de la conversación. Si hay que
+    embeber los chunks se hace en segundo plano: la sesión solo hace falta para el turno siguiente.
+    """
+    search_results = await search_azure(query, query_embedding)
+    if SESSION_ENABLED and session_id:
+        if SESSION_EMBED_CHUNKS and any(VECTOR_FIELD not in doc for doc in search_results):
+            task = asyncio.create_task(store_session(session_id, search_results, query_embedding))
+            session_tasks.add(task)
+            task.add_done_callback(session_tasks.discard)
+        else:
+            sessions.store(session_id, search_results)
+    return search_results
+
+
+async def classify_and_retrieve(
+    query, query_embedding: Optional[np.ndarray] = None, session_id: Optional[str] = None
+) -> Tuple[str, List[Dict], np.ndarray, Optional[str], bool]:
+    """
+    Etapa 1 del pipeline: clasificación de intención en paralelo con embedding→búsqueda.
+    Tras el embedding se consulta la caché semántica; si hay un candidato, se espera a la
+    intención y, si coincide, se devuelve la respuesta cacheada sin buscar ni generar.
+    Ambas ramas tienen su propio fallback (intent local / búsqueda keyword); si aun así
+    una falla o la petición se cancela, se cancela la otra y se propaga el error.
+    Devuelve (intención, resultados, embedding de la query, respuesta cacheada o None,
+    si los resultados son los del turno anterior de la conversación).
+    Si ya se tiene el embedding (p.ej. calculado en lote) se pasa en query_embedding.
+    Con session_id (conversación de Teams) la búsqueda puede reutilizar el turno anterior:
+    entonces la respuesta depende de la conversación y no se consulta la caché semántica.
+    """
+    if query_embedding is None:
+        embedding_task = asyncio.create_task(generate_embedding(query))
+    else:
+        embedding_task = asyncio.get_running_loop().create_future()
+        embedding_task.set_result(query_embedding)
+    intent_task = asyncio.create_task(detect_intent(query, embedding_task))
+    try:
+        query_embedding = await embedding_task
+
+        search_results = reuse_session(session_id, query_embedding)
+        reused = search_results is not None
+        if not reused:
+            candidates = answer_cache.lookup(query_embedding)
+            intent = await intent_task if candidates else None
+            cached_answer = answer_cache.resolve(candidates, intent)
+            if cached_answer is not None:
+                logging.info("⚡ Respuesta servida desde la caché semántica")
+                return intent, [], query_embedding, cached_answer, False
+
+        # 🔹 Sin generación disponible solo se pueden servir respuestas cacheadas: no buscar
+        if BREAKER_ENABLED and not breakers["chat"].available():
+            raise CircuitOpen("chat", breakers["chat"].retry_after())
+
+        if not reused:
+            search_results = await retrieve(query, query_embedding, session_id)
+        intent = await intent_task
+    except BaseException:
+        for task in (embedding_task, intent_task):
+            task.cancel()
+        raise
+    return intent, search_results, query_embedding, None, reused
+
+
+async def answer_query(
+    query, query_embedding: Optional[np.ndarray] = None, session_id: Optional[str] = None
+) -> str:
+    """Pipeline completo: (intención ∥ embedding → caché semántica → búsqueda) → generación."""
+    intent, search_results, query_embedding, cached_answer, reused = await classify_and_retrieve(
+        query, query_embedding, session_id
+    )
+    logging.info("🔍 Intención detectada: %s", intent)
+    if cached_answer is not None:
+        return cached_answer
+
+    response_text = await generate_response_by_intent(query, search_results, intent)
+    # 🔹 Una respuesta construida con el contexto de otra conversación no vale para las demás
+    if response_text != LOW_RELEVANCE_MESSAGE and not reused:
+        await answer_cache.store(query_embedding, intent, response_text)
+    return response_text
+
+
+async def answer_query_stream(query, session_id: Optional[str] = None):
+    """Como answer_query, pero genera la respuesta por fragmentos (token streaming)."""
+    intent, search_results, query_embedding, cached_answer, reused = await classify_and_retrieve(
+        query, session_id=session_id
+    )
+    logging.info("🔍 Intención detectada: %s", intent)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+
+    parts = []
+    async for delta in stream_response_by_intent(query, search_results, intent):
+        parts.append(delta)
+        yield delta
+
+    response_text = "".join(parts)
+    if response_text != LOW_RELEVANCE_MESSAGE and not reused:
+        await answer_cache.store(query_embedding, intent, response_text)
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+    request_id_var.set(request.headers.get("X-Request-Id") or uuid.uuid4().hex[:16])
+    request_timings.set({})
+    request_usage.set({})
+
+
+@app.after_request
+async def record_request_duration(response):
+    start = getattr(g, "request_start", None)
+    response.headers["X-Request-Id"] = request_id_var.get()
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        endpoint = request.url_rule.rule if request.url_rule else "other"
+        metrics.observe(
+            "confubot_request_seconds", elapsed, (("endpoint", endpoint), ("status", response.status_code)),
+        )
+        # 🔹 Un registro estructurado por petición con los tiempos por etapa (en streaming, hasta la cabecera)
+        timings = request_timings.get() or {}
+        logging.info(
+            "✅ %s %s %d", request.method, endpoint, response.status_code,
+            extra={"status": response.status_code, "duration_ms": round(elapsed * 1000, 1),
+                   "timings_ms": {name: round(seconds * 1000, 1) for name, seconds in timings.items()},
+                   "usage": request_usage.get() or {}},
+        )
     return response
 
 
+@app.route("/metrics", methods=["GET"])
+@require_basic_auth
+async def prometheus_metrics():
+    """Métricas del proceso en formato de texto de Prometheus."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/api/messages", methods=["POST"])
 async def messages():
     try:
         body = await request.get_json()
-        logging.info(f"📩 Petición recibida: {body}")
-
         auth_header = request.headers.get("Authorization", "")
         activity = Activity().deserialize(body)
 
+        # 🔹 Resumen estructurado siempre; el cuerpo completo solo a DEBUG o en una muestra, truncado
+        logging.info(
+            "📩 Actividad %s recibida", activity.type,
+            extra={"activity_id": activity.id, "conversation_id": activity.conversation.id if activity.conversation else None,
+                   "channel": activity.channel_id},
+        )
+        log_payload("📩 Petición recibida", body)
+
         async def aux_func(turn_context: TurnContext):
             try:
                 if turn_context.activity.type == ActivityTypes.message and turn_context.activity.text:
@@ -406,20 +2992,20 @@ async def messages():
                 else:
                     logging.info("🔹 Ignorando mensaje sin texto.")
             except Exception as e:
-                logging.error(f"❌ Error procesando mensaje del usuario: {e}", exc_info=True)
+                logging.error("❌ Error procesando mensaje del usuario: %s", e, exc_info=True)
                 await turn_context.send_activity(
                     Activity(type=ActivityTypes.message, text="Se ha producido un error procesando tu mensaje.")
                 )
 
-        await adapter.process_activity(activity, auth_header, aux_func)
+        await get_adapter().process_activity(activity, auth_header, aux_func)
         return Response(status=201)
 
     except PermissionError as e:
-        logging.warning(f"🔐 Acceso no autorizado: {e}")
+        logging.warning("🔐 Acceso no autorizado: %s", e)
         return Response("Unauthorized", status=401)
 
     except Exception as e:
-        logging.error(f"❌ Error general en la ruta /api/messages: {e}", exc_info=True)
+        logging.error("❌ Error general en la ruta /api/messages: %s", e, exc_info=True)
         return Response("Internal Server Error", status=500)
     
 @app.route("/api/ask", methods=["POST"])
@@ -437,15 +3023,28 @@ async def ask():
         if not user_message:
             return jsonify({"error": "No user message found in 'messages'"}), 400
 
-        logging.info(f"🤖 Pregunta MCP: {user_message}")
+        logging.info("🤖 Pregunta MCP: %s", user_message)
+
+        if not rate_limiter.allow(f"api:{g.auth_user}"):
+            return jsonify({"error": "Rate limit exceeded"}), 429, {"Retry-After": str(retry_after_seconds())}
 
-        intent = detect_intent(user_message)
-        logging.info(f"🔍 Intención detectada: {intent}")
+        # 🔹 "conversation_id" opcional: las repreguntas pueden reutilizar lo recuperado en el turno anterior
+        session_id = f"api:{g.auth_user}:{data['conversation_id']}" if data.get("conversation_id") else None
 
-        search_results = search_azure(user_message)
-        response_text = generate_response_by_intent(user_message, search_results, intent)
+        if data.get("stream"):
+            # El generador SSE entra en la cola al empezar; aquí solo se rechaza si ya está llena
+            if admission.full():
+                metrics.inc("confubot_rejected_total", (("reason", "queue_full"),))
+                return overloaded_response()
+            return stream_chat_completion(user_message, session_id)
 
-        return jsonify({
+        # 🔹 Tiempos por etapa opcionales en la respuesta ("timings": true o cabecera X-Confubot-Timings)
+        include_timings = bool(data.get("timings") or request.headers.get("X-Confubot-Timings"))
+
+        async with admission:
+            response_text = await answer_query(user_message, session_id=session_id)
+
+        completion = {
             "id": "chatcmpl-mcp-server",
             "object": "chat.completion",
             "created": int(time.time()),
@@ -460,13 +3059,175 @@ async def ask():
                     "finish_reason": "stop"
                 }
             ]
-        })
-
+        }
+        if include_timings:
+            timings = request_timings.get()
+            timings["total"] = time.perf_counter() - g.request_start
+            completion["timings"] = {name: round(seconds * 1000, 1) for name, seconds in timings.items()}
+        # 🔹 Tokens como en la API de OpenAI, más los de contexto enviados y ahorrados por build_context
+        usage = dict(request_usage.get() or {})
+        usage["total_tokens"] = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+        completion["usage"] = usage
+        return jsonify(completion)
+
+    except Overloaded:
+        return overloaded_response()
+    except UpstreamThrottled as e:
+        logging.warning("⛔ /api/ask rechazada: %s limitado por Azure", e.upstream)
+        return overloaded_response(e.retry_after)
     except Exception as e:
-        logging.error(f"❌ Error en /api/ask MCP: {e}", exc_info=True)
+        logging.error("❌ Error en /api/ask MCP: %s", e, exc_info=True)
         return jsonify({"error": "Internal Server Error"}), 500
 
 
+@app.route("/api/ask/batch", methods=["POST"])
+@require_basic_auth
+async def ask_batch():
+    """
+    Responde N preguntas en una sola petición: embeddings en lote y luego búsqueda + generación
+    con como mucho BATCH_CONCURRENCY preguntas a la vez. Devuelve NDJSON, una línea por
+    pregunta en orden de finalización: {"index", "id", "question", "answer"} o {"index", "id", "error"}.
+    """
+    data = await request.get_json(silent=True) or {}
+    questions = data.get("questions")
+    if not questions or not isinstance(questions, list):
+        return jsonify({"error": "Missing or invalid 'questions' field"}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"Too many questions (max {BATCH_MAX_QUESTIONS})"}), 400
+
+    # Cada elemento puede ser un texto o {"id": ..., "question": ...}
+    items = []
+    for index, item in enumerate(questions):
+        question = item.get("question") if isinstance(item, dict) else item
+        if not isinstance(question, str) or not question.strip():
+            return jsonify({"error": f"Invalid question at index {index}"}), 400
+        items.append((index, item.get("id") if isinstance(item, dict) else None, question))
+
+    # 🔹 Preguntas repetidas en el lote (misma query normalizada) se responden una sola vez
+    groups: "OrderedDict[str, List[Tuple[int, Optional[str], str]]]" = OrderedDict()
+    for item in items:
+        groups.setdefault(normalize_query(item[2]), []).append(item)
+
+    # Cada pregunta distinta cuesta un token del rate limit, como si llegara por /api/ask
+    if not rate_limiter.allow(f"api:{g.auth_user}", cost=len(groups)):
+        return jsonify({"error": "Rate limit exceeded"}), 429, {"Retry-After": str(retry_after_seconds())}
+    if admission.full():
+        metrics.inc("confubot_rejected_total", (("reason", "queue_full"),))
+        return overloaded_response()
+
+    logging.info("📦 Lote de %s preguntas (%s distintas)", len(items), len(groups))
+    metrics.inc("confubot_batch_questions_total", value=len(items))
+
+    async def answer(copies, embedding, semaphore) -> List[Dict]:
+        """Responde una pregunta distinta y devuelve una línea por cada copia del lote."""
+        question = copies[0][2]
+        start = time.perf_counter()
+        result = {}
+        try:
+            # 🔹 Cada pregunta pasa por el control de admisión como una petición más
+            async with semaphore, admission:
+                result["answer"] = await answer_query(question, embedding)
+        except Overloaded:
+            result["error"] = "Service overloaded, retry later"
+        except UpstreamThrottled as e:
+            result["error"] = f"{e.upstream} throttled"
+        except Exception as e:
+            logging.error("❌ Error en /api/ask/batch (pregunta '%s'): %s", question, e, exc_info=True)
+            result["error"] = "Internal Server Error"
+        result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return [{"index": index, "id": item_id, "question": text, **result} for index, item_id, text in copies]
+
+    async def lines():
+        tasks = []
+        try:
+            async with admission:
+                embeddings = await generate_embeddings([copies[0][2] for copies in groups.values()])
+            semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+            tasks = [
+                asyncio.create_task(answer(copies, embedding, semaphore))
+                for copies, embedding in zip(groups.values(), embeddings)
+            ]
+            for next_done in asyncio.as_completed(tasks):
+                for line in await next_done:
+                    yield json.dumps(line, ensure_ascii=False) + "\n"
+        except Overloaded:
+            yield json.dumps({"error": "Service overloaded, retry later"}) + "\n"
+        finally:
+            # Si el cliente corta la conexión no seguimos gastando tokens
+            for task in tasks:
+                task.cancel()
+
+    response = Response(lines(), mimetype="application/x-ndjson")
+    response.timeout = None
+    return response
+
+
+def retry_after_seconds() -> int:
+    """Segundos hasta que el usuario recupere un token del rate limit."""
+    rate = USER_RATE_LIMIT_PER_MINUTE / 60.0
+    return max(1, int(round(1 / rate))) if rate > 0 else 1
+
+
+def overloaded_response(retry_after: Optional[float] = None):
+    return jsonify({"error": "Service overloaded, retry later"}), 503, {
+        "Retry-After": str(max(1, int(round(retry_after or 1))))
+    }
+
+
+def stream_chat_completion(user_message, session_id: Optional[str] = None) -> Response:
+    """Respuesta SSE compatible con OpenAI (chat.completion.chunk) para /api/ask con stream=true."""
+    completion_id = f"chatcmpl-mcp-{int(time.time() * 1000)}"
+    created = int(time.time())
+
+    def chunk(delta, finish_reason=None) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": "confubot-mcp",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async def events():
+        yield chunk({"role": "assistant"})
+        try:
+            async with admission:
+                async for delta in answer_query_stream(user_message, session_id):
+                    yield chunk({"content": delta})
+        except (Overloaded, UpstreamThrottled) as e:
+            logging.warning("⛔ /api/ask (stream) rechazada por saturación: %r", e)
+            yield f"data: {json.dumps({'error': {'message': 'Service overloaded', 'code': 503}})}\n\n"
+        except Exception as e:
+            logging.error("❌ Error en /api/ask MCP (stream): %s", e, exc_info=True)
+            yield f"data: {json.dumps({'error': {'message': 'Internal Server Error'}})}\n\n"
+        yield chunk({}, "stop")
+        yield "data: [DONE]\n\n"
+
+    response = Response(events(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.timeout = None
+    return response
+
+
+@app.route("/api/cache/invalidate", methods=["POST"])
+@require_basic_auth
+async def invalidate_cache():
+    """Invalida las cachés completas o, si se indica 'query', solo las respuestas parecidas."""
+    data = await request.get_json(silent=True) or {}
+    query = data.get("query")
+    embedding = await generate_embedding(query) if query else None
+    removed = await answer_cache.invalidate(embedding)
+    if embedding is None:
+        await search_cache.clear()
+    logging.info("🧹 Caché semántica invalidada: %s entradas", removed)
+    return jsonify({
+        "invalidated": removed,
+        "answer_cache": answer_cache.stats(),
+        "search_cache": search_cache.stats(),
+    })
+
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
@@ -0,0 +1,157 @@
+"""
+Coste del logging por petición: configuración anterior frente al logging en cola.
+
+Reproduce los registros que genera una petición de Teams (/api/messages) y mide el tiempo que
+pasa el hilo de la petición (el event loop) dentro de logging:
+  - antes: logging.basicConfig (handler síncrono), f-strings y el cuerpo completo de la actividad
+  - después: setup_logging() de app.py (QueueHandler + JSON en un hilo aparte), argumentos
+    diferidos, resumen estructurado y cuerpo muestreado/truncado
+El volumen escrito se mide en bytes por petición. --write-latency simula un destino lento
+(disco compartido de App Service, pipe lleno) y --interval el hueco entre peticiones, que en
+producción ocupan las llamadas a Azure.
+
+Uso:
+    python bench_logging.py --requests 5000
+    python bench_logging.py --requests 5000 --sink file   # escribiendo a disco como App Service
+    python bench_logging.py --requests 2000 --write-latency 0.0005 --interval 0.005
+"""
+import argparse
+import atexit
+import io
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import app
+
+ACTIVITY = {
+    "type": "message",
+    "id": "1712345678901",
+    "timestamp": "2024-04-05T10:11:12.345Z",
+    "serviceUrl": "https://smba.trafficmanager.net/emea/",
+    "channelId": "msteams",
+    "from": {"id": "29:1AbCdEfGhIjKlMnOpQrStUvWxYz" * 2, "name": "Usuario de Prueba", "aadObjectId": "0" * 36},
+    "conversation": {"id": "a:1" + "x" * 120, "conversationType": "personal", "tenantId": "0" * 36},
+    "recipient": {"id": "28:" + "0" * 36, "name": "confubot"},
+    "textFormat": "plain",
+    "locale": "es-ES",
+    "text": "<at>confubot</at> ¿Cómo configuro la VPN para acceder a preproducción?",
+    "entities": [{"type": "clientInfo", "locale": "es-ES", "country": "ES", "platform": "Web", "timezone": "Europe/Madrid"}],
+    "channelData": {"tenant": {"id": "0" * 36}, "source": {"name": "message"}, "clientActivityId": "x" * 40},
+}
+QUERY = "¿Cómo configuro la VPN para acceder a preproducción?"
+TIMINGS = {"intent": 0.0004, "embedding": 0.21, "search_hybrid": 0.18, "build_context": 0.01, "generation": 2.4}
+
+
+def request_before():
+    """Los registros de una petición tal y como se emitían antes."""
+    body = ACTIVITY
+    logging.info(f"📩 Petición recibida: {body}")
+    logging.info(f"🔍 Query limpia: '{QUERY}'")
+    logging.info(f"🔍 Búsqueda híbrida para: '{QUERY}'")
+    logging.info(f"🔍 Búsqueda híbrida '{QUERY}': {15} encontrados, {12} relevantes")
+    logging.info(f"🔍 Intención detectada: {'procedimiento'}")
+    logging.info(f"✂️ Contexto: {5321}/{10000} tokens, {8}/{12} chunks ({2} duplicados, {2} por URL), {3120} tokens ahorrados")
+    logging.info(f"📊 Relevance score: {0.87}")
+    logging.info(f"🤖 Respuesta generada ({1534} chars)")
+    logging.info("✅ Respuesta enviada a Teams")
+
+
+def request_after():
+    """Los mismos registros con el logging actual."""
+    app.request_id_var.set("bench")
+    logging.info("📩 Actividad %s recibida", "message", extra={
+        "activity_id": ACTIVITY["id"], "conversation_id": ACTIVITY["conversation"]["id"], "channel": "msteams",
+    })
+    app.log_payload("📩 Petición recibida", ACTIVITY)
+    logging.info("🔍 Query limpia: '%s'", QUERY)
+    logging.info("🔍 Búsqueda híbrida para: '%s'", QUERY)
+    logging.info("🔍 Búsqueda híbrida '%s': %d encontrados, %d relevantes", QUERY, 15, 12)
+    logging.info("🔍 Intención detectada: %s", "procedimiento")
+    logging.info("✂️ Contexto: %d/%d tokens, %d/%d chunks (%d duplicados, %d por URL), %d tokens ahorrados",
+                 5321, 10000, 8, 12, 2, 2, 3120)
+    logging.info("📊 Relevance score: %s", 0.87)
+    logging.info("🤖 Respuesta generada (%d chars)", 1534)
+    logging.info("✅ Respuesta enviada a Teams")
+    logging.info("✅ %s %s %d", "POST", "/api/messages", 201, extra={
+        "status": 201, "duration_ms": 2801.4, "timings_ms": {k: round(v * 1000, 1) for k, v in TIMINGS.items()},
+    })
+
+
+class CountingStream(io.TextIOBase):
+    """Destino que cuenta los bytes escritos (y opcionalmente los escribe en un fichero)."""
+
+    def __init__(self, target=None, latency=0.0):
+        self.target = target
+        self.latency = latency
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text.encode("utf-8"))
+        if self.latency:
+            time.sleep(self.latency)
+        if self.target is not None:
+            self.target.write(text)
+        return len(text)
+
+    def flush(self):
+        if self.target is not None:
+            self.target.flush()
+
+
+def run(emit, requests, interval):
+    per_request = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        emit()
+        per_request.append((time.perf_counter() - start) * 1e6)
+        if interval:
+            time.sleep(interval)
+    return np.array(per_request)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--sink", choices=["memory", "file"], default="memory")
+    parser.add_argument("--write-latency", type=float, default=0.0, help="Segundos de espera por escritura")
+    parser.add_argument("--interval", type=float, default=0.002, help="Segundos entre peticiones")
+    args = parser.parse_args()
+
+    sink_file = tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False) if args.sink == "file" else None
+    root = logging.getLogger()
+    results = {}
+
+    # 🔹 Antes: handler síncrono en el hilo de la petición
+    before_stream = CountingStream(sink_file, args.write_latency)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    logging.basicConfig(level=logging.INFO, stream=before_stream, force=True)
+    results["antes"] = (run(request_before, args.requests, args.interval), before_stream)
+
+    # 🔹 Después: cola + JSON en el hilo del listener
+    after_stream = CountingStream(sink_file, args.write_latency)
+    listener, handler = app.setup_logging(after_stream)
+    atexit.unregister(listener.stop)
+    start = time.perf_counter()
+    latencies = run(request_after, args.requests, args.interval)
+    listener.stop()  # espera a que el hilo termine de escribir
+    drain = time.perf_counter() - start
+    results["después"] = (latencies, after_stream)
+
+    print(f"\n📊 Logging de {args.requests} peticiones simuladas de /api/messages (destino: {args.sink})\n")
+    print(f"{'config':<10} {'µs/pet p50':>11} {'p99':>9} {'media':>9} {'bytes/pet':>10}")
+    for name, (values, stream) in results.items():
+        p50, p99 = np.percentile(values, [50, 99])
+        print(f"{name:<10} {p50:>11.1f} {p99:>9.1f} {values.mean():>9.1f} {stream.bytes / args.requests:>10.0f}")
+    print(f"\nEl listener terminó de escribir {drain:.2f}s después del inicio; registros descartados: {handler.dropped}")
+    if sink_file is not None:
+        sink_file.close()
+        os.unlink(sink_file.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+"""
+Ingesta incremental de Confluence en el índice de Azure Search.
+
+Lee las páginas de la API REST de Confluence (o de un export JSONL), las trocea en chunks de
+~3000 caracteres (el tamaño que espera el bot), calcula el embedding solo de los chunks cuyo
+contenido ha cambiado y los sube en lotes mergeOrUpload:
+  - cada chunk tiene una clave estable (<id de página>-<n>) y un hash de su contenido; los hashes
+    de lo ya subido se guardan en un SQLite local (--state), y un chunk con el mismo hash no se
+    vuelve a embeber ni a subir. Una página con la misma versión ni siquiera se trocea
+  - si una página se acorta se borran del índice sus chunks sobrantes; con --prune, al terminar
+    una pasada completa se borran las páginas que ya no existen
+  - los embeddings se piden en lotes (--embed-batch) con concurrencia acotada (--concurrency),
+    con los reintentos y circuit breakers de app.py
+  - el checkpoint guarda la posición de la primera página sin terminar: si la ingesta se
+    interrumpe, la siguiente ejecución continúa desde ahí
+
+Formato del export JSONL (una página por línea):
+    {"id": "123", "title": "...", "url": "https://...", "version": 7, "body": "<p>HTML storage</p>"}
+("content" con texto plano en vez de "body" también vale; "type" por defecto "page").
+
+Uso:
+    python ingest_confluence.py --confluence-url https://empresa.atlassian.net/wiki --space INFRA
+    python ingest_confluence.py --jsonl confluence_export.jsonl --prune
+    python ingest_confluence.py --confluence-url http://localhost:9000 --space MOCK   # stand-in de mock_azure.py
+
+Credenciales de Confluence: CONFLUENCE_USER + CONFLUENCE_API_TOKEN (Cloud) o CONFLUENCE_TOKEN (PAT de Data Center).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import uuid
+from collections import Counter
+from html.parser import HTMLParser
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+
+import app
+
+CHUNK_SIZE = 3000
+CHUNK_OVERLAP = 200
+KEY_PATTERN = re.compile(r"^[A-Za-z0-9_\-=]+$")
+RETRYABLE_ITEM_STATUS = {409, 422, 429, 503}  # fallos por documento que Azure recomienda reintentar
+
+
+# 🔹 HTML (formato storage de Confluence) → texto con algo de Markdown
+class StorageText(HTMLParser):
+    BLOCKS = {"p", "div", "br", "tr", "table", "ul", "ol", "blockquote", "pre", "section"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("ac:parameter", "script", "style"):
+            self._skip += 1
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            self.parts.append("\n\n" + "#" * int(tag[1]) + " ")
+        elif tag == "li":
+            self.parts.append("\n- ")
+        elif tag in ("td", "th"):
+            self.parts.append(" | ")
+        elif tag == "ac:plain-text-body":
+            self.parts.append("\n```\n")
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("ac:parameter", "script", "style"):
+            self._skip = max(0, self._skip - 1)
+        elif tag == "ac:plain-text-body":
+            self.parts.append("\n```\n")
+        elif tag in self.BLOCKS or tag.startswith("h") and tag[1:].isdigit():
+            self.parts.append("\n\n" if tag in ("p", "table", "ul", "ol", "pre") or tag.startswith("h") else "\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+    def unknown_decl(self, data):
+        # Los bloques de código vienen como <![CDATA[...]]> dentro de ac:plain-text-body
+        if data.startswith("CDATA[") and not self._skip:
+            self.parts.append(data[len("CDATA["):])
+
+
+def html_to_text(html: str) -> str:
+    parser = StorageText()
+    parser.feed(html)
+    parser.close()
+    text = "".join(parser.parts).replace("\xa0", " ")
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+def _split_long(paragraph: str, size: int) -> List[str]:
+    """Corta un párrafo más largo que size por frases y, si hace falta, por espacios."""
+    pieces, current = [], ""
+    for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+        while len(sentence) > size:
+            cut = sentence.rfind(" ", 0, size)
+            cut = cut if cut > size // 2 else size
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if current and len(current) + 1 + len(sentence) > size:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """
+    Agrupa párrafos en chunks de hasta size caracteres. Cada chunk empieza con los últimos
+    overlap caracteres del anterior (cortados en un espacio) si caben.
+    """
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if paragraph:
+            pieces.extend([paragraph] if len(paragraph) <= size else _split_long(paragraph, size))
+
+    chunks, current = [], ""
+    for piece in pieces:
+        if current and len(current) + 2 + len(piece) > size:
+            chunks.append(current)
+            tail = current[-overlap:] if overlap else ""
+            tail = tail[tail.find(" ") + 1:] if " " in tail else tail
+            current = f"{tail}\n\n{piece}" if tail and len(tail) + 2 + len(piece) <= size else piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def page_key(page_id: str) -> str:
+    """Las claves de Azure Search solo admiten letras, dígitos, _, - y =."""
+    return page_id if KEY_PATTERN.match(page_id) else hashlib.sha1(page_id.encode("utf-8")).hexdigest()[:20]
+
+
+def content_hash(doc: Dict) -> str:
+    raw = json.dumps(
+        [app.EMBEDDING_MODEL, app.EMBEDDING_DIMENSIONS, doc["title"], doc["url"], doc["type"], doc["content"]],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# 🔹 Estado local: hashes de lo subido, versión de cada página y checkpoint
+class IngestState:
+    def __init__(self, path: str, source: str):
+        self.source = source
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS chunks (key TEXT PRIMARY KEY, page_id TEXT NOT NULL, hash TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS chunks_page ON chunks(page_id);"
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "page_id TEXT PRIMARY KEY, version TEXT, chunks INTEGER NOT NULL, run_id TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "source TEXT PRIMARY KEY, run_id TEXT NOT NULL, position INTEGER NOT NULL, updated REAL NOT NULL);"
+        )
+
+    def checkpoint(self, restart: bool) -> Tuple[str, int]:
+        row = self.db.execute("SELECT run_id, position FROM checkpoints WHERE source = ?", (self.source,)).fetchone()
+        if row is None or restart:
+            return uuid.uuid4().hex, 0
+        return row[0], row[1]
+
+    def save_checkpoint(self, run_id: str, position: int):
+        self.db.execute(
+            "INSERT OR REPLACE INTO checkpoints (source, run_id, position, updated) VALUES (?, ?, ?, ?)",
+            (self.source, run_id, position, time.time()),
+        )
+        self.db.commit()
+
+    def finish(self):
+        self.db.execute("DELETE FROM checkpoints WHERE source = ?", (self.source,))
+        self.db.commit()
+
+    def page(self, page_id: str) -> Optional[Tuple[Optional[str], int]]:
+        return self.db.execute("SELECT version, chunks FROM pages WHERE page_id = ?", (page_id,)).fetchone()
+
+    def save_page(self, page_id: str, version: Optional[str], chunks: int, run_id: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO pages (page_id, version, chunks, run_id) VALUES (?, ?, ?, ?)",
+            (page_id, version, chunks, run_id),
+        )
+
+    def chunk_hashes(self, page_id: str) -> Dict[str, str]:
+        return dict(self.db.execute("SELECT key, hash FROM chunks WHERE page_id = ?", (page_id,)))
+
+    def save_chunk(self, key: str, page_id: str, digest: str):
+        self.db.execute("INSERT OR REPLACE INTO chunks (key, page_id, hash) VALUES (?, ?, ?)", (key, page_id, digest))
+
+    def delete_chunk(self, key: str):
+        self.db.execute("DELETE FROM chunks WHERE key = ?", (key,))
+
+    def stale_pages(self, run_id: str) -> List[str]:
+        return [row[0] for row in self.db.execute("SELECT page_id FROM pages WHERE run_id != ?", (run_id,))]
+
+    def delete_page(self, page_id: str):
+        self.db.execute("DELETE FROM pages WHERE page_id = ?", (page_id,))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+# 🔹 Fuentes: API REST de Confluence o export JSONL. Devuelven (posición, página)
+async def get_json(session: aiohttp.ClientSession, url: str, params: Dict, headers: Dict, retries: int = 5) -> Dict:
+    for attempt in range(retries + 1):
+        async with session.get(url, params=params, headers=headers) as response:
+            if response.status == 429 or response.status >= 500:
+                if attempt == retries:
+                    response.raise_for_status()
+                delay = float(response.headers.get("Retry-After") or 2 ** attempt)
+                print(f"🔁 Confluence respondió {response.status}, reintento en {delay:.0f}s")
+                await asyncio.sleep(delay)
+                continue
+            response.raise_for_status()
+            return await response.json()
+
+
+async def confluence_pages(base_url: str, space: str, start: int, page_size: int) -> AsyncIterator[Tuple[int, Dict]]:
+    headers = {"Accept": "application/json"}
+    auth = None
+    if os.getenv("CONFLUENCE_USER"):
+        auth = aiohttp.BasicAuth(os.getenv("CONFLUENCE_USER"), os.getenv("CONFLUENCE_API_TOKEN", ""))
+    elif os.getenv("CONFLUENCE_TOKEN"):
+        headers["Authorization"] = f"Bearer {os.getenv('CONFLUENCE_TOKEN')}"
+    url = f"{base_url.rstrip('/')}/rest/api/content"
+    position = start
+    async with aiohttp.ClientSession(auth=auth, timeout=aiohttp.ClientTimeout(total=120)) as session:
+        while True:
+            params = {"spaceKey": space, "type": "page", "status": "current",
+                      "expand": "body.storage,version", "start": position, "limit": page_size}
+            data = await get_json(session, url, params, headers)
+            results = data.get("results", [])
+            link_base = data.get("_links", {}).get("base") or base_url.rstrip("/")
+            for result in results:
+                yield position, {
+                    "id": str(result["id"]),
+                    "title": result.get("title", ""),
+                    "url": link_base + result.get("_links", {}).get("webui", f"/pages/{result['id']}"),
+                    "version": str(result.get("version", {}).get("number", "")) or None,
+                    "body": result.get("body", {}).get("storage", {}).get("value", ""),
+                    "type": result.get("type", "page"),
+                }
+                position += 1
+            if not results or not data.get("_links", {}).get("next"):
+                return
+
+
+async def jsonl_pages(path: str, start: int) -> AsyncIterator[Tuple[int, Dict]]:
+    with open(path, encoding="utf-8") as f:
+        position = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if position >= start:
+                page = json.loads(line)
+                page["id"] = str(page["id"])
+                page["version"] = str(page["version"]) if page.get("version") is not None else None
+                yield position, page
+            position += 1
+            if position % 100 == 0:
+                await asyncio.sleep(0)
+
+
+class Ingestor:
+    """
+    Pipeline en tres etapas unidas por colas acotadas (la memoria no crece con el tamaño del espacio):
+    trocear y comparar hashes → embeddings en lotes (N workers) → subida en lotes (1 worker).
+    Una página está terminada cuando todas sus acciones (subidas y borrados) han respondido;
+    el checkpoint avanza hasta la primera página sin terminar o con errores.
+    """
+
+    def __init__(self, args, state: IngestState, run_id: str, start: int):
+        self.args = args
+        self.state = state
+        self.run_id = run_id
+        self.embed_queue: asyncio.Queue = asyncio.Queue(maxsize=args.concurrency * 2)
+        self.upload_queue: asyncio.Queue = asyncio.Queue(maxsize=args.upload_batch * 2)
+        self._embed_buffer: List[Tuple[int, Dict]] = []
+        self._pending: Dict[int, Dict] = {}
+        self._finished: Dict[int, bool] = {}
+        self.watermark = start
+        self.first_failed: Optional[int] = None
+        self.stats = Counter()
+        self.started = time.perf_counter()
+
+    # 🔹 Etapa 1: trocear y decidir qué cambia
+    async def process_page(self, position: int, page: Dict):
+        self.stats["pages"] += 1
+        page_id = page["id"]
+        previous = self.state.page(page_id)
+        if previous is not None and page.get("version") and previous[0] == page["version"] and not self.args.force:
+            self.stats["chunks"] += previous[1]
+            self.stats["skipped"] += previous[1]
+            self.state.save_page(page_id, page["version"], previous[1], self.run_id)
+            self._complete(position, ok=True)
+            return
+
+        text = html_to_text(page["body"]) if page.get("body") else (page.get("content") or "").strip()
+        contents = chunk_text(text, self.args.chunk_size, self.args.overlap)
+        hashes = self.state.chunk_hashes(page_id)
+        actions = []
+        for i, content in enumerate(contents):
+            doc = {
+                self.args.key_field: f"{page_key(page_id)}-{i}",
+                "title": page.get("title", ""),
+                "content": content,
+                "url": page.get("url", ""),
+                "type": page.get("type") or "page",
+            }
+            digest = content_hash(doc)
+            if hashes.get(doc[self.args.key_field]) == digest and not self.args.force:
+                self.stats["skipped"] += 1
+            else:
+                actions.append(("embed", doc, digest))
+        self.stats["chunks"] += len(contents)
+        current_keys = {f"{page_key(page_id)}-{i}" for i in range(len(contents))}
+        for key in hashes.keys() - current_keys:
+            actions.append(("delete", {"@search.action": "delete", self.args.key_field: key}, None))
+
+        self._pending[position] = {"remaining": len(actions), "ok": True, "page": (page_id, page.get("version"), len(contents))}
+        if not actions:
+            self._complete(position, ok=True)
+            return
+        for kind, doc, digest in actions:
+            item = {"position": position, "page_id": page_id, "doc": doc, "hash": digest}
+            if kind == "delete":
+                await self.upload_queue.put(item)
+                continue
+            self._embed_buffer.append(item)
+            if len(self._embed_buffer) >= self.args.embed_batch:
+                await self.flush_embeddings()
+
+    async def flush_embeddings(self):
+        if self._embed_buffer:
+            await self.embed_queue.put(self._embed_buffer)
+            self._embed_buffer = []
+
+    # 🔹 Etapa 2: embeddings en lotes
+    async def embed_worker(self):
+        while True:
+            batch = await self.embed_queue.get()
+            if batch is None:
+                return
+            texts = [app.clean_embedding_input(f"{item['doc']['title']}\n\n{item['doc']['content']}") for item in batch]
+            try:
+                result = await self.embed(texts)
+            except Exception as e:
+                print(f"❌ Error generando {len(batch)} embeddings: {e!r}")
+                self.stats["failed"] += len(batch)
+                for item in batch:
+                    self._done(item["position"], ok=False)
+                continue
+            self.stats["embedded"] += len(batch)
+            self.stats["tokens"] += result.usage.total_tokens
+            for data in result.data:
+                item = batch[data.index]
+                item["doc"]["@search.action"] = "mergeOrUpload"
+                item["doc"]["content_vector"] = data.embedding
+                await self.upload_queue.put(item)
+
+    async def embed(self, texts: List[str]):
+        """Con el circuito abierto o Azure limitando, la ingesta espera en vez de fallar (es un proceso batch)."""
+        for attempt in range(self.args.max_waits + 1):
+            try:
+                return await app.call_upstream("embedding", lambda: app.get_openai_client().embeddings.create(
+                    model=app.EMBEDDING_MODEL, input=texts, dimensions=app.EMBEDDING_DIMENSIONS
+                ))
+            except app.UpstreamThrottled as e:
+                if attempt == self.args.max_waits:
+                    raise
+                delay = e.retry_after or app.BREAKER_OPEN_SECONDS
+                print(f"⏳ Embeddings limitados ({e.upstream}), esperando {delay:.0f}s")
+                await asyncio.sleep(delay)
+
+    # 🔹 Etapa 3: subida a Azure Search en lotes mergeOrUpload
+    async def upload_worker(self):
+        """Sube cada lote completo, o lo acumulado si la cola lleva 1 s sin recibir nada."""
+        batch: List[Dict] = []
+        getter: Optional[asyncio.Future] = None
+        try:
+            while True:
+                # 🔹 El get() pendiente se conserva entre esperas: cancelarlo podría perder un elemento
+                getter = getter or asyncio.ensure_future(self.upload_queue.get())
+                done, _ = await asyncio.wait({getter}, timeout=1.0)
+                if not done:
+                    await self.upload(batch)
+                    batch = []
+                    continue
+                item, getter = getter.result(), None
+                if item is None:
+                    self.upload_queue.task_done()
+                    break
+                batch.append(item)
+                if len(batch) >= self.args.upload_batch:
+                    await self.upload(batch)
+                    batch = []
+            await self.upload(batch)
+        finally:
+            if getter is not None:
+                getter.cancel()
+
+    async def upload(self, batch: List[Dict]):
+        if not batch:
+            return
+        url = f"{app.AZURE_SEARCH_ENDPOINT}/indexes/{app.INDEX_NAME}/docs/index?api-version=2024-07-01"
+        headers = {"Content-Type": "application/json", "api-key": app.AZURE_SEARCH_API_KEY}
+        remaining = {item["doc"][self.args.key_field]: item for item in batch}
+        errors: Dict[str, str] = {}
+
+        async def post(actions):
+            async with app.http_session.post(url, headers=headers, json={"value": actions}) as response:
+                if response.status >= 400:
+                    raise app.SearchHTTPError(response.status, await response.text(), dict(response.headers))
+                return (await response.json()).get("value", [])
+
+        # 🔹 Los errores HTTP se reintentan en call_upstream; aquí, los fallos parciales (207) por documento
+        for attempt in range(3):
+            actions = [item["doc"] for item in remaining.values()]
+            try:
+                results = await app.call_upstream("search_index", lambda: post(actions))
+            except Exception as e:
+                errors.update({key: repr(e) for key in remaining})
+                break
+            retry = {}
+            answered = set()
+            for result in results:
+                item = remaining.get(result.get("key"))
+                if item is None:
+                    continue
+                answered.add(result["key"])
+                if result.get("status"):
+                    errors.pop(result["key"], None)
+                    self._uploaded(item)
+                    continue
+                errors[result["key"]] = result.get("errorMessage") or str(result.get("statusCode"))
+                if result.get("statusCode") in RETRYABLE_ITEM_STATUS:
+                    retry[result["key"]] = item
+            # 🔹 Una respuesta incompleta no puede dejar chunks sin terminar (la página no cerraría nunca)
+            for key, item in remaining.items():
+                if key not in answered:
+                    errors[key] = "sin resultado en la respuesta de Azure"
+                    retry[key] = item
+            remaining = retry
+            if not remaining:
+                break
+            await asyncio.sleep(2 ** attempt)
+
+        by_key = {item["doc"][self.args.key_field]: item for item in batch}
+        for key, error in errors.items():
+            print(f"❌ {key}: {error}")
+            self.stats["failed"] += 1
+            self._done(by_key[key]["position"], ok=False)
+        self.state.save_checkpoint(self.run_id, self.watermark)
+        for _ in batch:
+            self.upload_queue.task_done()
+
+    def _uploaded(self, item: Dict):
+        key = item["doc"][self.args.key_field]
+        if item["hash"] is None:
+            self.state.delete_chunk(key)
+            self.stats["deleted"] += 1
+        else:
+            self.state.save_chunk(key, item["page_id"], item["hash"])
+            self.stats["uploaded"] += 1
+        self._done(item["position"], ok=True)
+
+    # 🔹 Seguimiento de páginas terminadas y checkpoint
+    def _done(self, position: int, ok: bool):
+        pending = self._pending[position]
+        pending["remaining"] -= 1
+        pending["ok"] = pending["ok"] and ok
+        if pending["remaining"] <= 0:
+            self._complete(position, pending["ok"])
+
+    def _complete(self, position: int, ok: bool):
+        pending = self._pending.pop(position, None)
+        if ok and pending is not None:
+            if pending.get("pruned"):
+                self.state.delete_page(pending["pruned"])
+            else:
+                self.state.save_page(*pending["page"], self.run_id)
+        if position < 0:
+            return
+        if not ok:
+            self.first_failed = position if self.first_failed is None else min(self.first_failed, position)
+        self._finished[position] = ok
+        while self._finished.get(self.watermark):
+            del self._finished[self.watermark]
+            self.watermark += 1
+
+    async def prune(self) -> int:
+        """Borra del índice los chunks de las páginas que no han aparecido en esta pasada."""
+        stale = self.state.stale_pages(self.run_id)
+        for i, page_id in enumerate(stale):
+            position = -1 - i  # posiciones negativas: no cuentan para el checkpoint
+            keys = list(self.state.chunk_hashes(page_id))
+            self._pending[position] = {"remaining": len(keys), "ok": True, "pruned": page_id}
+            if not keys:
+                self._complete(position, ok=True)
+            for key in keys:
+                await self.upload_queue.put({"position": position, "page_id": page_id, "hash": None,
+                                             "doc": {"@search.action": "delete", self.args.key_field: key}})
+        return len(stale)
+
+    def progress(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        s = self.stats
+        return (
+            f"{s['pages']} páginas, {s['chunks']} chunks ({s['skipped']} sin cambios, {s['embedded']} embebidos, "
+            f"{s['uploaded']} subidos, {s['deleted']} borrados, {s['failed']} con error) en {elapsed:.1f}s → "
+            f"{s['chunks'] / elapsed if elapsed else 0:.1f} chunks/s, {s['embedded'] / elapsed if elapsed else 0:.1f} embebidos/s"
+        )
+
+
+async def report_progress(ingestor: Ingestor, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        print(f"⏱️ {ingestor.progress()}", flush=True)
+
+
+async def run(args):
+    source = f"api:{args.confluence_url}:{args.space}" if args.confluence_url else f"jsonl:{os.path.abspath(args.jsonl)}"
+    state = IngestState(args.state or f"ingest_state_{app.INDEX_NAME}.sqlite", source)
+    run_id, start = state.checkpoint(args.restart)
+    if start:
+        print(f"↪️ Continuando la ingesta desde la página {start}")
+    await app.startup()
+    ingestor = Ingestor(args, state, run_id, start)
+    workers = [asyncio.create_task(ingestor.embed_worker()) for _ in range(args.concurrency)]
+    uploader = asyncio.create_task(ingestor.upload_worker())
+    reporter = asyncio.create_task(report_progress(ingestor, args.progress))
+    try:
+        pages = (confluence_pages(args.confluence_url, args.space, start, args.page_size)
+                 if args.confluence_url else jsonl_pages(args.jsonl, start))
+        async for position, page in pages:
+            await ingestor.process_page(position, page)
+        await ingestor.flush_embeddings()
+        for _ in workers:
+            await ingestor.embed_queue.put(None)
+        await asyncio.gather(*workers)
+        await ingestor.upload_queue.join()
+
+        complete = ingestor.first_failed is None
+        if args.prune and complete:
+            print(f"🧹 {await ingestor.prune()} páginas eliminadas de Confluence")
+            await ingestor.upload_queue.join()
+        await ingestor.upload_queue.put(None)
+        await uploader
+        if complete:
+            state.finish()
+        else:
+            state.save_checkpoint(run_id, ingestor.watermark)
+            print(f"⚠️ Hubo errores: la próxima ejecución continuará desde la página {ingestor.watermark}")
+    finally:
+        reporter.cancel()
+        for task in workers + [uploader]:
+            task.cancel()
+        state.close()
+        await app.shutdown()
+    print(f"\n📊 {ingestor.progress()}\n   Tokens de embedding: {ingestor.stats['tokens']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--confluence-url", help="URL base de Confluence (p.ej. https://empresa.atlassian.net/wiki)")
+    source.add_argument("--jsonl", help="Export de páginas en JSONL")
+    parser.add_argument("--space", help="Clave del espacio de Confluence (con --confluence-url)")
+    parser.add_argument("--state", help="SQLite con hashes y checkpoint (por defecto ingest_state_<índice>.sqlite)")
+    parser.add_argument("--key-field", default="id", help="Campo clave del índice")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Caracteres máximos por chunk")
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP, help="Caracteres repetidos del chunk anterior")
+    parser.add_argument("--embed-batch", type=int, default=16, help="Chunks por llamada de embeddings")
+    parser.add_argument("--concurrency", type=int, default=4, help="Llamadas de embeddings simultáneas")
+    parser.add_argument("--upload-batch", type=int, default=100, help="Documentos por lote mergeOrUpload (~35 KB cada uno)")
+    parser.add_argument("--page-size", type=int, default=50, help="Páginas por petición a Confluence")
+    parser.add_argument("--max-waits", type=int, default=10, help="Esperas por throttling antes de dar un lote por fallido")
+    parser.add_argument("--progress", type=float, default=10, help="Segundos entre líneas de progreso")
+    parser.add_argument("--force", action="store_true", help="Reprocesar aunque el hash o la versión no hayan cambiado")
+    parser.add_argument("--restart", action="store_true", help="Ignorar el checkpoint y empezar desde la primera página")
+    parser.add_argument("--prune", action="store_true", help="Borrar del índice las páginas que ya no existen")
+    args = parser.parse_args()
+    if args.confluence_url and not args.space:
+        parser.error("--space es obligatorio con --confluence-url")
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("\n⏹️ Ingesta interrumpida: la próxima ejecución continuará desde el último checkpoint")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Comparativa offline del clasificador de intención local frente al LLM.
+
+Para cada query del fichero JSONL ({"query": ..., "intent": ...}; "intent" opcional) mide
+la etiqueta y la latencia de:
+  - palabras clave (classify_intent_keywords)
+  - centroides sobre el embedding (si hay INTENT_CENTROIDS_PATH)
+  - LLM (detect_intent_openai, AZURE_OPENAI_DEPLOYMENT_INTENT)
+  - hybrid: la decisión que tomaría detect_intent con INTENT_MODE=hybrid
+Si las queries no traen etiqueta, la referencia es la respuesta del LLM.
+
+Con --build-centroids se calculan los centroides (media normalizada de los embeddings por
+intención) y se guardan en un .npz para INTENT_CENTROIDS_PATH. Conviene evaluar los
+centroides con un fichero distinto del usado para construirlos.
+
+Uso:
+    python intent_eval.py intent_samples.jsonl
+    python intent_eval.py intent_samples.jsonl --build-centroids intent_centroids.npz
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import app
+
+
+def load_samples(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return float(np.percentile(np.array(values), p))
+
+
+async def evaluate(samples, use_llm=True):
+    rows = []
+    for sample in samples:
+        query = sample["query"]
+        row = {"query": query, "label": sample.get("intent")}
+
+        start = time.perf_counter()
+        row["keywords"], row["confidence"] = app.classify_intent_keywords(query)
+        row["keywords_ms"] = (time.perf_counter() - start) * 1000
+
+        row["embedding"] = await app.generate_embedding(query)
+        if app.intent_centroids is not None:
+            start = time.perf_counter()
+            result = app.intent_centroids.classify(row["embedding"])
+            row["centroid_ms"] = (time.perf_counter() - start) * 1000
+            row["centroid"], row["margin"] = result if result else (None, 0.0)
+
+        if use_llm:
+            start = time.perf_counter()
+            row["llm"] = await app.detect_intent_openai(query)
+            row["llm_ms"] = (time.perf_counter() - start) * 1000
+
+        # 🔹 Misma decisión que detect_intent en modo hybrid
+        if row["confidence"] >= app.INTENT_KEYWORD_MIN_CONFIDENCE:
+            row["hybrid"], row["escalated"] = row["keywords"], False
+        elif row.get("centroid") and row["margin"] >= app.INTENT_CENTROID_MIN_MARGIN:
+            row["hybrid"], row["escalated"] = row["centroid"], False
+        else:
+            # sin --llm no hay a quién escalar: se queda con las palabras clave (como INTENT_MODE=local)
+            row["hybrid"], row["escalated"] = row.get("llm", row["keywords"]), True
+
+        if row["label"] is None:
+            row["label"] = row.get("llm")
+        rows.append(row)
+    return rows
+
+
+def report(rows):
+    print(f"\n📊 {len(rows)} queries evaluadas\n")
+    print(f"{'clasificador':<12} {'acierto':>8} {'p50 ms':>9} {'p95 ms':>9}")
+    for name in ("keywords", "centroid", "llm", "hybrid"):
+        labelled = [row for row in rows if row.get(name) and row["label"]]
+        if not labelled:
+            continue
+        accuracy = sum(row[name] == row["label"] for row in labelled) / len(labelled)
+        latencies = [row[f"{name}_ms"] for row in labelled if f"{name}_ms" in row]
+        if name == "hybrid":
+            latencies = [
+                row.get("llm_ms", 0.0) if row["escalated"] else row["keywords_ms"] for row in labelled
+            ]
+        print(f"{name:<12} {accuracy:>8.1%} {percentile(latencies, 50):>9.2f} {percentile(latencies, 95):>9.2f}")
+
+    escalated = sum(row["escalated"] for row in rows)
+    print(f"\n🔁 hybrid escala al LLM en {escalated}/{len(rows)} queries ({escalated / len(rows):.0%})")
+
+    misses = [row for row in rows if row.get("hybrid") and row["label"] and row["hybrid"] != row["label"]]
+    for row in misses:
+        print(f"   ❌ '{row['query']}' → {row['hybrid']} (esperado {row['label']})")
+
+
+def build_centroids(rows, path):
+    by_intent = {}
+    for row in rows:
+        if row["label"] and row["embedding"].any():
+            by_intent.setdefault(row["label"], []).append(row["embedding"])
+    labels = sorted(by_intent)
+    centroids = np.stack([np.mean(by_intent[label], axis=0) for label in labels]).astype(np.float32)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+    np.savez(path, labels=np.array(labels), centroids=centroids)
+    print(f"\n🧭 Centroides guardados en {path}: " + ", ".join(f"{l} ({len(by_intent[l])})" for l in labels))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("samples", help="Fichero JSONL con queries (y opcionalmente su intención)")
+    parser.add_argument("--no-llm", action="store_true", help="No llamar al LLM (solo clasificadores locales)")
+    parser.add_argument("--build-centroids", metavar="NPZ", help="Guardar centroides de intención en este fichero")
+    args = parser.parse_args()
+
+    await app.startup()
+    try:
+        rows = await evaluate(load_samples(args.samples), use_llm=not args.no_llm)
+        report(rows)
+        if args.build_centroids:
+            build_centroids(rows, args.build_centroids)
+    finally:
+        await app.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
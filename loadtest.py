@@ -0,0 +1,156 @@
+"""
+Generador de carga para confubot: /api/ask o /api/messages a un ritmo objetivo (RPS).
+
+Las llegadas son en lazo abierto (una petición cada 1/RPS segundos, independientemente de
+lo que tarden las anteriores), así la latencia refleja las colas del servidor. Al terminar
+se informa de p50/p95/p99, throughput, rechazos por rate limit (429) y errores por código HTTP.
+
+Todas las peticiones a /api/ask van con el mismo usuario de Basic Auth: el servidor debe
+arrancar con USER_RATE_LIMIT_PER_MINUTE=0 o el rate limit por usuario rechazará casi todas.
+
+/api/messages requiere el bot con la autenticación de Bot Framework desactivada (BOT_APP_ID
+vacío); las respuestas del bot se envían a --service-url (p.ej. mock_azure.py).
+
+Uso:
+    python mock_azure.py --port 9000 &
+    AZURE_SEARCH_ENDPOINT=http://localhost:9000 AZURE_OPENAI_ENDPOINT=http://localhost:9000 \\
+        USER_RATE_LIMIT_PER_MINUTE=0 hypercorn app:app --bind 0.0.0.0:8000 --workers 2 &
+    python loadtest.py --endpoint ask --rps 20 --duration 60
+    python loadtest.py --endpoint ask --stream --rps 20 --duration 60   # mide también TTFT
+    python loadtest.py --endpoint messages --service-url http://localhost:9000 --rps 10
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+import aiohttp
+import numpy as np
+
+DEFAULT_QUERIES = [
+    "¿Cómo configuro la VPN?",
+    "Resume la arquitectura del servicio de pagos",
+    "Lista los servidores de preproducción",
+    "¿Cuál es la URL de Jenkins?",
+    "Pasos para desplegar en producción",
+]
+
+
+def load_queries(path):
+    if not path:
+        return DEFAULT_QUERIES
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["query"] for line in f if line.strip()]
+
+
+def ask_request(args, query):
+    body = {"messages": [{"role": "user", "content": query}]}
+    if args.stream:
+        body["stream"] = True
+    return f"{args.url}/api/ask", body
+
+
+def messages_request(args, query):
+    conversation_id = f"loadtest-{random.randint(1, args.conversations)}"
+    body = {
+        "type": "message",
+        "id": uuid.uuid4().hex,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        "serviceUrl": args.service_url,
+        "channelId": "msteams",
+        "from": {"id": f"user-{conversation_id}", "name": "Load Test"},
+        "conversation": {"id": conversation_id},
+        "recipient": {"id": "confubot", "name": "confubot"},
+        "text": query,
+    }
+    return f"{args.url}/api/messages", body
+
+
+async def send(session, args, query, results):
+    url, body = (ask_request if args.endpoint == "ask" else messages_request)(args, query)
+    start = time.perf_counter()
+    ttft = None
+    try:
+        async with session.post(url, json=body) as response:
+            if args.stream and response.status == 200:
+                async for line in response.content:
+                    if ttft is None and line.startswith(b"data:") and b'"content"' in line:
+                        ttft = time.perf_counter() - start
+            else:
+                await response.read()
+            status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status = type(e).__name__
+    results.append({"status": status, "latency": time.perf_counter() - start, "ttft": ttft})
+
+
+def percentiles(values):
+    if not values:
+        return "-"
+    p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+    return f"p50={p50:.0f}ms p95={p95:.0f}ms p99={p99:.0f}ms"
+
+
+def report(args, results, elapsed):
+    ok = [r for r in results if r["status"] in (200, 201)]
+    limited = sum(r["status"] == 429 for r in results)
+    statuses = Counter(str(r["status"]) for r in results)
+    print(f"\n📊 /api/{args.endpoint} — objetivo {args.rps} RPS durante {args.duration}s")
+    print(f"   Peticiones: {len(results)} | OK: {len(ok)} | Rate limit (429): {limited} | "
+          f"Errores: {len(results) - len(ok) - limited} | Throughput: {len(ok) / elapsed:.1f} resp/s")
+    if limited and args.endpoint == "ask":
+        print("   ⚠️ Respuestas 429: arranca el servidor con USER_RATE_LIMIT_PER_MINUTE=0 para medir capacidad")
+    print(f"   Latencia (OK): {percentiles([r['latency'] for r in ok])}")
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    if ttfts:
+        print(f"   TTFT:          {percentiles(ttfts)}")
+    print(f"   Códigos: {dict(statuses)}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--endpoint", choices=["ask", "messages"], default="ask")
+    parser.add_argument("--rps", type=float, default=10.0, help="Peticiones por segundo objetivo")
+    parser.add_argument("--duration", type=float, default=30.0, help="Duración de la prueba en segundos")
+    parser.add_argument("--queries", help="JSONL con un campo 'query' por línea (p.ej. intent_samples.jsonl)")
+    parser.add_argument("--stream", action="store_true", help="Usar stream=true en /api/ask y medir TTFT")
+    parser.add_argument("--user", default="admin", help="Usuario Basic Auth de /api/ask")
+    parser.add_argument("--password", default="password", help="Password Basic Auth de /api/ask")
+    parser.add_argument("--service-url", default="http://localhost:9000", help="serviceUrl para /api/messages")
+    parser.add_argument("--conversations", type=int, default=50, help="Conversaciones distintas en /api/messages")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+    args.url = args.url.rstrip("/")
+
+    queries = load_queries(args.queries)
+    results = []
+    tasks = []
+    headers = {}
+    if args.endpoint == "ask":
+        credentials = base64.b64encode(f"{args.user}:{args.password}".encode("utf-8")).decode("ascii")
+        headers["Authorization"] = f"Basic {credentials}"
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    async with aiohttp.ClientSession(headers=headers, connector=connector, timeout=timeout) as session:
+        print(f"🚀 {args.rps} RPS contra {args.url}/api/{args.endpoint} durante {args.duration}s")
+        start = time.perf_counter()
+        interval = 1.0 / args.rps
+        sent = 0
+        while (next_at := start + sent * interval) < start + args.duration:
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            tasks.append(asyncio.create_task(send(session, args, random.choice(queries), results)))
+            sent += 1
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    report(args, results, elapsed)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,376 @@
+"""
+Motor de recuperación híbrida local: BM25 + búsqueda vectorial fusionadas con RRF.
+
+Se construye a partir de un export del índice de Azure Search (JSONL con title, content, url,
+type y content_vector) y puede servir de fallback cuando Azure Search falla o de capa primaria
+(LOCAL_INDEX_PATH / LOCAL_INDEX_MODE en app.py).
+
+Formato en disco (un directorio):
+  - meta.json                      documentos, dimensiones, parámetros BM25 e IVF
+  - docs.jsonl + docs_offsets.npy  metadatos de cada documento (title, content, url, type)
+  - terms.json, idf.npy, postings_*.npy   índice invertido BM25 en formato CSR
+  - vectors.npy                    matriz float32 N×D normalizada
+  - ivf_*.npy                      (opcional) centroides y listas invertidas IVF
+
+Todo se abre con mmap y de forma perezosa (en la primera búsqueda): los workers de hypercorn
+comparten las páginas de la caché del sistema operativo en vez de tener una copia cada uno.
+
+Uso:
+    python local_index.py export --out snapshot.jsonl
+    python local_index.py build snapshot.jsonl --out ./local_index [--ivf-lists 256]
+    python local_index.py search ./local_index "¿Cómo configuro la VPN?"
+"""
+import argparse
+import asyncio
+import json
+import logging
+import mmap
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+RRF_K = 60  # misma constante que usa Azure Search en la fusión híbrida
+BM25_K1 = 1.2
+BM25_B = 0.75
+METADATA_FIELDS = ("title", "content", "url", "type")
+SIMILARITY_FIELD = "@vector.similarity"
+VECTOR_FIELD = "@vector"  # vector normalizado del chunk (float16), solo para uso interno
+
+STOPWORDS = set(
+    "a al algo como con cual cuales cuando de del donde el en es esta este esto la las le lo los me mi "
+    "mas no o para pero por que quien se si sin sobre su sus te tu un una uno y ya the of to and is in".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Minúsculas, sin acentos, palabras de 2+ caracteres y sin stopwords."""
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    normalized = "".join(c for c in normalized if not unicodedata.combining(c))
+    return [t for t in re.findall(r"\w+", normalized) if len(t) > 1 and t not in STOPWORDS]
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+def _kmeans(vectors: np.ndarray, lists: int, iterations: int = 10, sample: int = 50000, seed: int = 42) -> np.ndarray:
+    """K-means esférico sencillo (producto escalar) para los centroides IVF."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[rng.choice(len(vectors), sample, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(lists):
+            members = vectors[assignment == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = _normalize_rows(centroids)
+    return centroids
+
+
+def build_index(snapshot_path: str, out_dir: str, ivf_lists: int = 0):
+    """Construye el índice local a partir del JSONL exportado."""
+    os.makedirs(out_dir, exist_ok=True)
+    offsets = []
+    vectors = []
+    postings: Dict[str, List] = {}
+    doc_lengths = []
+
+    with open(snapshot_path, encoding="utf-8") as src, open(os.path.join(out_dir, "docs.jsonl"), "wb") as docs:
+        for line in src:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            doc_id = len(offsets)
+            offsets.append(docs.tell())
+            docs.write(json.dumps({k: doc.get(k) for k in METADATA_FIELDS}, ensure_ascii=False).encode("utf-8") + b"\n")
+
+            tokens = tokenize(f"{doc.get('title') or ''} {doc.get('content') or ''}")
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, tf))
+            vectors.append(doc.get("content_vector"))
+        offsets.append(docs.tell())
+
+    count = len(doc_lengths)
+    if not count:
+        raise ValueError(f"{snapshot_path} no contiene documentos")
+
+    # 🔹 BM25: se precalcula la parte de cada posting que no depende de la query
+    lengths = np.asarray(doc_lengths, dtype=np.float32)
+    avgdl = float(lengths.mean()) or 1.0
+    terms = sorted(postings)
+    indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    for i, term in enumerate(terms):
+        indptr[i + 1] = indptr[i] + len(postings[term])
+    posting_docs = np.empty(indptr[-1], dtype=np.int32)
+    posting_tf = np.empty(indptr[-1], dtype=np.float32)
+    for i, term in enumerate(terms):
+        entries = np.asarray(postings[term], dtype=np.int64)
+        posting_docs[indptr[i]:indptr[i + 1]] = entries[:, 0]
+        posting_tf[indptr[i]:indptr[i + 1]] = entries[:, 1]
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[posting_docs] / avgdl)
+    posting_weights = (posting_tf * (BM25_K1 + 1) / (posting_tf + norm)).astype(np.float32)
+    df = np.diff(indptr).astype(np.float32)
+    idf = np.log(1 + (count - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    np.save(os.path.join(out_dir, "docs_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(out_dir, "idf.npy"), idf)
+    np.save(os.path.join(out_dir, "postings_indptr.npy"), indptr)
+    np.save(os.path.join(out_dir, "postings_docs.npy"), posting_docs)
+    np.save(os.path.join(out_dir, "postings_weights.npy"), posting_weights)
+    with open(os.path.join(out_dir, "terms.json"), "w", encoding="utf-8") as f:
+        json.dump(terms, f, ensure_ascii=False)
+
+    # 🔹 Vectores (opcionales: sin content_vector el índice es solo BM25)
+    dimensions = 0
+    if all(v is not None for v in vectors):
+        matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+        dimensions = matrix.shape[1]
+        np.save(os.path.join(out_dir, "vectors.npy"), matrix)
+        if ivf_lists:
+            ivf_lists = min(ivf_lists, count)
+            centroids = _kmeans(matrix, ivf_lists)
+            assignment = np.concatenate([
+                np.argmax(matrix[i:i + 10000] @ centroids.T, axis=1) for i in range(0, count, 10000)
+            ])
+            order = np.argsort(assignment, kind="stable").astype(np.int32)
+            ivf_indptr = np.searchsorted(assignment[order], np.arange(ivf_lists + 1)).astype(np.int64)
+            np.save(os.path.join(out_dir, "ivf_centroids.npy"), centroids)
+            np.save(os.path.join(out_dir, "ivf_indptr.npy"), ivf_indptr)
+            np.save(os.path.join(out_dir, "ivf_ids.npy"), order)
+    else:
+        ivf_lists = 0
+        logging.warning("⚠️ Hay documentos sin content_vector: el índice local solo tendrá BM25")
+
+    meta = {"documents": count, "dimensions": dimensions, "terms": len(terms), "avgdl": avgdl,
+            "k1": BM25_K1, "b": BM25_B, "ivf_lists": ivf_lists}
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class LocalIndex:
+    """
+    Índice híbrido local en modo solo lectura. search() devuelve documentos con el mismo
+    formato que Azure Search ("@search.score" = puntuación RRF), así que el resto del
+    pipeline no distingue el origen. Es síncrono y sin estado mutable tras cargar:
+    se puede llamar desde varios hilos (asyncio.to_thread).
+    """
+
+    def __init__(self, path: str, nprobe: int = 8):
+        self.path = path
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load_npy(self, name: str) -> Optional[np.ndarray]:
+        path = self._file(name)
+        return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+    def load(self):
+        """Abre los ficheros (mmap) la primera vez que se usa el índice."""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with open(self._file("meta.json"), encoding="utf-8") as f:
+                self.meta = json.load(f)
+            with open(self._file("terms.json"), encoding="utf-8") as f:
+                self._term_ids = {term: i for i, term in enumerate(json.load(f))}
+            with open(self._file("docs.jsonl"), "rb") as f:
+                self._docs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._offsets = self._load_npy("docs_offsets.npy")
+            self._idf = self._load_npy("idf.npy")
+            self._indptr = self._load_npy("postings_indptr.npy")
+            self._posting_docs = self._load_npy("postings_docs.npy")
+            self._posting_weights = self._load_npy("postings_weights.npy")
+            self._vectors = self._load_npy("vectors.npy")
+            self._ivf_centroids = self._load_npy("ivf_centroids.npy")
+            self._ivf_indptr = self._load_npy("ivf_indptr.npy")
+            self._ivf_ids = self._load_npy("ivf_ids.npy")
+            self._loaded = True
+            logging.info(
+                "📚 Índice local cargado: %s documentos, %s términos, %s",
+                self.meta["documents"], self.meta["terms"],
+                f"IVF {self.meta['ivf_lists']} listas" if self._ivf_centroids is not None else "fuerza bruta",
+            )
+
+    @property
+    def dimensions(self) -> int:
+        self.load()
+        return self.meta["dimensions"]
+
+    def document(self, doc_id: int) -> Dict:
+        start, end = int(self._offsets[doc_id]), int(self._offsets[doc_id + 1])
+        return json.loads(self._docs[start:end])
+
+    @staticmethod
+    def _top(scores: np.ndarray, ids: Optional[np.ndarray], k: int) -> np.ndarray:
+        """ids de los k mejores scores, ordenados de mayor a menor."""
+        k = min(k, len(scores))
+        if k == 0:
+            return np.empty(0, dtype=np.int64)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return ids[best] if ids is not None else best
+
+    def search_bm25(self, query: str, k: int = 50) -> np.ndarray:
+        self.load()
+        scores = np.zeros(self.meta["documents"], dtype=np.float32)
+        matched = False
+        for term in set(tokenize(query)):
+            term_id = self._term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self._indptr[term_id], self._indptr[term_id + 1]
+            # dentro de un término cada documento aparece una sola vez: la suma con índices es segura
+            scores[self._posting_docs[start:end]] += self._idf[term_id] * self._posting_weights[start:end]
+            matched = True
+        if not matched:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.flatnonzero(scores)
+        return self._top(scores[candidates], candidates, k)
+
+    def _query_vector(self, query_vector: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """Vector normalizado, o None si no hay vectores o no coinciden las dimensiones."""
+        if query_vector is None or self._vectors is None or len(query_vector) != self.meta["dimensions"]:
+            return None
+        norm = float(np.linalg.norm(query_vector))
+        return (query_vector / norm).astype(np.float32) if norm else None
+
+    def search_vector(self, query_vector: np.ndarray, k: int = 50) -> np.ndarray:
+        self.load()
+        query_vector = self._query_vector(query_vector)
+        if query_vector is None:
+            return np.empty(0, dtype=np.int64)
+
+        if self._ivf_centroids is None:
+            return self._top(self._vectors @ query_vector, None, k)
+
+        # 🔹 IVF: solo se recorren las nprobe listas con el centroide más cercano
+        lists = self._top(self._ivf_centroids @ query_vector, None, self.nprobe)
+        ids = np.concatenate([self._ivf_ids[self._ivf_indptr[c]:self._ivf_indptr[c + 1]] for c in lists])
+        ids.sort()  # lectura secuencial del mmap
+        return self._top(self._vectors[ids] @ query_vector, ids, k)
+
+    def search(self, query: str, query_vector: Optional[np.ndarray] = None, top: int = 15, k: int = 50) -> List[Dict]:
+        """
+        Búsqueda híbrida: top-k de BM25 y de vectores fusionados con RRF, como Azure Search.
+        Con query_vector, cada resultado lleva además su similitud coseno en SIMILARITY_FIELD
+        y su vector en VECTOR_FIELD.
+        """
+        rankings = [self.search_bm25(query, k)]
+        if query_vector is not None:
+            rankings.append(self.search_vector(query_vector, k))
+
+        fused: Dict[int, float] = {}
+        for ranking in rankings:
+            for rank, doc_id in enumerate(ranking.tolist(), start=1):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (RRF_K + rank)
+
+        best = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top]
+        results = [{"@search.score": score, **self.document(doc_id)} for doc_id, score in best]
+
+        # 🔹 Similitud coseno query-chunk y vector del chunk (filtro de relevancia y sesiones en app.py)
+        normalized = self._query_vector(query_vector)
+        if normalized is not None and best:
+            vectors = np.asarray(self._vectors[[doc_id for doc_id, _ in best]])
+            for doc, vector, similarity in zip(results, vectors, (vectors @ normalized).tolist()):
+                doc[SIMILARITY_FIELD] = similarity
+                doc[VECTOR_FIELD] = vector.astype(np.float16)
+        return results
+
+
+async def export_index(out_path: str, page_size: int = 1000, key_field: str = "id"):
+    """
+    Descarga title, content, url, type y content_vector de todo el índice de Azure Search.
+
+    Pagina por la clave (orderby + filtro "clave gt última") en vez de con skip: el orden es estable
+    y no hay límite de 100000 documentos ($skip). La clave tiene que ser sortable y filterable.
+    """
+    import aiohttp
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    endpoint = (
+        os.getenv("AZURE_SEARCH_ENDPOINT") or f"https://{os.getenv('AZURE_SEARCH_SERVICE')}.search.windows.net"
+    ).rstrip("/")
+    url = f"{endpoint}/indexes/{os.getenv('AZURE_SEARCH_INDEX')}/docs/search?api-version=2024-07-01"
+    headers = {"Content-Type": "application/json", "api-key": os.getenv("AZURE_SEARCH_API_KEY")}
+
+    exported, last_key = 0, None
+    async with aiohttp.ClientSession(headers=headers) as session:
+        with open(out_path, "w", encoding="utf-8") as out:
+            while True:
+                payload = {"search": "*", "select": f"{key_field},title,content,url,type,content_vector",
+                           "orderby": f"{key_field} asc", "top": page_size}
+                if last_key is not None:
+                    escaped = str(last_key).replace("'", "''")
+                    payload["filter"] = f"{key_field} gt '{escaped}'"
+                async with session.post(url, json=payload) as response:
+                    if response.status >= 400:
+                        raise RuntimeError(f"Azure Search devolvió {response.status}: {(await response.text())[:300]}")
+                    page = (await response.json()).get("value", [])
+                for doc in page:
+                    doc.pop("@search.score", None)
+                    out.write(json.dumps(doc, ensure_ascii=False) + "\n")
+                exported += len(page)
+                if len(page) < page_size:
+                    break
+                last_key = page[-1][key_field]
+    print(f"📦 {exported} documentos exportados a {out_path}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Exporta el índice de Azure Search a JSONL")
+    export.add_argument("--out", default="snapshot.jsonl")
+    export.add_argument("--page-size", type=int, default=1000)
+    export.add_argument("--key-field", default="id", help="Campo clave del índice (sortable y filterable)")
+
+    build = commands.add_parser("build", help="Construye el índice local a partir del JSONL")
+    build.add_argument("snapshot")
+    build.add_argument("--out", default="local_index")
+    build.add_argument("--ivf-lists", type=int, default=0,
+                       help="Listas IVF (0 = fuerza bruta; ~sqrt(N) para índices de cientos de miles de chunks)")
+
+    search = commands.add_parser("search", help="Búsqueda BM25 de prueba en el índice local")
+    search.add_argument("index")
+    search.add_argument("query")
+    search.add_argument("--top", type=int, default=5)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        asyncio.run(export_index(args.out, args.page_size, args.key_field))
+    elif args.command == "build":
+        start = time.perf_counter()
+        meta = build_index(args.snapshot, args.out, args.ivf_lists)
+        print(f"✅ Índice local en {args.out} ({time.perf_counter() - start:.1f}s): {json.dumps(meta)}")
+    else:
+        index = LocalIndex(args.index)
+        start = time.perf_counter()
+        results = index.search(args.query, top=args.top)
+        print(f"🔍 {len(results)} resultados en {(time.perf_counter() - start) * 1000:.1f} ms")
+        for doc in results:
+            print(f"  {doc['@search.score']:.4f}  {doc.get('title')}  {doc.get('url')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""
+Stand-in local de Azure Search, Azure OpenAI y el Bot Connector para pruebas de carga.
+
+Implementa las rutas que usa app.py:
+  - POST /indexes/<index>/docs/search                          (Azure Search, también export con search=*)
+  - POST /indexes/<index>/docs/index                           (Azure Search, mergeOrUpload/delete)
+  - GET  /rest/api/content                                     (Confluence: páginas del corpus, para ingest_confluence.py)
+  - POST /openai/deployments/<deployment>/embeddings           (Azure OpenAI)
+  - POST /openai/deployments/<deployment>/chat/completions     (Azure OpenAI, con stream)
+  - POST /v3/conversations/<id>/activities[/<reply_to>]        (respuestas del bot)
+  - PUT  /v3/conversations/<id>/activities/<id>                (update_activity)
+
+Cada API tiene una latencia log-normal configurable (mediana y sigma) y una tasa de errores
+(mitad 429 con Retry-After, mitad 500).
+
+Uso:
+    python mock_azure.py --port 9000 --search-latency 0.12,0.4 --chat-latency 1.5,0.5 --error-rate 0.01
+
+Y en el .env del bot:
+    AZURE_SEARCH_ENDPOINT=http://localhost:9000
+    AZURE_SEARCH_API_KEY=mock
+    AZURE_SEARCH_INDEX=mock
+    AZURE_OPENAI_ENDPOINT=http://localhost:9000
+    AZURE_OPENAI_API_KEY=mock
+    BOT_APP_ID=
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import numpy as np
+from quart import Quart, request, jsonify, Response
+
+app = Quart(__name__)
+
+# 🔹 Configuración (se sobrescribe desde la línea de comandos)
+config = {
+    "search_latency": (0.12, 0.4),
+    "embedding_latency": (0.08, 0.3),
+    "chat_latency": (1.5, 0.5),
+    "intent_latency": (0.4, 0.3),
+    "connector_latency": (0.05, 0.3),
+    "token_interval": 0.02,
+    "error_rate": 0.0,
+    "vectors_retrievable": True,
+}
+
+stats = {"requests": 0, "errors": 0}
+
+WORDS = (
+    "vpn kubernetes despliegue servidor certificado jenkins pipeline base datos backup kafka "
+    "redis api gateway usuario acceso red proxy entorno producción preproducción monitorización "
+    "alertas logs configuración secreto vault token sso arquitectura microservicio cola evento"
+).split()
+
+corpus = []
+confluence = []  # páginas del corpus inicial: lo que sube ingest_confluence.py no las modifica
+
+
+def build_corpus(size: int, seed: int = 42):
+    rng = random.Random(seed)
+    docs = []
+    for i in range(size):
+        topic = rng.sample(WORDS, 3)
+        content = " ".join(rng.choice(WORDS + topic * 5) for _ in range(450))
+        docs.append({
+            "title": f"{' '.join(topic).title()} ({i})",
+            "content": content[:3000],
+            "url": f"https://confluence.local/pages/{i // 3}",
+            "type": "page",
+        })
+    return docs
+
+
+def load_corpus(path: str):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def sample_latency(name: str) -> float:
+    median, sigma = config[f"{name}_latency"]
+    if median <= 0:
+        return 0.0
+    return float(np.random.lognormal(np.log(median), sigma))
+
+
+async def simulate(name: str):
+    """Aplica latencia y, según la tasa de errores, devuelve una respuesta de error."""
+    stats["requests"] += 1
+    await asyncio.sleep(sample_latency(name))
+    if config["error_rate"] and random.random() < config["error_rate"]:
+        stats["errors"] += 1
+        if random.random() < 0.5:
+            return jsonify({"error": {"code": "429", "message": "Too Many Requests"}}), 429, {"Retry-After": "1"}
+        return jsonify({"error": {"code": "500", "message": "Internal Server Error"}}), 500
+    return None
+
+
+def word_vector(word: str, dimensions: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha1(word.encode("utf-8")).digest()[:4], "little")
+    return np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+
+
+def fake_embedding(text: str, dimensions: int) -> list:
+    """Suma de vectores aleatorios por palabra: textos con palabras en común tienen similitud coseno alta."""
+    words = re.findall(r"\w+", text.lower()) or [text]
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word, count in Counter(words).items():
+        vector += np.sqrt(count) * word_vector(word, dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+@app.route("/indexes/<index>/docs/search", methods=["POST"])
+async def search(index):
+    error = await simulate("search")
+    if error:
+        return error
+    payload = await request.get_json()
+    if payload.get("search") == "*":
+        # Export completo (local_index.py export): ordenado por la clave y paginado con "clave gt 'última'"
+        key = (payload.get("orderby") or "id").split()[0]
+        docs = sorted(({key: str(i), **doc} for i, doc in enumerate(corpus)), key=lambda doc: doc[key])
+        after = re.fullmatch(rf"{re.escape(key)} gt '(.*)'", payload.get("filter") or "")
+        if after:
+            docs = [doc for doc in docs if doc[key] > after.group(1).replace("''", "'")]
+        skip, top = int(payload.get("skip", 0)), int(payload.get("top", 50))
+        return jsonify({"value": [
+            {"@search.score": 1.0, **doc, "content_vector": fake_embedding(doc["content"], 1536)}
+            for doc in docs[skip:skip + top]
+        ]})
+    terms = set(re.findall(r"\w+", (payload.get("search") or "").lower()))
+    hybrid = bool(payload.get("vectorQueries"))
+    top = int(payload.get("top", 15))
+
+    scored = []
+    for doc in corpus:
+        overlap = sum(1 for word in terms if word in doc["content"])
+        if overlap or hybrid:
+            scored.append((overlap + random.random(), doc))
+    scored.sort(key=lambda item: item[0], reverse=True)
+
+    with_vectors = "content_vector" in (payload.get("select") or "")
+    if with_vectors and not config["vectors_retrievable"]:
+        # Como Azure con un campo vectorial no recuperable ("retrievable": false)
+        return jsonify({"error": {"code": "", "message": "Invalid expression: The field 'content_vector' is not retrievable."}}), 400
+    dimensions = len(payload["vectorQueries"][0]["vector"]) if hybrid else 1536
+    value = []
+    for rank, (score, doc) in enumerate(scored[:top]):
+        # RRF ~ 1/(60+rank) en híbrida; escala BM25 en keyword
+        search_score = 2 / (60 + rank) if hybrid else 5 + score * 3
+        result = {"@search.score": search_score, **doc}
+        if with_vectors:
+            result["content_vector"] = fake_embedding(doc["content"], dimensions)
+        value.append(result)
+    return jsonify({"value": value})
+
+
+@app.route("/indexes/<index>/docs/index", methods=["POST"])
+async def index_documents(index):
+    error = await simulate("search")
+    if error:
+        return error
+    payload = await request.get_json()
+    results = []
+    for action in payload.get("value", []):
+        action = dict(action)
+        kind = action.pop("@search.action", "upload")
+        key = action.get("id")
+        position = next((i for i, doc in enumerate(corpus) if doc.get("id") == key), None)
+        if kind == "delete":
+            if position is not None:
+                del corpus[position]
+        else:
+            action.pop("content_vector", None)  # el stand-in calcula los vectores al buscar
+            if position is None:
+                corpus.append(action)
+            else:
+                corpus[position] = {**corpus[position], **action} if kind.startswith("merge") else action
+        results.append({"key": key, "status": True, "errorMessage": None, "statusCode": 200})
+    return jsonify({"value": results})
+
+
+def build_confluence_pages(docs_list):
+    """El corpus agrupado por url como páginas de Confluence (una por url, versión 1)."""
+    pages = OrderedDict()
+    for doc in docs_list:
+        pages.setdefault(doc["url"], []).append(doc)
+    return [
+        {
+            "id": url.rsplit("/", 1)[-1],
+            "type": "page",
+            "title": docs[0]["title"],
+            "version": {"number": 1},
+            "body": {"storage": {"value": "".join(f"<p>{doc['content']}</p>" for doc in docs), "representation": "storage"}},
+            "_links": {"webui": f"/pages/{url.rsplit('/', 1)[-1]}"},
+        }
+        for url, docs in pages.items()
+    ]
+
+
+@app.route("/rest/api/content", methods=["GET"])
+async def confluence_content():
+    error = await simulate("search")
+    if error:
+        return error
+    start, limit = int(request.args.get("start", 0)), int(request.args.get("limit", 25))
+    pages = confluence
+    links = {"base": "https://confluence.local"}
+    if start + limit < len(pages):
+        links["next"] = f"/rest/api/content?start={start + limit}&limit={limit}"
+    return jsonify({"results": pages[start:start + limit], "start": start, "limit": limit,
+                    "size": len(pages[start:start + limit]), "_links": links})
+
+
+@app.route("/openai/deployments/<deployment>/embeddings", methods=["POST"])
+async def embeddings(deployment):
+    error = await simulate("embedding")
+    if error:
+        return error
+    payload = await request.get_json()
+    inputs = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+    dimensions = int(payload.get("dimensions", 1536))
+    tokens = sum(len(text.split()) for text in inputs)
+    return jsonify({
+        "object": "list",
+        "model": deployment,
+        "data": [
+            {"object": "embedding", "index": i, "embedding": fake_embedding(text, dimensions)}
+            for i, text in enumerate(inputs)
+        ],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    })
+
+
+def fake_answer(messages) -> str:
+    question = messages[-1]["content"].rsplit("### PREGUNTA:", 1)[-1].strip()
+    return (
+        f"## Respuesta\n\nSegún la documentación, para **{question[:80]}**:\n\n"
+        "1. Revisa la página de referencia.\n2. Aplica la configuración indicada.\n"
+        "3. Valida el resultado en el entorno correspondiente.\n\n"
+        "```bash\nkubectl get pods -n confubot\n```"
+    )
+
+
+@app.route("/openai/deployments/<deployment>/chat/completions", methods=["POST"])
+async def chat_completions(deployment):
+    payload = await request.get_json()
+    is_intent = int(payload.get("max_tokens") or 0) <= 10
+    error = await simulate("intent" if is_intent else "chat")
+    if error:
+        return error
+
+    messages = payload.get("messages", [])
+    if is_intent:
+        content = random.choice(["resumen", "extraccion", "procedimiento", "consulta_directa"])
+    else:
+        content = json.dumps(
+            {"relevance_score": round(random.uniform(0.55, 0.95), 2), "answer": fake_answer(messages)},
+            ensure_ascii=False,
+        )
+    prompt_tokens = sum(len(m.get("content", "")) for m in messages) // 4
+    completion_tokens = len(content) // 4
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+
+    if not payload.get("stream"):
+        return jsonify({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": deployment,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    async def events():
+        def chunk(delta, finish_reason=None):
+            return "data: " + json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": deployment,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }, ensure_ascii=False) + "\n\n"
+
+        yield chunk({"role": "assistant", "content": ""})
+        for i in range(0, len(content), 4):
+            await asyncio.sleep(config["token_interval"])
+            yield chunk({"content": content[i:i + 4]})
+        yield chunk({}, "stop")
+        yield "data: [DONE]\n\n"
+
+    response = Response(events(), mimetype="text/event-stream")
+    response.timeout = None
+    return response
+
+
+@app.route("/v3/conversations/<conversation_id>/activities", methods=["POST"])
+@app.route("/v3/conversations/<conversation_id>/activities/<activity_id>", methods=["POST", "PUT"])
+async def connector_activities(conversation_id, activity_id=None):
+    error = await simulate("connector")
+    if error:
+        return error
+    return jsonify({"id": activity_id if request.method == "PUT" else uuid.uuid4().hex})
+
+
+@app.route("/_stats", methods=["GET"])
+async def get_stats():
+    return jsonify({**stats, "config": config, "corpus": len(corpus)})
+
+
+def parse_latency(value: str):
+    median, _, sigma = value.partition(",")
+    return float(median), float(sigma or 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--corpus", help="JSONL con documentos (title, content, url, type)")
+    parser.add_argument("--corpus-size", type=int, default=500, help="Documentos sintéticos si no hay --corpus")
+    for name in ("search", "embedding", "chat", "intent", "connector"):
+        median, sigma = config[f"{name}_latency"]
+        parser.add_argument(
+            f"--{name}-latency", type=parse_latency, default=(median, sigma), metavar="MEDIANA,SIGMA",
+            help=f"Latencia log-normal en segundos (por defecto {median},{sigma})",
+        )
+    parser.add_argument("--token-interval", type=float, default=config["token_interval"],
+                        help="Segundos entre fragmentos en streaming")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de peticiones con error (0-1)")
+    parser.add_argument("--no-retrievable-vectors", action="store_true",
+                        help="Responder 400 si la búsqueda pide content_vector (campo no recuperable)")
+    args = parser.parse_args()
+
+    for name in ("search", "embedding", "chat", "intent", "connector"):
+        config[f"{name}_latency"] = getattr(args, f"{name}_latency")
+    config["token_interval"] = args.token_interval
+    config["error_rate"] = args.error_rate
+    config["vectors_retrievable"] = not args.no_retrievable_vectors
+    corpus.extend(load_corpus(args.corpus) if args.corpus else build_corpus(args.corpus_size))
+    confluence.extend(build_confluence_pages(corpus))
+
+    print(f"🧪 Stand-in de Azure escuchando en http://{args.host}:{args.port} ({len(corpus)} documentos)")
+    app.run(host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+"""
+Record/replay del pipeline de respuesta para medir, sin red, si un cambio en build_context,
+en los umbrales (MIN_SCORE_THRESHOLD_HYBRID, RELEVANCE_THRESHOLD, filtro de relevancia) o en
+la detección de intención hace el bot más lento o cambia sus respuestas.
+
+  record: pasa cada query por classify_and_retrieve + generate_response_by_intent contra Azure
+          (o mock_azure.py) y guarda, por query, los intercambios con los upstreams —embeddings,
+          búsquedas (payload → resultados) y completions (mensajes → respuesta)— junto con la
+          intención y la respuesta final.
+  replay: repite el mismo recorrido sirviendo esos intercambios desde el fichero, sin red ni
+          cachés, y mide por etapa el tiempo de CPU, los tokens del prompt y las diferencias
+          con la respuesta grabada.
+
+Si una petición no coincide con la grabada (p.ej. build_context ha generado otro prompt) se
+sirve la grabada del mismo tipo y la query se marca como aproximada; si no hay ninguna, la
+query falla. El CPU de cada etapa se cuenta solo mientras su task se ejecuta (MeteredLoop),
+no mientras espera y corren otras ramas del pipeline. Las etapas de upstream (embedding,
+search_*, generation) solo miden el trabajo local (call_upstream, breaker, parseo): la
+latencia de red no se reproduce. Las sesiones y las cachés se desactivan para que cada query
+recorra el pipeline completo.
+
+Para CI: --save guarda el informe en JSON y --compare lo compara con uno anterior. Sale con
+código 1 si una etapa o los tokens del prompt superan el baseline en más de --tolerance, si
+alguna query falla o, con --fail-on-diff, si cambia alguna respuesta.
+
+Uso:
+    python replay_bench.py record intent_samples.jsonl --out replay_fixtures.jsonl
+    python replay_bench.py replay replay_fixtures.jsonl --save replay_baseline.json
+    RELEVANCE_THRESHOLD=0.6 python replay_bench.py replay replay_fixtures.jsonl --compare replay_baseline.json
+"""
+import argparse
+import asyncio
+import base64
+import contextvars
+import difflib
+import hashlib
+import json
+import os
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 🔹 Sin cachés ni sesiones: cada query recorre el pipeline completo y la repetición es determinista
+os.environ.update({
+    "CACHE_BACKEND": "memory",
+    "CACHE_PRELOAD": "false",
+    "EMBEDDING_CACHE_SIZE": "0",
+    "ANSWER_CACHE_ENABLED": "false",
+    "SEARCH_CACHE_TTL": "0",
+    "SESSION_ENABLED": "false",
+    "HEDGE_ENABLED": "false",
+})
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import app  # noqa: E402
+from openai.types import CreateEmbeddingResponse  # noqa: E402
+from openai.types.chat import ChatCompletion  # noqa: E402
+
+
+def load_queries(path):
+    with open(path, encoding="utf-8") as f:
+        queries = [json.loads(line)["query"] for line in f if line.strip()]
+    return list(dict.fromkeys(queries))
+
+
+def load_fixtures(path) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def pack_vector(values) -> str:
+    return base64.b64encode(np.asarray(values, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def unpack_vector(data: str) -> List[float]:
+    # 🔹 Lista de floats, como la que devuelve el JSON de Azure
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32).tolist()
+
+
+def request_key(request: Dict) -> str:
+    return hashlib.sha1(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def chat_kind(request: Dict) -> str:
+    return "generation" if "response_format" in request else "intent"
+
+
+def search_kind(payload: Dict) -> str:
+    return "search_hybrid" if "vectorQueries" in payload else "search_classic"
+
+
+def prompt_tokens(request: Optional[Dict]) -> int:
+    if request is None:
+        return 0
+    return sum(app.count_tokens(message["content"]) for message in request["messages"])
+
+
+class Recorder:
+    """
+    Se hace pasar por el cliente de Azure OpenAI y por post_search: llama a los de verdad y
+    guarda cada intercambio de la query en curso (los vectores en base64 float32).
+    """
+
+    def __init__(self, client, post_search):
+        self.client = client
+        self.post_search = post_search
+        self.exchanges: List[Dict] = []
+        self.failures = 0
+        self.embeddings = SimpleNamespace(create=self._embed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._complete))
+
+    def install(self):
+        app.get_openai_client = lambda: self
+        app.post_search = self._search
+
+    def start(self):
+        self.exchanges = []
+        self.failures = 0
+
+    async def _call(self, call):
+        try:
+            return await call()
+        except Exception:
+            self.failures += 1
+            raise
+
+    async def _embed(self, **request):
+        response = await self._call(lambda: self.client.embeddings.create(**request))
+        data = response.model_dump()
+        for item in data["data"]:
+            item["embedding"] = pack_vector(item["embedding"])
+        self.exchanges.append({"kind": "embedding", "key": request_key(request), "request": request, "response": data})
+        return response
+
+    async def _complete(self, **request):
+        response = await self._call(lambda: self.client.chat.completions.create(**request))
+        self.exchanges.append({
+            "kind": chat_kind(request), "key": request_key(request), "request": request,
+            "response": response.model_dump(mode="json"),
+        })
+        return response
+
+    async def _search(self, payload: Dict, timeout: Optional[float] = None) -> List[Dict]:
+        results = await self._call(lambda: self.post_search(payload, timeout))
+        docs = [
+            {**doc, "content_vector": pack_vector(doc["content_vector"])} if "content_vector" in doc else dict(doc)
+            for doc in results
+        ]
+        # 🔹 El vector de la query no se guarda: ya está en la clave y se reconstruye del embedding
+        light = {**payload, "vectorQueries": [
+            {k: v for k, v in vq.items() if k != "vector"} for vq in payload.get("vectorQueries", [])
+        ]} if "vectorQueries" in payload else payload
+        self.exchanges.append({"kind": search_kind(payload), "key": request_key(payload), "request": light, "response": docs})
+        return results
+
+
+class ReplayMiss(Exception):
+    """La query necesita un upstream que no se grabó."""
+
+
+class StageFrame:
+    """Etapa abierta en una task: acumula CPU solo mientras esa task se está ejecutando."""
+
+    __slots__ = ("name", "cpu", "overhead", "since")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.cpu = 0.0
+        self.overhead = 0.0
+        self.since = time.thread_time()
+
+
+open_stages: "contextvars.ContextVar[Tuple[StageFrame, ...]]" = contextvars.ContextVar("open_stages", default=())
+
+
+def _metered(callback, *args):
+    """
+    Un paso del event loop (p.ej. un tramo de una task hasta su siguiente await). Corre en el
+    contexto de la task, así que ve sus etapas abiertas: el contador de estas se reanuda al
+    empezar el paso y se cierra al terminar.
+    """
+    now = time.thread_time()
+    for frame in open_stages.get():
+        frame.since = now
+    try:
+        callback(*args)
+    finally:
+        now = time.thread_time()
+        for frame in open_stages.get():
+            frame.cpu += now - frame.since
+            frame.since = now
+
+
+class MeteredLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop que mide por paso: la intención y el embedding→búsqueda corren a la vez en el
+    mismo hilo, y sin esto el CPU de una etapa incluiría el de las otras corrutinas que se
+    ejecutan mientras la etapa espera.
+    """
+
+    def call_soon(self, callback, *args, context=None):
+        return super().call_soon(_metered, callback, *args, context=context)
+
+    def call_soon_threadsafe(self, callback, *args, context=None):
+        return super().call_soon_threadsafe(_metered, callback, *args, context=context)
+
+
+class Replayer:
+    """
+    Sirve los intercambios grabados de la query en curso en lugar del cliente de Azure OpenAI
+    y de post_search. Busca primero la petición exacta; si no está, la grabada del mismo tipo.
+    El CPU que gasta en ello (overhead) se descuenta de las etapas.
+    """
+
+    def __init__(self):
+        self.by_key: Dict[str, Dict] = {}
+        self.by_kind: Dict[str, Dict] = {}
+        self.approximate: set = set()
+        self.missing: set = set()
+        self.generation_request: Optional[Dict] = None
+        self.overhead = 0.0
+        self.embeddings = SimpleNamespace(create=self._embed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._complete))
+
+    def install(self):
+        app.get_openai_client = lambda: self
+        app.post_search = self._search
+        original_stage = app.stage
+
+        @contextmanager
+        def cpu_stage(name: str):
+            frame = StageFrame(name)
+            token = open_stages.set(open_stages.get() + (frame,))
+            try:
+                with original_stage(name):
+                    yield
+            finally:
+                frame.cpu += time.thread_time() - frame.since
+                open_stages.reset(token)
+                times = cpu_times.get()
+                if times is not None:
+                    times[name] = times.get(name, 0.0) + frame.cpu - frame.overhead
+
+        app.stage = cpu_stage
+
+    def _charge(self, start: float):
+        """Descuenta el CPU del propio replay de la query y de las etapas abiertas en esta task."""
+        elapsed = time.thread_time() - start
+        self.overhead += elapsed
+        for frame in open_stages.get():
+            frame.overhead += elapsed
+
+    def start(self, fixture: Dict):
+        self.by_key = {exchange["key"]: exchange for exchange in fixture["exchanges"]}
+        self.by_kind = {}
+        for exchange in fixture["exchanges"]:
+            self.by_kind.setdefault(exchange["kind"], exchange)
+        self.approximate = set()
+        self.missing = set()
+        self.generation_request = None
+
+    def _serve(self, kind: str, request: Dict) -> Dict:
+        exchange = self.by_key.get(request_key(request))
+        if exchange is None or exchange["kind"] != kind:
+            exchange = self.by_kind.get(kind)
+            if exchange is None:
+                # 🔹 El pipeline puede absorber el error con un fallback: se anota igualmente
+                self.missing.add(kind)
+                raise ReplayMiss(f"sin {kind} grabado")
+            self.approximate.add(kind)
+        return exchange["response"]
+
+    async def _embed(self, **request):
+        start = time.thread_time()
+        try:
+            data = json.loads(json.dumps(self._serve("embedding", request)))
+            for item in data["data"]:
+                item["embedding"] = unpack_vector(item["embedding"])
+            return CreateEmbeddingResponse.model_validate(data)
+        finally:
+            self._charge(start)
+
+    async def _complete(self, **request):
+        start = time.thread_time()
+        try:
+            kind = chat_kind(request)
+            if kind == "generation":
+                self.generation_request = request
+            return ChatCompletion.model_validate(self._serve(kind, request))
+        finally:
+            self._charge(start)
+
+    async def _search(self, payload: Dict, timeout: Optional[float] = None) -> List[Dict]:
+        start = time.thread_time()
+        try:
+            # 🔹 Copias nuevas: attach_similarity modifica los documentos
+            return [
+                {**doc, "content_vector": unpack_vector(doc["content_vector"])} if "content_vector" in doc else dict(doc)
+                for doc in self._serve(search_kind(payload), payload)
+            ]
+        finally:
+            self._charge(start)
+
+
+cpu_times: "contextvars.ContextVar[Optional[Dict[str, float]]]" = contextvars.ContextVar("cpu_times", default=None)
+
+
+async def record(args):
+    queries = load_queries(args.queries)
+    await app.startup()
+    recorder = Recorder(app.get_openai_client(), app.post_search)
+    recorder.install()
+    written = 0
+    try:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for query in queries:
+                recorder.start()
+                try:
+                    intent, search_results, _, _, _ = await app.classify_and_retrieve(query)
+                    answer = await app.generate_response_by_intent(query, search_results, intent)
+                except Exception as e:
+                    print(f"❌ {query!r}: {e!r}")
+                    continue
+                if recorder.failures:
+                    # 🔹 Un upstream falló y el pipeline tiró de fallback: no es un caso representativo
+                    print(f"⚠️ {query!r}: {recorder.failures} llamadas fallidas, no se graba")
+                    continue
+                f.write(json.dumps({
+                    "query": query, "intent": intent, "answer": answer, "exchanges": recorder.exchanges,
+                }, ensure_ascii=False) + "\n")
+                written += 1
+                print(f"📼 {query[:60]!r}: {intent}, {len(search_results)} chunks, {len(recorder.exchanges)} intercambios")
+    finally:
+        await app.shutdown()
+    print(f"\n✅ {written}/{len(queries)} queries grabadas en {args.out}")
+
+
+async def replay_query(replayer: Replayer, fixture: Dict) -> Dict:
+    query = fixture["query"]
+    replayer.start(fixture)
+    times: Dict[str, float] = {}
+    cpu_times.set(times)
+    result = {"query": query, "error": None}
+    start, overhead = time.thread_time(), replayer.overhead
+    try:
+        intent, search_results, _, _, _ = await app.classify_and_retrieve(query)
+        answer = await app.generate_response_by_intent(query, search_results, intent)
+    except Exception as e:
+        result["error"] = repr(e)
+        return result
+    times["total"] = time.thread_time() - start - (replayer.overhead - overhead)
+    recorded_request = next((ex["request"] for ex in fixture["exchanges"] if ex["kind"] == "generation"), None)
+    result.update({
+        "intent": intent,
+        "answer": answer,
+        "chunks": len(search_results),
+        "cpu": times,
+        "approximate": sorted(replayer.approximate),
+        "missing": sorted(replayer.missing),
+        "prompt_tokens": prompt_tokens(replayer.generation_request),
+        "prompt_tokens_recorded": prompt_tokens(recorded_request),
+    })
+    return result
+
+
+async def replay(args) -> List[List[Dict]]:
+    fixtures = load_fixtures(args.fixtures)
+    replayer = Replayer()
+    replayer.install()
+    app.get_tokenizer()  # la carga (o el intento de descarga) de tiktoken no cuenta
+    rounds = []
+    for round_number in range(args.warmup + args.rounds):
+        results = [await replay_query(replayer, fixture) for fixture in fixtures]
+        if round_number >= args.warmup:
+            rounds.append(results)
+    return rounds
+
+
+def summarize(rounds: List[List[Dict]]) -> Dict:
+    """CPU por etapa (ms por query; mínimo y mediana entre rondas), tokens y respuestas."""
+    results = rounds[0]
+    ok = [result for result in results if result["error"] is None]
+    per_round: Dict[str, List[float]] = {}
+    for round_results in rounds:
+        totals: Dict[str, float] = {}
+        for result in round_results:
+            for name, seconds in result.get("cpu", {}).items():
+                totals[name] = totals.get(name, 0.0) + seconds
+        for name, seconds in totals.items():
+            per_round.setdefault(name, []).append(seconds * 1000 / max(len(ok), 1))
+    stages = {
+        name: {"min": min(values), "median": statistics.median(values)}
+        for name, values in sorted(per_round.items(), key=lambda item: item[0] == "total")
+    }
+    return {
+        "queries": len(results),
+        "rounds": len(rounds),
+        "errors": len(results) - len(ok),
+        "stages_ms": stages,
+        "prompt_tokens": sum(result["prompt_tokens"] for result in ok),
+        "prompt_tokens_recorded": sum(result["prompt_tokens_recorded"] for result in ok),
+        "answers": {
+            result["query"]: hashlib.sha1(result["answer"].encode("utf-8")).hexdigest()[:12] for result in ok
+        },
+    }
+
+
+def report(fixtures: List[Dict], rounds: List[List[Dict]], summary: Dict, baseline: Optional[Dict], args) -> List[str]:
+    """Imprime el informe y devuelve las regresiones encontradas."""
+    regressions = []
+    results = rounds[0]
+    recorded = {fixture["query"]: fixture for fixture in fixtures}
+
+    print(f"\n📊 Replay de {summary['queries']} queries, {summary['rounds']} rondas (CPU, ms por query)\n")
+    header = f"{'etapa':<16} {'mín':>8} {'mediana':>8}"
+    if baseline:
+        header += f" {'baseline':>9} {'Δ':>7}"
+    print(header)
+    for name, values in summary["stages_ms"].items():
+        line = f"{name:<16} {values['min']:>8.3f} {values['median']:>8.3f}"
+        previous = (baseline or {}).get("stages_ms", {}).get(name)
+        if previous:
+            change = values["min"] / previous["min"] - 1 if previous["min"] else 0.0
+            line += f" {previous['min']:>9.3f} {change:>+7.0%}"
+            if previous["min"] >= args.min_ms and change > args.tolerance:
+                regressions.append(f"{name}: {previous['min']:.3f} → {values['min']:.3f} ms ({change:+.0%})")
+        print(line)
+
+    tokens, tokens_recorded = summary["prompt_tokens"], summary["prompt_tokens_recorded"]
+    print(f"\n🧮 Tokens de prompt: {tokens} (grabación: {tokens_recorded}, {tokens - tokens_recorded:+d})")
+    if baseline and baseline.get("prompt_tokens") and tokens > baseline["prompt_tokens"] * (1 + args.tolerance):
+        regressions.append(f"tokens de prompt: {baseline['prompt_tokens']} → {tokens}")
+
+    ok = [result for result in results if result["error"] is None]
+    changed = [result for result in ok if result["answer"] != recorded[result["query"]]["answer"]]
+    intents = sum(result["intent"] != recorded[result["query"]]["intent"] for result in ok)
+    approximate = sum(bool(result["approximate"]) for result in ok)
+    print(f"📝 Respuestas distintas de la grabada: {len(changed)}/{len(ok)}; intenciones distintas: {intents}; "
+          f"aproximadas (petición no grabada): {approximate}")
+    if baseline:
+        differ = sum(summary["answers"].get(query) != answer for query, answer in baseline.get("answers", {}).items())
+        print(f"   Respuestas distintas del baseline: {differ}/{len(baseline.get('answers', {}))}")
+    for result in changed[:args.show_diffs]:
+        print(f"\n--- {result['query']!r} ({result['intent']}, prompt {result['prompt_tokens_recorded']} → {result['prompt_tokens']} tokens)")
+        diff = list(difflib.unified_diff(
+            recorded[result["query"]]["answer"].splitlines(), result["answer"].splitlines(), lineterm="", n=0,
+        ))[2:]
+        for sign in "-+":
+            lines = [line for line in diff if line.startswith(sign)]
+            for line in lines[:8]:
+                print(f"   {line}")
+            if len(lines) > 8:
+                print(f"   {sign} … ({len(lines) - 8} líneas más)")
+    if changed and args.fail_on_diff:
+        regressions.append(f"{len(changed)} respuestas distintas de la grabada")
+
+    for result in results:
+        if result["error"] is not None:
+            print(f"❌ {result['query']!r}: {result['error']}")
+    missing = [result for result in ok if result["missing"]]
+    for result in missing[:args.show_diffs]:
+        print(f"⚠️ {result['query']!r}: sin grabar {', '.join(result['missing'])} (el pipeline tiró de fallback)")
+    if summary["errors"]:
+        regressions.append(f"{summary['errors']} queries fallidas")
+    if missing:
+        regressions.append(f"{len(missing)} queries necesitan llamadas no grabadas: hay que volver a grabar")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="Grabar intercambios contra Azure (o mock_azure.py)")
+    record_parser.add_argument("queries", help="JSONL con {\"query\": ...} (p.ej. intent_samples.jsonl)")
+    record_parser.add_argument("--out", default="replay_fixtures.jsonl")
+
+    replay_parser = commands.add_parser("replay", help="Repetir sin red y medir")
+    replay_parser.add_argument("fixtures", help="JSONL generado con record")
+    replay_parser.add_argument("--rounds", type=int, default=5, help="Rondas medidas (se toma el mínimo y la mediana)")
+    replay_parser.add_argument("--warmup", type=int, default=1, help="Rondas previas sin medir")
+    replay_parser.add_argument("--save", help="Guardar el informe en JSON (baseline para --compare)")
+    replay_parser.add_argument("--compare", help="Informe JSON anterior con el que comparar")
+    replay_parser.add_argument("--tolerance", type=float, default=0.2, help="Empeoramiento relativo admitido")
+    replay_parser.add_argument("--min-ms", type=float, default=0.5, help="Etapas más rápidas no se comparan (ruido)")
+    replay_parser.add_argument("--show-diffs", type=int, default=3, help="Diferencias de respuesta a mostrar")
+    replay_parser.add_argument("--fail-on-diff", action="store_true", help="Fallar si cambia alguna respuesta")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        asyncio.run(record(args))
+        return
+
+    with asyncio.Runner(loop_factory=MeteredLoop) as runner:
+        rounds = runner.run(replay(args))
+    summary = summarize(rounds)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = report(load_fixtures(args.fixtures), rounds, summary, baseline, args)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Informe guardado en {args.save}")
+    if regressions:
+        print("\n❌ Regresiones:")
+        for regression in regressions:
+            print(f"   - {regression}")
+        sys.exit(1)
+    print("\n✅ Sin regresiones")
+
+
+if __name__ == "__main__":
+    main()
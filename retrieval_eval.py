@@ -0,0 +1,104 @@
+"""
+Comparativa del índice local (local_index.py) frente a la búsqueda híbrida de Azure Search.
+
+Para cada query del fichero JSONL ({"query": ...}) calcula el embedding una vez y mide:
+  - Azure Search híbrida (mismo payload que search_azure_hybrid, sin caché)
+  - índice local: BM25, vectores y la fusión híbrida con RRF
+El recall@k del índice local se calcula respecto al top-k de Azure (mismo documento =
+misma url, título y comienzo del contenido).
+
+Uso:
+    python local_index.py export --out snapshot.jsonl
+    python local_index.py build snapshot.jsonl --out local_index
+    python retrieval_eval.py intent_samples.jsonl --index local_index
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import app
+from local_index import LocalIndex
+
+
+def load_queries(path):
+    with open(path, encoding="utf-8") as f:
+        queries = [json.loads(line)["query"] for line in f if line.strip()]
+    return list(dict.fromkeys(queries))
+
+
+def doc_key(doc):
+    return doc.get("url"), doc.get("title"), (doc.get("content") or "")[:80]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return float(np.percentile(np.array(values), p))
+
+
+def timed(rows, name, call):
+    start = time.perf_counter()
+    result = call()
+    rows.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+    return result
+
+
+async def evaluate(queries, index, ks):
+    latencies = {}
+    recalls = {k: [] for k in ks}
+    index.load()  # la carga (mmap) no cuenta en la latencia
+
+    for query in queries:
+        embedding = await app.generate_embedding(query)
+        vector = embedding if embedding.any() else None
+
+        start = time.perf_counter()
+        azure = await app.post_search(app.build_hybrid_payload(query, embedding))
+        latencies.setdefault("azure_hybrid", []).append((time.perf_counter() - start) * 1000)
+
+        timed(latencies, "local_bm25", lambda: index.search_bm25(query))
+        if vector is not None:
+            timed(latencies, "local_vector", lambda: index.search_vector(vector))
+        local = timed(latencies, "local_hybrid", lambda: index.search(query, vector, top=max(ks)))
+
+        for k in ks:
+            expected = {doc_key(doc) for doc in azure[:k]}
+            if expected:
+                found = {doc_key(doc) for doc in local[:k]}
+                recalls[k].append(len(expected & found) / len(expected))
+    return latencies, recalls
+
+
+def report(queries, latencies, recalls):
+    print(f"\n📊 {len(queries)} queries evaluadas\n")
+    print(f"{'búsqueda':<14} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, values in latencies.items():
+        print(f"{name:<14} {percentile(values, 50):>9.2f} {percentile(values, 95):>9.2f}")
+    print()
+    for k, values in recalls.items():
+        if values:
+            print(f"recall@{k:<3} local vs Azure: {np.mean(values):.1%}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("queries", help="Fichero JSONL con un campo 'query' por línea")
+    parser.add_argument("--index", default=app.LOCAL_INDEX_PATH or "local_index", help="Directorio del índice local")
+    parser.add_argument("--nprobe", type=int, default=app.LOCAL_INDEX_NPROBE, help="Listas IVF a recorrer")
+    parser.add_argument("--k", type=int, nargs="+", default=[5, 15], help="Cortes para el recall")
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    await app.startup()
+    try:
+        latencies, recalls = await evaluate(queries, LocalIndex(args.index, nprobe=args.nprobe), args.k)
+        report(queries, latencies, recalls)
+    finally:
+        await app.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())